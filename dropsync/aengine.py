@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+"""
+Asyncio based sync engine for full syncs, with the same command line as dbxmirror.
+
+Listing folders, hashing local files, transfers and metadata writes run as
+concurrent pipeline stages. Blocking calls (the dropbox API and hashing) run in
+thread pools, everything touching the metadata DB runs on the event loop thread.
+"""
+import sys, os, asyncio, functools, concurrent.futures
+from . import dbxmirror, dbxmeta, dropbox_content_hasher
+from .dbxmirror import log
+
+
+class AsyncTransfers(object):
+  """
+  dbxtransfer.Transfers for the event loop: transfers run in a bounded thread pool,
+  completion callbacks are called on the event loop thread.
+  """
+  def __init__(self, loop, jobs=1):
+    self.loop    = loop
+    self.pool    = concurrent.futures.ThreadPoolExecutor(max(1, jobs), thread_name_prefix="dropsync")
+    self.pending = set()
+    self.recent  = [] # tasks submitted since it was last reset, see Engine.folder()
+
+  def track(self, coro):
+    task = self.loop.create_task(coro)
+    self.pending.add(task)
+    task.add_done_callback(self.pending.discard)
+    self.recent += [ task ]
+    return task
+
+  def submit(self, fn, done=None, *args, **kwargs):
+    async def run():
+      result = await self.loop.run_in_executor(self.pool, functools.partial(fn, *args, **kwargs))
+      if done is not None: done(result)
+      return result
+    return self.track(run())
+
+  def after(self, done, fn=None, *args):
+    """
+    call done() as soon as the transfers submitted since 'recent' was reset (those of the current folder) are finished.
+    With 'fn': done(fn(*args)), fn runs in the thread pool
+    """
+    tasks = list(self.recent)
+    async def wait():
+      await asyncio.gather(*tasks)
+      if fn is None: done()
+      else:          done(await self.loop.run_in_executor(self.pool, functools.partial(fn, *args)))
+    return self.track(wait())
+
+  async def join(self):
+    while self.pending:
+      await asyncio.gather(*list(self.pending))
+
+  def close(self, cancel=False):
+    if cancel:
+      for task in self.pending: task.cancel()
+    self.pool.shutdown(wait=True)
+
+
+class Engine(object):
+  """
+  A full sync of the folder tree, like dbxmirror.sync().
+
+  Each folder is a task. Up to 'backlog' folders are listed, compared and transferred
+  at the same time, so listing subfolders overlaps with the transfers of their parents.
+  A folder is finished (metadata written, journal updated), when its own transfers
+  and all of its subfolders are finished.
+  """
+  def __init__(self, args, dbx, metadb, backlog=None):
+    self.args    = args
+    self.dbx     = dbx
+    self.metadb  = metadb
+    self.backlog = backlog if backlog is not None else max(2, 2 * args.jobs)
+    self.tasks   = set()
+
+  async def run(self):
+    loop = asyncio.get_running_loop()
+    args = self.args
+    self.io      = concurrent.futures.ThreadPoolExecutor(max(2, args.hash_jobs), thread_name_prefix="dropsync-io")
+    self.lister  = concurrent.futures.ThreadPoolExecutor(max(1, args.list_jobs), thread_name_prefix="dropsync-list")
+    self.folders = asyncio.Semaphore(self.backlog)
+    threaded, args.transfers = args.transfers, AsyncTransfers(loop, args.jobs)
+    try:
+      await self.folder(None)
+      await args.transfers.join()
+    except BaseException:
+      for task in self.tasks: task.cancel()
+      args.transfers.close(cancel=True)
+      raise
+    else:
+      args.transfers.close()
+    finally:
+      self.io.shutdown(wait=True)
+      self.lister.shutdown(wait=True)
+      args.transfers = threaded
+
+  def execute(self, fn, *args, pool=None):
+    return asyncio.get_running_loop().run_in_executor(pool or self.io, functools.partial(fn, *args))
+
+  def spawn(self, coro):
+    task = asyncio.ensure_future(coro)
+    self.tasks.add(task)
+    task.add_done_callback(self.tasks.discard)
+    return task
+
+  async def local_hash(self, meta, loc, cached):
+    """ the content hash of an existing local file, if download() would have to read it """
+    try:
+      st = os.stat(loc)
+    except OSError:
+      return None
+    if cached is not None and cached.fingerprint is not None and cached.content_hash is not None and \
+       cached.fingerprint == dbxmirror.fingerprint(st):
+      return None
+    return await self.execute(functools.partial(dropbox_content_hasher.hash_file, loc, workers=self.args.hash_jobs))
+
+  async def folder(self, path):
+    args, metadb = self.args, self.metadb
+    if path is None: folder = dpath = args.remote
+    else:            folder,  dpath = path.path_display, path.path_lower
+
+    local = dbxmirror.localpath(args, dbxmirror.relpath(args, folder))
+    if path is not None and dbxmirror.skipped(args, dpath, folder, local):
+      return
+
+    async with self.folders:
+      entries = await self.execute(dbxmirror.dbx_list_entries, self.dbx, dpath, pool=self.lister)
+
+      log(args, 2, "Syncing {0}".format(local))
+      log(args, 3, "Remote {0}".format(folder))
+      folders, files, deleted = dbxmirror.dbx_split(args, entries)
+
+      parent = dpath if path is not None else "" # key of the parent entry
+      batch  = dbxmirror.prepare_folder(args, metadb, dpath, local, parent, folders, files, deleted)
+
+      hashes = {}
+      if not args.dir_only:
+        found = await asyncio.gather(*[ self.local_hash(f, os.path.join(local, f.name), batch.get(f.path_lower)) for f in files ])
+        hashes = { f.path_lower: h for f, h in zip(files, found) if h is not None }
+
+      created = {} # the remote folders of local-only trees, instead of creating them on the event loop
+      if args.direction != "download" and not args.dry_run and dpath in args.uploads:
+        created = await self.execute(dbxmirror.create_folders, args, self.dbx, args.uploads[dpath], dpath)
+
+      args.transfers.recent = [] # no await until all transfers of this folder are submitted
+      dbxmirror.sync_files(args, self.dbx, metadb, batch, dpath, local, parent, entries, files, hashes, created)
+      transfers = args.transfers.recent
+
+      # list the subfolders while the files are transferred
+      subfolders = [ self.spawn(self.folder(f)) for f in folders ]
+
+      await asyncio.gather(*transfers)
+      batch.flush()
+
+    await asyncio.gather(*subfolders)
+    for f in folders:
+      batch.add(dbxmeta.MetaRecord.from_dbx(f, parent), args.synctime)
+    batch.flush()
+    if path is not None and dbxmirror.complete(args, dpath): metadb.journal_done(dpath)
+
+
+def walk(args, dbx, metadb):
+  """ replaces dbxmirror.sync() in dbxmirror.sync_full() """
+  asyncio.run(Engine(args, dbx, metadb).run())
+
+def main(argv=sys.argv[1:]):
+  return dbxmirror.main(argv, walk=walk, prog="dbxmirror-async")
+
+if __name__ == "__main__": # pragma: nocover
+  sys.exit(main())
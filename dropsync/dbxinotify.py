@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+"""
+Records local changes for incremental uploads (dbxmirror --direction=upload --incremental).
+
+Watches the local folder with Linux inotify and writes the changed paths into the metadata DB.
+The next sync only uploads (or removes) these paths instead of scanning the whole tree. It falls
+back to a full scan, if the watcher isn't running, has been started after the last full scan or
+has lost events (queue overflow, fs.inotify.max_user_watches exceeded).
+"""
+import sys, os, re, argparse, ctypes, ctypes.util, errno, json, select, sqlite3, struct
+from . import dbxmeta, dbxtransfer, dbxutil
+from .dbxmirror import utcnow
+
+IN_MODIFY      = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+# IN_MODIFY is reported for every write, IN_CLOSE_WRITE once the file is complete
+EVENTS = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT  = struct.Struct("iIII") # wd, mask, cookie, len, followed by the name
+
+
+class Inotify(object):
+  """
+  Recursive inotify watch of the folder tree 'root'. read() returns the changed paths,
+  relative to 'root'. 'ignore(relative path)' skips files and folders, e.g. the metadata DB
+  """
+  def __init__(self, root, ignore=None):
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+      raise OSError(errno.ENOSYS, "inotify is not available on this system")
+    self.libc     = libc
+    self.root     = root
+    self.ignore   = ignore or (lambda rel: False)
+    self.dirs     = {} # watch descriptor -> folder, relative to root
+    self.overflow = False # events have been lost
+    self.fd       = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err))
+    self.watch_tree("")
+
+  def watch(self, rel):
+    # a folder watched already (e.g. moved within the tree) keeps its descriptor
+    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(self.root, rel)), EVENTS | IN_ONLYDIR)
+    if wd < 0:
+      err = ctypes.get_errno()
+      if err == errno.ENOSPC:
+        self.overflow = True # max_user_watches
+      elif err not in (errno.ENOENT, errno.ENOTDIR): # removed in the meantime
+        raise OSError(err, os.strerror(err), os.path.join(self.root, rel))
+      return
+    self.dirs[wd] = rel
+
+  def watch_tree(self, rel):
+    self.watch(rel)
+    for path, folders, _files in os.walk(os.path.join(self.root, rel)):
+      folders[:] = [ f for f in folders if not self.ignore(os.path.relpath(os.path.join(path, f), self.root)) ]
+      for f in folders:
+        self.watch(os.path.relpath(os.path.join(path, f), self.root))
+
+  def unwatch_tree(self, rel):
+    for wd, folder in list(self.dirs.items()):
+      if folder == rel or folder.startswith(rel + os.sep):
+        self.libc.inotify_rm_watch(self.fd, wd)
+        del self.dirs[wd]
+
+  def read(self, timeout=None):
+    """ the paths changed within 'timeout' seconds (None: until something changes) """
+    changed = set()
+    if not select.select([ self.fd ], [], [], timeout)[0]:
+      return changed
+    try:
+      data = os.read(self.fd, 64 * 1024)
+    except BlockingIOError: # pragma: nocover
+      return changed
+    for wd, mask, name in self.events(data):
+      if mask & IN_Q_OVERFLOW:
+        self.overflow = True
+        continue
+      if mask & IN_IGNORED: # the folder has been removed
+        self.dirs.pop(wd, None)
+        continue
+      folder = self.dirs.get(wd)
+      if folder is None or not name:
+        continue
+      rel = os.path.join(folder, name) if folder else name
+      if self.ignore(rel):
+        continue
+      changed.add(rel)
+      if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+        self.unwatch_tree(rel)
+      if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+        self.watch_tree(rel) # its contents are uploaded along with the new folder
+    return changed
+
+  @staticmethod
+  def events(data):
+    """ (watch descriptor, mask, name) of the inotify_event structs in 'data' """
+    pos = 0
+    while pos < len(data):
+      wd, mask, _cookie, size = EVENT.unpack_from(data, pos)
+      name = data[pos + EVENT.size:pos + EVENT.size + size].rstrip(b"\0")
+      pos += EVENT.size + size
+      yield wd, mask, os.fsdecode(name)
+
+  def close(self):
+    os.close(self.fd)
+
+
+def record(metadb, changed, state):
+  """ write the changed paths (and the watcher state). False, if the DB is locked by a sync """
+  try:
+    metadb.journal_local(changed)
+    if state is not None: metadb.set_state("local_journal", json.dumps(state))
+    metadb.commit()
+  except sqlite3.OperationalError as exc:
+    if "locked" not in str(exc): raise
+    metadb.db.rollback()
+    return False
+  return True
+
+def ignorer(args):
+  """ ignore(relative path): the metadata DB, partial downloads and everything below the folders excluded by --exclude """
+  matcher = dbxutil.PathMatcher([ re.compile("^/" + p.lstrip("/"), re.I) for p in args.exclude ],
+                                [ re.compile("^/" + p.lstrip("/"), re.I) for p in args.include ])
+  def ignore(rel):
+    name = os.path.basename(rel)
+    return name.startswith(args.metadb) or dbxtransfer.part_target(name) is not None or \
+           matcher.excluded_tree("/" + rel.replace(os.sep, "/"))
+  return ignore
+
+def argparser(prog=None):
+  ap = argparse.ArgumentParser(prog=prog, description="Record local changes for dbxmirror --direction=upload --incremental")
+  ap.add_argument(      "local",       default=None)
+  ap.add_argument("-m", "--metadb",    default=".~dropsync.py.db3", help="Metadata file. Always located in local folder")
+  ap.add_argument(      "--metadb-profile", default="safe", choices=sorted(dbxmeta.DbxMetaDB.PROFILES), help="SQLite settings of the metadata file, as for dbxmirror")
+  ap.add_argument("-x", "--exclude",   default=[],          action="append", help="RegEx matching the path (relative to the local folder, as for dbxmirror)")
+  ap.add_argument("-i", "--include",   default=[],          action="append", help="RegEx overriding exclude")
+  ap.add_argument(      "--interval",  default=1.0,         type=float, help="Seconds between writes of the recorded changes")
+  ap.add_argument("-v", "--verbose",   default=0,           action="count", help="Specify multiple times to increase verbosity")
+  return ap
+
+def main(argv=sys.argv[1:], prog=None):
+  args = argparser(prog).parse_args(argv)
+  local = os.path.realpath(args.local)
+
+  try:
+    watcher = Inotify(local, ignorer(args))
+  except OSError as exc:
+    print(f"ERROR: Cannot watch {local}: {exc}", file=sys.stderr)
+    return 2
+  metadb = dbxmeta.DbxMetaDB(local, args.metadb, profile=args.metadb_profile)
+  state  = { "pid": os.getpid(), "since": utcnow().isoformat(), "overflow": None }
+  if args.verbose: print(f"Watching {local}, {len(watcher.dirs)} folders")
+
+  pending, updated = set(), True
+  try:
+    while True:
+      if watcher.overflow:
+        print(f"WARNING: Lost changes of {local}, the next sync is a full one", file=sys.stderr)
+        state["overflow"], updated = utcnow().isoformat(), True
+        watcher.overflow = False
+      if (pending or updated) and record(metadb, pending, state if updated else None):
+        pending, updated = set(), False
+      changed = watcher.read(args.interval)
+      if args.verbose > 1:
+        for rel in sorted(changed): print(f"Changed {rel}")
+      pending |= changed
+  except KeyboardInterrupt:
+    pass
+  finally:
+    watcher.close()
+    try:
+      metadb.journal_local(pending)
+      metadb.set_state("local_journal", None) # the next sync is a full one
+      metadb.close()
+    except sqlite3.OperationalError: # pragma: nocover # locked, the sync checks if the watcher is still running anyway
+      pass
+  return 0
+
+if __name__ == "__main__": # pragma: nocover
+  sys.exit(main())
@@ -1,8 +1,8 @@
-import os, datetime, pathlib, urllib.parse
+import os, re, datetime, pathlib, urllib.parse, json, time
 try:    from pysqlite2 import dbapi2 as sql # type: ignore[reportMissingImports] #@UnresolvedImport,@UnusedImport
 except ImportError: from sqlite3   import dbapi2 as sql #@Reimport
 import dropbox, dropbox.files
-from typing import Callable, Optional
+from typing import Callable, Dict, List, Optional
 
 # see Python 3.12 documentation for recipes to replace deprecated default adapters and converterrs
 # these are compatible with Python <= 3.11
@@ -49,6 +49,7 @@ class LocalMetadata(object):
     self.kwargs = kwargs
     self.syncts = None
     self.modts  = None
+    self.fingerprint: Optional[tuple] = None # (size, mtime_ns, inode) of the local file, when it matched content_hash
     if dbxmeta is not None:
       for attr in self.COPY_ATTR:
         val = getattr(dbxmeta, attr, None)
@@ -59,33 +60,31 @@ class LocalMetadata(object):
       if not hasattr(self, attr): setattr(self, attr, val)
 
   def save(self, ts: Optional[datetime.datetime]=datetime.datetime.now(datetime.timezone.utc)):
-    if ts is not None:     self.syncts = ts
-    if self.modts is None: self.modts  = self.syncts
-
-    prev = self.db.get(self.key)
-    if prev is not None:
-      if prev != self: self.modts = self.syncts
-      else:            self.modts = prev.modts if prev.modts is not None else self.modts
-
-    cur = self.db.cursor()
-    cur.execute("insert or replace into meta values(?,?,?,?,?,?,?,?,?,?,?,?)",
-                (self.key,         self.type,
-                 self.name,        self.id,
-                 self.size,        self.path_display,
-                 self.parent.key if self.parent else "",
-                 self.rev,
-                 self.client_modified,
-                 self.server_modified,
-                 self.modts,
-                 self.syncts))
-    cur.close()
+    rec = self.record()
+    self.db.save_many([ rec ], ts)
+    self.syncts, self.modts = rec.sync_ts, rec.mod_ts
+
+  def record(self):
+    local_size, local_mtime, local_inode = self.fingerprint or (None, None, None)
+    return MetaRecord(self.key,         self.type,
+                      self.name,        self.id,
+                      self.size,        self.path_display,
+                      self.parent.key if self.parent else "",
+                      self.rev,
+                      self.client_modified,
+                      self.server_modified,
+                      self.modts,
+                      self.syncts,
+                      getattr(self, "content_hash", None),
+                      local_size, local_mtime, local_inode)
 
   def remove(self, children=False):
+    if children and hasattr(self, "children"):
+      self.db.remove_subtree(self.path_lower)
+      return
     cur = self.db.db.cursor()
     cur.execute("delete from meta where key = ?", (self.path_lower,))
     cur.close()
-    if children and hasattr(self, "children"):
-      for c in self.children(): c.remove(children=True)
 
   @classproperty
   def type(cls): return cls.__name__ #@NoSelf # type: ignore[attributeAccessIssue] # I don't know, why they're all complaining...
@@ -107,7 +106,7 @@ class LocalMetadata(object):
 
 class LocalFileMeta(LocalMetadata, dropbox.files.FileMetadata):
   COPY_ATTR = LocalMetadata.COPY_ATTR +\
-              [ "id", "client_modified", "server_modified", "size", "rev" ]
+              [ "id", "client_modified", "server_modified", "size", "rev", "content_hash" ]
 
   def __init__(self, db, dbxmeta=None, parent=None, *args, **kwargs):
     LocalMetadata.__init__(self, db, dbxmeta, parent, **kwargs)
@@ -134,7 +133,112 @@ class LocalDeletedMeta(dropbox.files.DeletedMetadata, LocalMetadata):
     self.id = id
 
 
+class MetaRecord(object):
+  """
+  A row of the meta table. Much smaller and faster to create than the LocalMetadata classes, which
+  are based on the dropbox SDK types. Used for the working set of a sync, see DbxMetaDB.records().
+  """
+  __slots__ = FIELDS = ( "key", "type", "name", "id", "size", "path", "parent", "rev",
+                         "client_ts", "server_ts", "mod_ts", "sync_ts",
+                         "content_hash", "local_size", "local_mtime", "local_inode" )
+  # a change of these fields updates mod_ts
+  CMP_FIELDS = ( "key", "type", "name", "id", "size", "path", "rev", "client_ts", "server_ts", "content_hash" )
+
+  def __init__(self, key, type, name, id=None, size=None, path=None, parent="", rev=None,  # @ReservedAssignment
+               client_ts=None, server_ts=None, mod_ts=None, sync_ts=None,
+               content_hash=None, local_size=None, local_mtime=None, local_inode=None):
+    self.key, self.type, self.name, self.id = key, type, name, id
+    self.size, self.path, self.parent, self.rev = size, path, parent, rev
+    self.client_ts, self.server_ts, self.mod_ts, self.sync_ts = client_ts, server_ts, mod_ts, sync_ts
+    self.content_hash, self.local_size, self.local_mtime, self.local_inode = content_hash, local_size, local_mtime, local_inode
+
+  @classmethod
+  def from_dbx(cls, meta, parent="", fingerprint=None):
+    """ convert dropbox SDK metadata """
+    local_size, local_mtime, local_inode = fingerprint or (None, None, None)
+    if isinstance(meta, dropbox.files.FileMetadata):
+      return cls(meta.path_lower, "LocalFileMeta", meta.name, meta.id, meta.size, meta.path_display, parent, meta.rev,
+                 meta.client_modified, meta.server_modified, None, None,
+                 meta.content_hash, local_size, local_mtime, local_inode)
+    if isinstance(meta, dropbox.files.FolderMetadata):
+      return cls(meta.path_lower, "LocalFolderMeta", meta.name, meta.id, path=meta.path_display, parent=parent)
+    return cls(meta.path_lower, "LocalDeletedMeta", meta.name, path=meta.path_display, parent=parent)
+
+  @property
+  def fingerprint(self):
+    return (self.local_size, self.local_mtime, self.local_inode) if self.local_size is not None else None
+
+  def values(self):
+    return tuple(getattr(self, field) for field in self.FIELDS)
+
+  def same(self, rhs):
+    return all(getattr(self, field) == getattr(rhs, field) for field in self.CMP_FIELDS)
+
+  def __repr__(self):
+    return f"<MetaRecord{self.values()}>"
+
+
+class MetaBatch(object):
+  """
+  Collects the entries of a folder, which are then written at once by DbxMetaDB.save_many().
+  The stored entries for 'keys' (and 'ids') are loaded with a single query.
+  """
+  def __init__(self, db, keys=(), limit=1000, ids=()):
+    self.db     = db
+    self.limit  = limit
+    self.records: List[MetaRecord] = []
+    self.known: Dict[str, Optional[MetaRecord]] = { key: None for key in keys }
+    found = db.find_records(keys, ids)
+    self.known.update((key, rec) for key, rec in found.items() if key in self.known)
+    self.ids: Dict[str, MetaRecord] = { rec.id: rec for rec in found.values() if rec.id is not None }
+
+  def get(self, key):
+    return self.known.get(key)
+
+  def add(self, rec, ts=None):
+    if ts is not None: rec.sync_ts = ts
+    self.records += [ rec ]
+    if len(self.records) >= self.limit: self.flush()
+
+  def flush(self):
+    if not self.records: return
+    self.db.save_many(self.records, prev=self.known)
+    self.records = []
+
+
 class DbxMetaDB(object):
+  INSERT_META = "insert or replace into meta ({0}) values({1})".format(", ".join(MetaRecord.FIELDS), ",".join("?" * len(MetaRecord.FIELDS)))
+  SELECT_META = "select {0} from meta".format(", ".join(MetaRecord.FIELDS))
+  MAX_PARAMS  = 500 # per query, older sqlite versions allow 999 at most
+
+  # schema migrations, applied in order by init_db(); the number is the resulting "pragma user_version".
+  # 0 is the schema of dropsync <= 0.2.x, "add column" of an already existing column is skipped.
+  MIGRATIONS = [
+    (1, [ "alter table meta add column content_hash text",
+          "alter table meta add column local_size integer",
+          "alter table meta add column local_mtime integer",
+          "alter table meta add column local_inode integer",
+          "create index if not exists meta_parent on meta (parent)" ]),
+    (2, [ "create index if not exists meta_content_hash on meta (content_hash)" ]),
+    (3, [ "create index if not exists meta_id on meta (id)" ]),
+  ]
+
+  # performance profiles, applied by init_db(). WAL allows readers (e.g. a status tool) while a sync is writing,
+  # but persists in the file and needs shared memory, so it doesn't work on network filesystems (e.g. shards on other hosts).
+  # safe leaves the journal mode alone: switching back from WAL fails while another process has the file open
+  PROFILES = {
+    "safe": { "synchronous": "full" },
+    "fast": { "journal_mode": "wal", "synchronous": "normal", # only the last transactions may be lost on power failure
+              "mmap_size": 256 * 1024 * 1024, "cache_size": -64 * 1024, "temp_store": "memory" },
+  }
+
+  # the entry 'key' and all entries below it, use as prefix of a select or delete statement
+  SUBTREE = """with recursive subtree(key) as (
+                 select :subtree
+                 union all
+                 select meta.key from meta join subtree on meta.parent = subtree.key
+               )"""
+
   DBX_META_MAP = {
     dropbox.files.FileMetadata:    LocalFileMeta,
     "LocalFileMeta":               LocalFileMeta,
@@ -155,18 +259,34 @@ class DbxMetaDB(object):
     def __repr__(self):
       return f"<DbxMetaDB.Row({str(self)})>"
 
-  def __init__(self, path, dbname=".~dbxmeta.py.db3", login=None, reset=False):
+  def __init__(self, path, dbname=".~dbxmeta.py.db3", login=None, reset=False, checkpoint=0, checkpoint_interval=0, profile="safe"):
     self.path     = path
     self.dbname   = dbname 
+    self.profile  = profile
     self.db: sql.Connection
     self._token   = False
     self._refresh = False
+    self.checkpoint_entries  = checkpoint          # commit after this many entries...
+    self.checkpoint_interval = checkpoint_interval # ...or seconds. 0: only on close()
+    self._uncommitted = 0
+    self._committed   = time.monotonic()
 
     self.init_db(login=login, reset=reset)
 
   def __del__(self):
     self.close()
 
+  def migrate(self, cur):
+    version = cur.execute("pragma user_version").fetchone()[0]
+    columns = [ row["name"] for row in cur.execute("pragma table_info(meta)").fetchall() ]
+    for target, statements in self.MIGRATIONS:
+      if version >= target: continue
+      for stmt in statements:
+        m = re.match(r"alter table meta add column (\w+)", stmt)
+        if m and m.group(1) in columns: continue # databases of development versions
+        cur.execute(stmt)
+      cur.execute(f"pragma user_version = {target}")
+
   def create_meta(self, dbxmeta=None, parent=None, type: type[LocalMetadata]=LocalFileMeta, *args, **kwargs):  # @ReservedAssignment
     type        = self.DBX_META_MAP[type] if isinstance(type, str) else type # type:ignore # @ReservedAssignment # NOSONAR(S5806) 
     MetaFactory = self.DBX_META_MAP[dbxmeta.__class__] if dbxmeta is not None else type
@@ -199,37 +319,89 @@ class DbxMetaDB(object):
     if self._refresh is False: self.token
     return self._refresh
 
-  def find(self, cond=None, param=None):
-    result = []
+  def records(self, cond=None, param=None):
     cur = self.db.cursor()
+    cur.row_factory = None # plain tuples are faster
     cond  = "where " + cond if cond else ""
     if param is not None:
       param = param if isinstance(param, (tuple,list,dict)) else (param,)
     else:
       param = []
-    cur.execute("select * from meta {0}".format(cond), param)
-    for row in cur.fetchall():
-      res = self.create_meta(type=row["type"], name=row["name"], id=row["id"],
-                             path_lower=row["key"], path_display=row["path"])
-      if row["client_ts"] is not None:
-        res.client_modified = row["client_ts"]
-      if row["server_ts"] is not None:
-        res.server_modified = row["server_ts"]
-      if row["size"] is not None:
-        res.size = row["size"]
-      if row["rev"] is not None:
-        res.rev = row["rev"]
-      res.syncts = row["sync_ts"]
-      res.modts  = row["mod_ts"]
-      result += [ res ]
+    cur.execute("{0} {1}".format(self.SELECT_META, cond), param)
+    result = [ MetaRecord(*row) for row in cur.fetchall() ]
     cur.close()
     return result
 
+  def find(self, cond=None, param=None):
+    return [ self.from_record(rec) for rec in self.records(cond, param) ]
+
+  def from_record(self, rec):
+    """ convert to the LocalMetadata classes (and therefore dropbox SDK types) """
+    res = self.create_meta(type=rec.type, name=rec.name, id=rec.id,
+                           path_lower=rec.key, path_display=rec.path)
+    if rec.client_ts is not None:
+      res.client_modified = rec.client_ts
+    if rec.server_ts is not None:
+      res.server_modified = rec.server_ts
+    if rec.size is not None:
+      res.size = rec.size
+    if rec.rev is not None:
+      res.rev = rec.rev
+    if rec.content_hash is not None:
+      res.content_hash = rec.content_hash
+    res.fingerprint = rec.fingerprint
+    res.syncts = rec.sync_ts
+    res.modts  = rec.mod_ts
+    return res
+
   def get(self, key):
     res = self.find("key = ?", key)
     assert len(res) <= 1, "Too many results"
     return res[0] if len(res) > 0 else None
 
+  def find_records(self, keys, ids=()):
+    """ records by key and by dropbox id (e.g. of moved entries), queried in chunks """
+    result = {}
+    keys, ids = list(keys), list(ids)
+    step = self.MAX_PARAMS // 2 if ids else self.MAX_PARAMS
+    for pos in range(0, max(len(keys), len(ids)), step):
+      kchunk, ichunk = keys[pos:pos+step], ids[pos:pos+step]
+      cond = "key in ({0})".format(",".join("?" * len(kchunk)))
+      if ichunk: cond += " or id in ({0})".format(",".join("?" * len(ichunk)))
+      for rec in self.records(cond, kchunk + ichunk):
+        result[rec.key] = rec
+    return result
+
+  def find_content(self, content_hash):
+    """ records of synced local files with this content hash """
+    return self.records("content_hash = ? and local_size is not null", content_hash)
+
+  def batch(self, keys=(), limit=1000, ids=()):
+    return MetaBatch(self, keys, limit, ids)
+
+  def save_many(self, records, ts=None, prev=None):
+    """
+    Insert or replace many entries (MetaRecord or LocalMetadata) at once. The stored entries, which are
+    not already in 'prev', are loaded with a single query and all rows are written with executemany().
+    """
+    records = [ rec if isinstance(rec, MetaRecord) else rec.record() for rec in records ]
+    prev    = prev if prev is not None else {}
+    missing = [ rec.key for rec in records if rec.key not in prev ]
+    loaded  = self.find_records(missing) if missing else {}
+
+    for rec in records:
+      if ts is not None:      rec.sync_ts = ts
+      if rec.mod_ts is None:  rec.mod_ts  = rec.sync_ts
+      old = prev.get(rec.key) or loaded.get(rec.key)
+      if old is not None:
+        if not rec.same(old): rec.mod_ts = rec.sync_ts
+        else:                 rec.mod_ts = old.mod_ts if old.mod_ts is not None else rec.mod_ts
+
+    cur = self.db.cursor()
+    cur.executemany(self.INSERT_META, [ rec.values() for rec in records ])
+    cur.close()
+    self.checkpoint(len(records))
+
   def remove(self, cond, param=None):
     cur = self.db.cursor()
     cond  = "where " + cond if cond else ""
@@ -240,18 +412,154 @@ class DbxMetaDB(object):
     cur.execute("delete from meta {0}".format(cond), param)
     cur.close()
 
-  def init_db(self, reset=False, login=None):
-    if not os.path.isdir(self.path): os.makedirs(self.path)
+  def subtree(self, key):
+    """ records of 'key' and all entries below it, in a single recursive query """
+    cur = self.db.cursor()
+    cur.row_factory = None
+    cur.execute("{0} {1} where key in (select key from subtree)".format(self.SUBTREE, self.SELECT_META), { "subtree": key })
+    result = [ MetaRecord(*row) for row in cur.fetchall() ]
+    cur.close()
+    return result
+
+  def remove_subtree(self, key):
+    """ delete 'key' and all entries below it, in a single recursive statement """
+    before = self.db.total_changes # rowcount isn't set for statements starting with "with"
+    cur = self.db.cursor()
+    cur.execute("{0} delete from meta where key in (select key from subtree)".format(self.SUBTREE), { "subtree": key })
+    cur.close()
+    return self.db.total_changes - before
+
+  def move_subtree(self, key, new, parent, name, path):
+    """ rekey 'key' and all entries below it to 'new' (a moved or renamed entry), in a single statement """
+    self.remove_subtree(new) # outdated entries
+    cur = self.db.cursor()
+    cur.execute("""{0} update meta set
+                     key    = :new  || substr(key, length(:subtree) + 1),
+                     path   = :path || substr(path, length((select path from meta where key = :subtree)) + 1),
+                     parent = case when key = :subtree then :parent else :new || substr(parent, length(:subtree) + 1) end,
+                     name   = case when key = :subtree then :name   else name end
+                   where key in (select key from subtree)""".format(self.SUBTREE),
+                { "subtree": key, "new": new, "parent": parent, "name": name, "path": path })
+    cur.close()
+
+  def get_state(self, key, default=None):
+    row = self.db.execute("select value from state where key = ?", (key,)).fetchone()
+    return row["value"] if row is not None else default
+
+  def set_state(self, key, value):
+    if value is None:
+      self.db.execute("delete from state where key = ?", (key,))
+    else:
+      self.db.execute("insert or replace into state values(?,?)", (key, value))
+
+  def commit(self):
+    self.db.commit()
+    self._uncommitted = 0
+    self._committed   = time.monotonic()
+
+  def pragmas(self):
+    """ the effective settings of the performance profile """
+    return { pragma: self.db.execute(f"pragma {pragma}").fetchone()[0] for pragma in self.PROFILES["fast"] }
+
+  def checkpoint(self, count=1):
+    """ commit, if enough entries have been written or enough time has passed since the last commit """
+    self._uncommitted += count
+    if (self.checkpoint_entries  and self._uncommitted >= self.checkpoint_entries) or \
+       (self.checkpoint_interval and time.monotonic() - self._committed >= self.checkpoint_interval):
+      self.commit()
+
+  def journal_start(self, run, options):
+    """ start a run, or resume an aborted one with the same options.
+        Returns the keys of the folders, which have been completed already.
+    """
+    stored = json.loads(self.get_state("journal", "null"))
+    if stored is not None and stored["run"] == run and stored["options"] == options:
+      return set(row["key"] for row in self.db.execute("select key from journal"))
+    self.db.execute("delete from journal")
+    self.set_state("journal", json.dumps({ "run": run, "options": options }))
+    self.commit()
+    return set()
+
+  def journal_done(self, key):
+    self.db.execute("insert or replace into journal values(?,?)", (key, datetime.datetime.now()))
+    self.checkpoint()
+
+  def journal_finish(self):
+    self.db.execute("delete from journal")
+    self.set_state("journal", None)
+
+  def journal_local(self, paths):
+    """ record changed local paths (relative to the local folder), see dbxinotify """
+    self.db.executemany("insert or replace into local_journal (path) values (?)", [ (path,) for path in paths ])
+
+  def local_changes(self):
+    """ (sequence number, paths) of the recorded local changes. Pass the number to local_changes_done() """
+    rows = self.db.execute("select seq, path from local_journal order by seq").fetchall()
+    return (rows[-1]["seq"] if rows else 0), sorted(set(row["path"] for row in rows))
+
+  def local_changes_done(self, seq):
+    self.db.execute("delete from local_journal where seq <= ?", (seq,))
+
+  def uri(self, dbname):
+    """ the URI of the metadata file 'dbname' in this folder """
     # HACK ALERT: separate sqlite URI-parameters from filename
-    p = urllib.parse.urlparse(self.dbname)
+    p = urllib.parse.urlparse(dbname)
     dburi = pathlib.Path(os.path.join(self.path, p.path)).resolve().as_uri()
     if p.query: dburi += f"?{p.query}"
-    self.db = sql.connect(dburi, uri=True,
+    return dburi
+
+  def attach(self, dbname):
+    """ attach the metadata file 'dbname' in this folder as schema "other", until detach() """
+    self.db.commit()
+    self.db.execute("attach database ? as other", (self.uri(dbname),))
+
+  def detach(self):
+    self.db.commit()
+    self.db.execute("detach database other")
+
+  def copy_login(self, dbname):
+    """ replace the login by the one of another metadata file, e.g. by the main one for a shard """
+    self.attach(dbname)
+    try:
+      self.db.execute("delete from login")
+      self.db.execute("insert into login select * from other.login")
+    finally:
+      self.detach()
+    self._token = self._refresh = False
+
+  def merge(self, dbname, owned, complete=None):
+    """
+    replace the records, for which owned(key) is true, by those of another metadata file, e.g. of a shard.
+    With 'complete': only if the other file has this state (e.g. set by a finished sync), which is removed then. Returns True, if merged
+    """
+    fields = ", ".join(MetaRecord.FIELDS)
+    self.db.create_function("owned", 1, owned)
+    self.attach(dbname)
+    try:
+      if complete is not None:
+        if self.db.execute("select value from other.state where key = ?", (complete,)).fetchone() is None:
+          return False
+        self.db.execute("delete from other.state where key = ?", (complete,)) # merged, not to be merged again over newer records
+      self.db.execute("delete from meta where owned(key)")
+      self.db.execute(f"insert or replace into meta ({fields}) select {fields} from other.meta where owned(key)")
+      return True
+    finally:
+      self.detach()
+
+  def init_db(self, reset=False, login=None):
+    if not os.path.isdir(self.path): os.makedirs(self.path)
+    self.db = sql.connect(self.uri(self.dbname), uri=True,
                           detect_types=sql.PARSE_DECLTYPES)
     self.db.row_factory = self.Row
     cur = self.db.cursor()
+    for pragma, value in self.PROFILES[self.profile].items():
+      cur.execute(f"pragma {pragma} = {value}")
     if reset:
       cur.execute("""drop table if exists meta""")
+      cur.execute("""drop table if exists state""") # cursors are useless without metadata
+      cur.execute("""drop table if exists journal""")
+      cur.execute("""drop table if exists local_journal""")
+      cur.execute("""pragma user_version = 0""")
       cur.execute("""vacuum""")
     cur.execute("""create table if not exists meta (
       key        text not null primary key,
@@ -267,6 +575,19 @@ class DbxMetaDB(object):
       mod_ts     timestamp,
       sync_ts    timestamp
     )""")
+    self.migrate(cur)
+    cur.execute("""create table if not exists state (
+      key        text not null primary key,
+      value      text
+    )""")
+    cur.execute("""create table if not exists journal (
+      key        text not null primary key,
+      done       timestamp
+    )""")
+    cur.execute("""create table if not exists local_journal (
+      seq        integer primary key autoincrement,
+      path       text not null unique
+    )""")
     cur.execute("""create table if not exists login (
       token         text,
       expires       timestamp,
@@ -296,6 +617,6 @@ class DbxMetaDB(object):
 
   def close(self, commit=True):
     if not self.db: return
-    self.db.commit() if commit else self.db.rollback()
+    self.commit() if commit else self.db.rollback()
     self.db.close()
     self.db = None
\ No newline at end of file
@@ -1,7 +1,7 @@
 #!/usr/bin/python3
-import sys, os, argparse, re, shutil, stat, mmap, datetime, contextlib
-import dropbox, dropbox.oauth, dropbox.files
-from . import dropbox_content_hasher, dbxmeta, dbxutil
+import sys, os, argparse, re, shutil, stat, datetime, json, posixpath, time, subprocess
+import dropbox, dropbox.oauth, dropbox.files, dropbox.exceptions
+from . import dropbox_content_hasher, dbxmeta, dbxutil, dbxtransfer, dbxretry, dbxplan
 
 
 # OAuth2 access. (App: "dbxmirror-tj")
@@ -27,100 +27,230 @@ def isdeleted(meta):
   return isinstance(meta, dropbox.files.DeletedMetadata)
 
 def excluded(args, meta):
-  exclude = False
-  for patt in args.excl_patt:
-    if patt.match(meta.path_display):
-      exclude = True
-      break
-
-  if exclude:
-    for patt in args.incl_patt:
-      if patt.match(meta.path_display):
-        exclude = False
-        break
-  return exclude
+  return excluded_path(args, meta.path_display)
+
+def excluded_path(args, path):
+  return args.matcher.excluded(path)
+
+def excluded_tree(args, meta):
+  # a recursive listing also returns entries below excluded folders, so check all ancestors, too
+  return args.matcher.excluded_tree(meta.path_display)
 
 def keep(args, path):
-  keep = False
-  for patt in args.keep_patt:
-    if patt.match(path):
-      keep = True
-      break
-  return keep
+  return args.matcher.kept(path)
 
 def dbx_list(args, dbx, folder):
-  folders, files, deleted = [], [], []
+  return dbx_split(args, dbx_list_entries(dbx, folder))
+
+def dbx_list_entries(dbx, folder):
+  # may run in a worker thread, so no logging here
+  entries = []
   res = dbx.files_list_folder(dbx_path(folder), recursive=False, include_deleted=True)
   add = True
   while add:
-    for e in res.entries:
-      if not excluded(args, e):
-        coll = files if isfile(e) else (folders if isfolder(e) else deleted)
-        coll += [ e ]
-      elif args.verbose >= 2:
-        log(args, 2, "Excluded: {0}".format(e.path_display))
-
+    entries += res.entries
     add = res.has_more
 
     if add:
       res = dbx.files_list_folder_continue(res.cursor)
+  return entries
+
+def dbx_split(args, entries):
+  folders, files, deleted = [], [], []
+  for e in entries:
+    if not excluded(args, e):
+      coll = files if isfile(e) else (folders if isfolder(e) else deleted)
+      coll += [ e ]
+    elif args.verbose >= 2:
+      log(args, 2, "Excluded: {0}".format(e.path_display))
 
   sort_key = lambda meta: meta.path_lower
   return sorted(folders, key=sort_key), sorted(files, key=sort_key), sorted(deleted, key=sort_key)
 
+def dbx_delta(args, dbx, cursor):
+  entries = []
+  add = True
+  while add:
+    res = dbx.files_list_folder_continue(cursor)
+    entries += res.entries
+    cursor, add = res.cursor, res.has_more
+  return entries, cursor
+
 def remove_readonly(func, path, _):
     "Clear the readonly bit and reattempt the removal"
     os.chmod(path, stat.S_IWRITE)
     func(path)
 
-def download(args, dbx, meta, loc):
+def fingerprint(st):
+  # st_ino may exceed sqlite's signed 64-bit integers
+  ino = st.st_ino - (1 << 64) if st.st_ino >= (1 << 63) else st.st_ino
+  return (st.st_size, st.st_mtime_ns, ino)
+
+def download(args, dbx, meta, loc, done=None, cached=None, metadb=None, zipped=None, local_hash=None):
   dutc = meta.client_modified.replace(tzinfo=datetime.timezone.utc)
   dts  = dutc.timestamp()
   dl   = True
 
-  if os.path.isfile(loc):
-    hasher = dropbox_content_hasher.DropboxContentHasher()
-    with open(loc, "rb") as f:
-      try:
-        with contextlib.closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as mm:
-          hasher.update(mm[:])
-      except ValueError: # Windows cannot mmap empty files
-          hasher.update(b"")
-    fhash = hasher.hexdigest()
+  present = loc
+  if args.dry_run and not os.path.lexists(loc):
+    src = unmoved(args, meta) # where it is, until the planned moves are applied
+    if src is not None:
+      present = src[1]
+      cached  = metadb.find_records([ src[0] ]).get(src[0]) if metadb is not None else None
+  if os.path.isfile(present):
+    fhash = content_hash(args, present, cached, local_hash)
     if fhash == meta.content_hash:
       dl = False
       log(args, 3, "Identical {0}".format(loc))
     else:
-      ts = os.stat(loc).st_mtime
+      ts = os.stat(present).st_mtime
       if ts > dts and meta.symlink_info is None:
         log(args, 0, "WARNING: Overwriting newer {0}".format(loc))
     
 
   if dl:
     if meta.symlink_info is None:
-      log(args, 1, "Downloading {0}, {1}k".format(loc, int(meta.size/1024)))
+      src = local_copy(args, metadb, meta)
+      if src is not None:
+        log(args, 1, "Copying {0} from {1}, {2}k".format(loc, src[0], int(meta.size/1024)))
+      else:
+        log(args, 1, "Downloading {0}, {1}k".format(loc, int(meta.size/1024)))
       if not args.dry_run:
-        _meta = dbx.files_download_to_file(loc, meta.path_lower)
+        if zipped is not None and src is None:
+          zipped += [ (meta, loc, done) ] # see download_zipped()
+        else:
+          submit_download(args, dbx, meta, loc, done, src)
+        return
       else:
         log(args, 1, "  Dry-run DL: {0}, {1}b".format(meta.path_lower, meta.size))
+        args.plan.add("download" if src is None else "copy", loc, meta.size, meta, parent=parent_key(args, meta))
     elif not os.path.exists(loc): # TODO replace / update (or not, considering dbx symlink support :( )
       linktarget = symlink_target(args, meta)
       log(args, 1, "{2}Symlink {0}, {1}".format(loc, linktarget or meta.symlink_info.target, "Dry-Run " if args.dry_run else ""))
       if linktarget is not None:
         if not args.dry_run:
           make_symlink(args, linktarget, loc)
+        else:
+          args.plan.add("download", loc, 0, meta, parent=parent_key(args, meta))
       else:
         log(args, 0, "WARNING: symbolic link target not found: {0}".format(linktarget or meta.symlink_info.target))
     else:
       log(args, 2, f"Leaving symlink {loc} alone...")
 
+  downloaded(args, meta, loc, dl, done, verified=not dl)
+
+def content_hash(args, loc, cached=None, local_hash=None):
+  """ the content hash of the local file 'loc' """
+  if cached is not None and cached.fingerprint is not None and \
+     cached.fingerprint == fingerprint(os.stat(loc)) and cached.content_hash is not None:
+    log(args, 3, "Unchanged {0}".format(loc))
+    return cached.content_hash # unchanged since the last sync, no need to read the whole file again
+  if local_hash is not None: # e.g. hashed in an executor by aengine
+    return local_hash
+  return dropbox_content_hasher.hash_file(loc, workers=args.hash_jobs)
+
+def submit_download(args, dbx, meta, loc, done=None, src=None):
+  # metadata is written when the transfer has finished, see dbxtransfer.Transfers
+  def finished(res):
+    if not failed(args, [ (meta.path_lower, loc) ], res[1]):
+      downloaded(args, meta, loc, True, done, verified=True)
+  args.transfers.submit(args.retry.attempt, finished,
+                        transfer, dbx, meta, loc, src, args.dedup) # a failing transfer is retried as a whole
+
+def failed(args, files, exc):
+  """
+  True, if the transfer of 'files' [ (key, local path) ] has failed with 'exc' (after all retries). The sync goes on
+  without their metadata, and their folders aren't journaled as done, see complete()
+  """
+  if exc is None: return False
+  for key, loc in files:
+    log(args, -1, "ERROR: Transfer of {0} failed: {1!r}".format(loc, exc))
+    args.failed += [ key ]
+  return True
+
+def complete(args, dpath):
+  """
+  True, if no transfer within the folder 'dpath' has failed, and none of its entries waits for remove_pending().
+  Otherwise it isn't journaled as done, so an aborted sync is resumed with it
+  """
+  return not any(key.startswith(dpath + "/") for key in args.failed) and \
+         not any(posixpath.dirname(key) == dpath for key in args.removals)
+
+def zippable(args, path, entries):
+  # the archive contains the whole folder, so only for leaf folders of small files, none of them excluded. 'entries': the unfiltered listing
+  files = [ e for e in entries if not isdeleted(e) ]
+  return args.zip_min > 0 and bool(path) and len(files) < dbxtransfer.ZIP_MAX_ENTRIES and \
+         all(isfile(f) and not excluded(args, f) and f.size <= args.zip_max_size and f.symlink_info is None for f in files)
+
+def download_zipped(args, dbx, folder, pending, size):
+  """
+  download the files collected by download() as a zip archive of 'folder', if there are enough of them, and they
+  make up enough of the folder's 'size' (bytes): the archive contains the unchanged files, too
+  """
+  if len(pending) < args.zip_min or sum(meta.size for meta, _loc, _done in pending) < size * dbxtransfer.ZIP_MIN_SHARE:
+    for meta, loc, done in pending:
+      submit_download(args, dbx, meta, loc, done)
+    return
+
+  log(args, 2, "Downloading {0} files of {1} as zip archive".format(len(pending), folder))
+  def unzipped(res):
+    if failed(args, [ (meta.path_lower, loc) for meta, loc, _done in pending ], res[1]): return
+    for meta, loc, done in pending:
+      downloaded(args, meta, loc, True, done, verified=True)
+  args.transfers.submit(args.retry.attempt, unzipped, dbxtransfer.download_zip, dbx, folder, [ (meta, loc) for meta, loc, _done in pending ])
+
+def transfer(dbx, meta, loc, src=None, mode=None):
+  # runs in a worker thread, so no logging or metadata here
+  if src is not None:
+    path, rec = src
+    if mode == "hardlink" and rec.client_ts != meta.client_modified:
+      mode = "copy" # links share one timestamp, fixing either one would change the other's fingerprint
+    if dbxtransfer.clone_file(path, loc, meta.rev, mode, check=lambda st: fingerprint(st) == rec.fingerprint):
+      return meta
+    # the local copy changed since it was looked up, so download it after all
+  return dbxtransfer.download_file(dbx, meta, loc)
+
+def local_copy(args, metadb, meta):
+  """ (path, record) of an already synced local file with the same content as 'meta', or None """
+  if not args.dedup or metadb is None or meta.content_hash is None:
+    return None
+  for rec in metadb.find_content(meta.content_hash):
+    if rec.key == meta.path_lower: continue
+    src = localpath(args, relpath(args, rec.path))
+    try:
+      st = os.stat(src)
+    except OSError:
+      continue
+    if stat.S_ISREG(st.st_mode) and fingerprint(st) == rec.fingerprint: # unchanged since it was synced
+      return src, rec
+  return None
+
+def downloaded(args, meta, loc, dl, done=None, verified=False):
+  dutc = meta.client_modified.replace(tzinfo=datetime.timezone.utc)
+  dts  = dutc.timestamp()
+  fp   = None
+
   if os.path.isfile(loc):
+    if dl: args.dirindex.add(loc)
     st = os.stat(loc)
     ts = st.st_mtime
-    if ts != dts:
+    if ts != dts and not (args.dry_run and dl): # downloaded with the right one
       log(args, 2 if not dl else 3, "Adjusting timestamp {0} -> {1}".format(
            datetime.datetime.fromtimestamp(ts), dutc))
-      os.utime(loc, (dts, dts))
+      if args.dry_run:
+        args.plan.add("timestamp", loc, 0, meta, parent=parent_key(args, meta))
+      else:
+        os.utime(loc, (dts, dts))
+        st = os.stat(loc)
+    if verified and meta.symlink_info is None:
+      fp = fingerprint(st) # local content matches meta.content_hash
+
+  if done is not None: done(fp)
+
+def saver(args, batch, meta, parent):
+  def save(fingerprint=None):
+    batch.add(dbxmeta.MetaRecord.from_dbx(meta, parent, fingerprint), args.synctime if not args.dir_only else None)
+  return save
 
 
 def make_symlink(args, src, dst):
@@ -156,26 +286,92 @@ def localpath(args, child=None):
     # Dropbox itself is case-IN-sensitive, but case-AWARE. This is a problem for case-sensitive filesystems...
     # So, we check if the path already exist in another case
     parent, target = os.path.dirname(real), os.path.basename(real)
-    has = dbxutil.path_insensitive(parent)
+    has = dbxutil.path_insensitive(parent, args.dirindex)
     if has is not None: # pragma: nobranch
       real = os.path.join(has, target)
   return real
 
+def relpath(args, path):
+  return re.compile(re.escape(args.remote), re.I).sub("", path, 1).lstrip("/") # remove prefix
+
+def parent_key(args, meta):
+  parent = posixpath.dirname(meta.path_lower)
+  return "" if parent.rstrip("/") == args.remote.lower().rstrip("/") else parent
+
+def apply_moves(args, metadb, entries, known):
+  """
+  Rename local files and folders, which have been moved or renamed on dropbox (same id, other path).
+  'known' are the stored records by id. Returns the number of moved entries. A dry run plans the moves, see planned_move()
+  """
+  moved = 0
+  for e in entries:
+    if not (isfile(e) or isfolder(e)): continue
+    rec = known.get(e.id)
+    if rec is None or rec.type != ("LocalFolderMeta" if isfolder(e) else "LocalFileMeta"):
+      continue
+    key, path = planned_move(args, rec.key, rec.path)
+    if key == e.path_lower: # not moved, or with its parent
+      continue
+    if keep(args, rec.key): # not to be removed from its old path
+      continue
+    src = localpath(args, relpath(args, rec.path))
+    dst = localpath(args, relpath(args, e.path_display))
+    if not os.path.lexists(src) or os.path.lexists(dst): # already moved (with its parent), or replaced
+      continue
+    log(args, 1, "{2}Moving {0} -> {1}".format(src, dst, "Dry-run " if args.dry_run else ""))
+    if args.dry_run:
+      args.moves[rec.key] = (rec.path, e.path_lower, e.path_display)
+      args.plan.add("move", dst, 0, e, src=localpath(args, relpath(args, path)), key=key, parent=parent_key(args, e))
+      continue
+    move(args, metadb, rec.key, src, dst, e)
+    moved += 1
+  return moved
+
+def move(args, metadb, key, src, dst, meta):
+  """ rename the local 'src' to 'dst', and rekey the records of 'key' and below to the moved remote entry 'meta' """
+  if not os.path.isdir(os.path.dirname(dst)):
+    os.makedirs(os.path.dirname(dst))
+    args.dirindex.add(os.path.dirname(dst))
+  os.rename(src, dst)
+  args.dirindex.remove(src)
+  args.dirindex.add(dst)
+  metadb.move_subtree(key, meta.path_lower, parent_key(args, meta), meta.name, meta.path_display)
+
+def planned_move(args, key, path):
+  """ (key, remote path) of a stored record, after the moves planned by a dry run so far (see apply_moves()) have been applied """
+  old = max((k for k in args.moves if key == k or key.startswith(k + "/")), key=len, default=None)
+  if old is None:
+    return key, path
+  old_path, new, new_path = args.moves[old]
+  return new + key[len(old):], new_path + path[len(old_path):]
+
+def unmoved(args, meta):
+  """ (key, local path) of the stored record, which a move planned by a dry run moves to 'meta', or None """
+  old = max((k for k, (_p, new, _np) in args.moves.items() if meta.path_lower == new or meta.path_lower.startswith(new + "/")),
+            key=lambda k: len(args.moves[k][1]), default=None)
+  if old is None:
+    return None
+  old_path, new, new_path = args.moves[old]
+  return old + meta.path_lower[len(new):], localpath(args, relpath(args, old_path + meta.path_display[len(new_path):]))
+
 def sync(args, dbx, path=None, metadb=None):
   # Avoid recursive list...
   if path is None: folder = dpath = args.remote; parent = None
   else:            folder,  dpath = path.path_display, path.path_lower
-  rel = re.compile(re.escape(args.remote), re.I).sub("", folder, 1) # remove prefix
 
-  local = localpath(args, rel.lstrip("/"))
+  local = localpath(args, relpath(args, folder))
+  if path is not None and skipped(args, dpath, folder, local):
+    return
 
   log(args, 2, "Syncing {0}".format(local))
   log(args, 3, "Remote {0}".format(folder))
 
   # According to dropbox support, there's no way to just retrieve changes.
   # https://www.dropboxforum.com/t5/API-Support-Feedback/How-to-get-list-of-files-recently-modified-within-24-hours/td-p/284978
+  # Well, there is a way for a *recursive* cursor, see sync_incremental()
 
-  folders, files, deleted = dbx_list(args, dbx, dpath)
+  entries = args.listings.get(dpath) # see dbx_list(), possibly prefetched
+  folders, files, deleted = dbx_split(args, entries)
 
   if metadb is None: # pragma: nocover
     metadb = dbxmeta.DbxMetaDB(localpath(args), args.metadb)
@@ -183,56 +379,656 @@ def sync(args, dbx, path=None, metadb=None):
   else:
     meta_new = False
 
-  parent = metadb.create_meta(path) if path is not None else None
+  parent = dpath if path is not None else "" # key of the parent entry
+  batch  = prepare_folder(args, metadb, dpath, local, parent, folders, files, deleted)
+  args.listings.add([ f.path_lower for f in folders # only those to be synced, others would never be taken
+                      if not skipped(args, f.path_lower, f.path_display, localpath(args, relpath(args, f.path_display)), quiet=True) ])
+  sync_files(args, dbx, metadb, batch, dpath, local, parent, entries, files)
+
+  args.transfers.after(batch.flush) # as soon as all downloads in this folder are finished
+
+  # Recurse
+  for f in folders:
+    sync(args, dbx, f, metadb)
+
+    batch.add(dbxmeta.MetaRecord.from_dbx(f, parent), args.synctime)
+
+  def done():
+    batch.flush()
+    if path is not None and complete(args, dpath): metadb.journal_done(dpath)
+  args.transfers.after(done)
 
-  if not os.path.isdir(local):
+  if meta_new: # pragma: nocover
+    metadb.close()
+
+def skipped(args, dpath, folder, local, quiet=False):
+  """ True, if the subfolder isn't synced (now) """
+  if dpath in args.resume:
+    if not quiet: log(args, 2, "Already synced {0}".format(folder))
+    return True
+  if dpath in args.remote_removals: # removed locally, see remove_remote()
+    return True
+  return args.direction == "upload" and not os.path.isdir(local) # remote only, but kept
+
+def prepare_folder(args, metadb, dpath, local, parent, folders, files, deleted):
+  """ create the local folder, apply moves and schedule removals. Returns the MetaBatch of the folder """
+  if not os.path.isdir(local) and not args.dry_run: # planned by the parent folder
     log(args, 2, "Creating {0}".format(local))
     os.makedirs(local)
+    args.dirindex.add(local)
+
+  remote_folders = {}
+  for f in folders + files:
+    remote_folders[f.path_lower] = f
+  present = local_entries(dpath, local)
+  keys    = [ e.path_lower for e in folders + files + deleted ]
+  def lookup():
+    # in both directions, the stored records tell whether local-only entries are new or have been removed remotely
+    return keys + ([ key for key in present if key not in remote_folders ] if args.direction == "both" else [])
+
+  batch = metadb.batch(lookup(), ids=[ e.id for e in folders + files ])
+  if args.direction != "upload" and apply_moves(args, metadb, folders + files, batch.ids): # before anything is removed or downloaded
+    present = local_entries(dpath, local)
+    batch   = metadb.batch(lookup()) # with the moved entries
 
   # remove (or upload) local files and folders
-  if args.direction == "download" and not args.no_delete:
-    remote_folders = {}
-    for f in folders + files:
-      remote_folders[f.path_lower] = f
-    for key, loc in [ ("/".join([dpath, d.name.lower()]), d) for d in os.scandir(local)]:
-      if key not in remote_folders:
-        if not keep(args, key):
-          log(args, 1, "Removing {0}".format(loc.path))
-          if loc.is_dir():
-            lmeta = metadb.create_meta(name=loc.name, path_lower=key, type=dbxmeta.LocalFolderMeta)
-            shutil.rmtree(loc.path, onerror=remove_readonly) # type: ignore[reportDeprecated] # TODO: As long as it is running on Python < 3.12 :(
-          else:
-            lmeta = metadb.create_meta(name=loc.name, path_lower=key)
-            remove_readonly(os.remove, loc.path, None)
-          lmeta.remove(children=loc.is_dir())
+  uploads = []
+  for key, loc in present.items():
+    if key not in remote_folders:
+      part = dbxtransfer.part_target(loc.name)
+      if part is not None and getattr(remote_folders.get("/".join([dpath, part[0].lower()])), "rev", None) == part[1]:
+        log(args, 3, "Partial download {0}".format(loc.path)) # will be resumed
+        continue
+      if part is not None:
+        remove_part(args, loc.path, key)
+        continue
+      new = args.direction == "upload" or (args.direction == "both" and not synced(batch.get(key)))
+      if not new and args.direction == "both" and not args.no_delete and \
+         not keep(args, key) and changed_locally(args, metadb, key, loc, batch.get(key)):
+        log(args, 0, "WARNING: Changed locally, removed remotely: uploading {0} again".format(loc.path))
+        new = True
+      if new:
+        if excluded_path(args, "/".join([dpath, loc.name])):
+          log(args, 2, "Excluded: {0}".format(loc.path))
         else:
-          log(args, 2, "Keeping {0}".format(loc.path))
+          uploads += [ loc ] # new local entry, see upload_new()
+      elif args.direction == "upload" or args.no_delete:
+        continue
+      elif not keep(args, key):
+        # removed after the whole tree has been synced, it might have been moved to a folder not synced yet
+        args.removals[key] = [ loc.name, loc.path, loc.is_dir(), None ]
+      else:
+        log(args, 2, "Keeping {0}".format(loc.path))
+  if uploads: args.uploads[dpath] = uploads # see sync_files()
+
+  # remove remote files and folders removed locally
+  if args.direction != "download" and not args.no_delete:
+    for f in folders + files:
+      if f.path_lower in present: continue
+      rec = batch.get(f.path_lower)
+      if args.direction == "both" and (not synced(rec) or (isfile(f) and rec.rev != f.rev)):
+        continue # new or changed remote entry, downloaded
+      if keep(args, f.path_lower):
+        log(args, 2, "Keeping remote {0}".format(f.path_display))
+      else:
+        args.remote_removals[f.path_lower] = f # see remove_remote()
 
   if not args.no_delete:
     for dlt in deleted:
       loc = os.path.join(local, dlt.name)
-      if os.path.exists(loc): # pragma: nocover # probably never reached because it was removed a few lines above
+      if dlt.path_lower in args.removals: # stored when it has been removed
+        args.removals[dlt.path_lower][3] = dbxmeta.MetaRecord.from_dbx(dlt, parent)
+      elif os.path.exists(loc): # pragma: nocover # probably never reached because it was scheduled for removal a few lines above
         log(args, 1, "DELETED (ign.): {0}".format(loc))
       else:
-        metadb.create_meta(dlt, parent=parent).save(args.synctime)
-
-
+        batch.add(dbxmeta.MetaRecord.from_dbx(dlt, parent), args.synctime)
+
+  if args.dry_run and args.direction != "upload": # otherwise created when the subfolder is synced
+    for f in folders:
+      loc = localpath(args, relpath(args, f.path_display))
+      src = unmoved(args, f)
+      if not os.path.isdir(loc) and f.path_lower not in args.remote_removals and not (src is not None and os.path.isdir(src[1])):
+        log(args, 2, "Creating {0}".format(loc))
+        args.plan.add("mkdir", loc, 0, f, parent=parent)
+
+  return batch
+
+def remove_part(args, path, key):
+  """ remove an outdated partial download (see dbxtransfer.partpath()). Regardless of --no-delete, it has never been synced """
+  log(args, 2, "{1}Removing outdated partial download {0}".format(path, "Dry-run " if args.dry_run else ""))
+  if args.dry_run:
+    args.plan.add("remove", path, key=key, name=os.path.basename(path), dir=False)
+    return
+  remove_readonly(os.remove, path, None)
+  args.dirindex.remove(path)
+
+def remove_parts(args, meta, loc):
+  """ remove the partial downloads of 'loc' of other revisions than the one of 'meta' (all, if it has been deleted), see remove_part() """
+  folder, name = os.path.split(loc)
+  rev = getattr(meta, "rev", None)
+  for names in list((args.dirindex.names(folder) or {}).values()):
+    for part in list(names):
+      target = dbxtransfer.part_target(part)
+      if target is not None and target[0] == name and target[1] != rev:
+        remove_part(args, os.path.join(folder, part), "/".join([ posixpath.dirname(meta.path_lower), part.lower() ]))
+
+def local_entries(dpath, local):
+  """ the entries of the local folder by key """
+  if not os.path.isdir(local): # not created by a dry run
+    return {}
+  return { "/".join([dpath, d.name.lower()]): d for d in os.scandir(local) }
+
+def changed_locally(args, metadb, key, loc, rec):
+  """
+  True, if the synced local entry 'loc' (os.DirEntry) has been changed since 'rec' was synced:
+  a file with other content, or a folder tree with new or changed entries. See prepare_folder()
+  """
+  if loc.is_symlink():
+    return False
+  if not loc.is_dir():
+    return content_hash(args, loc.path, rec) != rec.content_hash
+  records = { r.key: r for r in metadb.subtree(key) }
+  for path, folders, files in os.walk(loc.path):
+    sub = "/".join([ key ] + [ name.lower() for name in os.path.relpath(path, loc.path).split(os.sep) if name != "." ])
+    folders[:] = [ f for f in folders if not excluded_path(args, "/".join([ sub, f.lower() ])) ]
+    for name in folders + files:
+      entry, ekey = os.path.join(path, name), "/".join([ sub, name.lower() ])
+      if name in files and (excluded_path(args, ekey) or dbxtransfer.part_target(name) is not None or os.path.islink(entry)):
+        continue
+      rec = records.get(ekey)
+      if not synced(rec) or (name in files and content_hash(args, entry, rec) != rec.content_hash):
+        return True
+  return False
+
+def changed_remotely(args, dbx, metadb, key):
+  """ True, if the remote folder 'key' contains entries, which haven't been synced (e.g. added after it was synced). See remove_remote() """
+  records = { r.key: r for r in metadb.subtree(key) }
+  res = dbx.files_list_folder(dbx_path(key), recursive=True)
+  while True:
+    for e in res.entries:
+      if isdeleted(e) or e.path_lower == key or excluded_tree(args, e): continue
+      rec = records.get(e.path_lower)
+      if not synced(rec) or (isfile(e) and rec.rev != e.rev):
+        return True
+    if not res.has_more:
+      return False
+    res = dbx.files_list_folder_continue(res.cursor)
+
+def synced(rec):
+  """ True, if the stored record is a synced file or folder """
+  return rec is not None and rec.type != "LocalDeletedMeta"
+
+def sync_files(args, dbx, metadb, batch, dpath, local, parent, entries, files, hashes=None, created=None):
+  """
+  download or upload (or submit the transfers of) the files of a folder. 'entries': its unfiltered listing,
+  'hashes': precomputed local content hashes, 'created': remote folders created already, see create_folders()
+  """
+  zipped  = [] if zippable(args, dpath, entries) else None
+  uploads = [] # finished upload sessions, see commit_uploads()
   for f in files:
-    loc = os.path.join(local, f.name)
+    loc  = os.path.join(local, f.name)
+    save = saver(args, batch, f, parent)
+    if f.path_lower in args.remote_removals:
+      continue
 
     if not args.dir_only:
-      download(args, dbx, f, loc)
-
-    metadb.create_meta(f, parent=parent).save(args.synctime if not args.dir_only else None)
+      cached, lhash = batch.get(f.path_lower), hashes.get(f.path_lower) if hashes else None
+      if args.direction == "upload" and (f.symlink_info is not None or not os.path.isfile(loc)):
+        continue # remote only, but kept
+      if args.direction != "download" and f.symlink_info is None and os.path.isfile(loc):
+        lhash = content_hash(args, loc, cached, lhash)
+        if lhash != f.content_hash and upload_changed(args, dbx, f, loc, cached, parent, batch, uploads):
+          continue
+      download(args, dbx, f, loc, done=save, cached=cached, metadb=metadb, zipped=zipped, local_hash=lhash)
+    else:
+      save()
+  if zipped:
+    download_zipped(args, dbx, dpath, zipped, sum(f.size for f in entries if isfile(f)))
+
+  if args.direction != "download":
+    for loc in args.uploads.pop(dpath, []):
+      upload_new(args, dbx, loc, "/".join([dpath, loc.name]), parent, batch, uploads, created)
+    args.transfers.after(lambda committed: commit_uploads(args, dbx, batch, uploads, committed), finish_uploads, args, dbx, uploads)
+
+def upload_changed(args, dbx, meta, loc, cached, parent, batch, uploads):
+  """
+  upload the local file 'loc', which differs from the remote file 'meta', if the local changes win.
+  Returns False, if the remote file is to be downloaded (after all)
+  """
+  if args.direction == "upload":
+    upload(args, dbx, loc, meta.path_display, parent, batch, uploads)
+    return True
+
+  local_changed  = cached is None or cached.fingerprint != fingerprint(os.stat(loc))
+  remote_changed = cached is None or cached.rev != meta.rev
+  if not local_changed:
+    return False
+  if not remote_changed:
+    upload(args, dbx, loc, meta.path_display, parent, batch, uploads, mode=dropbox.files.WriteMode.update(meta.rev))
+    return True
+
+  # changed on both sides: keep the local file as conflicted copy, which is uploaded as new file
+  name, ext = os.path.splitext(meta.name)
+  copy = "{0} (conflicted copy {1:%Y-%m-%d}){2}".format(name, args.synctime, ext)
+  log(args, 0, "WARNING: Changed on both sides, keeping {0} as {1}".format(loc, copy))
+  if args.dry_run:
+    return True
+  os.rename(loc, os.path.join(os.path.dirname(loc), copy))
+  args.dirindex.remove(loc)
+  args.dirindex.add(os.path.join(os.path.dirname(loc), copy))
+  upload(args, dbx, os.path.join(os.path.dirname(loc), copy), posixpath.join(posixpath.dirname(meta.path_display), copy),
+         parent, batch, uploads, mode=dropbox.files.WriteMode.add)
+  return False
+
+def upload(args, dbx, loc, path, parent, batch, uploads, mode=None):
+  """ submit the upload of the local file 'loc' to the remote 'path', see commit_uploads() """
+  st = os.stat(loc)
+  log(args, 1, "Uploading {0}, {1}k".format(loc, int(st.st_size/1024)))
+  if args.dry_run:
+    log(args, 1, "  Dry-run UL: {0}, {1}b".format(path, st.st_size))
+    args.plan.add("upload", loc, st.st_size, remote=path, parent=parent, mode=dbxplan.Plan.encode_mode(mode))
+    return
+  modified = datetime.datetime.fromtimestamp(int(st.st_mtime), datetime.timezone.utc).replace(tzinfo=None) # whole seconds only
+  commit   = dropbox.files.CommitInfo(path, mode or dropbox.files.WriteMode.overwrite, autorename=args.direction == "both",
+                                      client_modified=modified, mute=True)
+  def uploaded(res):
+    if not failed(args, [ (path.lower(), loc) ], res[1]):
+      uploads.append((*res[0], loc, parent))
+  args.transfers.submit(args.retry.attempt, uploaded,
+                        dbxtransfer.upload_file, dbx, loc, commit, args.jobs)
+
+def upload_new(args, dbx, loc, path, parent, batch, uploads, created=None):
+  """ upload the local-only file or folder tree 'loc' (os.DirEntry) to the remote 'path'. 'created': see create_folders() """
+  if loc.is_symlink():
+    log(args, 2, "Not uploading symlink {0}".format(loc.path))
+  elif loc.is_file():
+    if not args.dir_only:
+      upload(args, dbx, loc.path, path, parent, batch, uploads)
+  elif loc.is_dir():
+    log(args, 1, "{1}Creating remote {0}".format(path, "Dry-run " if args.dry_run else ""))
+    if args.dry_run:
+      args.plan.add("remote_mkdir", loc.path, remote=path, parent=parent)
+      path_display, path_lower = path, path.lower()
+    else:
+      meta = (created or {}).get(path.lower()) or dbx.files_create_folder_v2(path).metadata
+      batch.add(dbxmeta.MetaRecord.from_dbx(meta, parent), args.synctime)
+      path_display, path_lower = meta.path_display, meta.path_lower
+    for child in sorted(os.scandir(loc.path), key=lambda d: d.name):
+      if excluded_path(args, "/".join([path_display, child.name])) or dbxtransfer.part_target(child.name) is not None:
+        log(args, 2, "Excluded: {0}".format(child.path))
+        continue
+      upload_new(args, dbx, child, "/".join([path_display, child.name]), path_lower, batch, uploads, created)
+
+def create_folders(args, dbx, entries, path):
+  """
+  create the remote folders of the local-only trees 'entries' [ os.DirEntry ] below the remote 'path' ahead of upload_new(),
+  e.g. in a worker thread (so no logging or metadata here). Returns { key: FolderMetadata }
+  """
+  created = {}
+  for loc in entries:
+    if loc.is_symlink() or not loc.is_dir(): continue
+    meta = dbx.files_create_folder_v2("/".join([path, loc.name])).metadata
+    created["/".join([path, loc.name]).lower()] = meta
+    children = [ child for child in os.scandir(loc.path) if not excluded_path(args, "/".join([meta.path_display, child.name])) and
+                 dbxtransfer.part_target(child.name) is None ]
+    created.update(create_folders(args, dbx, children, meta.path_display))
+  return created
+
+def finish_uploads(args, dbx, uploads):
+  # may run in a worker thread (see aengine), so no logging or metadata here. Not retried, the sessions might have been committed
+  return args.retry.attempt_once(dbxtransfer.finish_uploads, dbx, [ arg for arg, _st, _loc, _parent in uploads ]) if uploads else ([], None)
+
+def commit_uploads(args, dbx, batch, uploads, committed=None):
+  """ commit the upload sessions finished by upload() in one batch, and save their metadata. 'committed': see finish_uploads() """
+  if not uploads: return
+  committed, exc = committed or finish_uploads(args, dbx, uploads)
+  if failed(args, [ (arg.commit.path.lower(), loc) for arg, _st, loc, _parent in uploads ], exc):
+    uploads.clear() # uploaded again by the next sync
+    return
+  for (arg, st, loc, parent), meta in zip(uploads, committed):
+    if failed(args, [ (arg.commit.path.lower(), loc) ], meta if isinstance(meta, Exception) else None):
+      continue # uploaded again by the next sync
+    if meta.path_lower != arg.commit.path.lower(): # renamed by dropbox, because it has been changed remotely in the meantime
+      log(args, 0, "WARNING: Changed on both sides, uploaded {0} as {1}".format(loc, meta.path_display))
+      continue # downloaded by the next sync
+    try:
+      changed = fingerprint(os.lstat(loc)) != fingerprint(st)
+    except FileNotFoundError:
+      changed = True
+    if changed: # since it has been read: no timestamp fix or fingerprint, so the next sync uploads it again
+      log(args, 1, "Changed during upload {0}".format(loc))
+      saver(args, batch, meta, parent)()
+      continue
+    downloaded(args, meta, loc, False, saver(args, batch, meta, parent), verified=True)
+  uploads.clear()
+
+def sync_options(args):
+  """ options a stored cursor or an aborted run are valid for """
+  return { "exclude": args.exclude, "include": args.include, "dir_only": args.dir_only, "no_delete": args.no_delete }
+
+def cursor_state(args):
+  return f"cursor:{args.remote.lower()}", sync_options(args)
+
+def sync_full(args, dbx, metadb, walk=None):
+  args.resume = metadb.journal_start(args.remote.lower(), sync_options(args)) if not args.dry_run else set()
+  if args.resume:
+    log(args, 1, "Resuming aborted sync, {0} folders already done".format(len(args.resume)))
+
+  (walk or sync)(args, dbx, metadb=metadb) # see aengine.walk()
+
+  args.transfers.join()
+  remove_pending(args, metadb)
+  remove_remote(args, dbx, metadb)
+  if not args.dry_run and not args.failed: metadb.journal_finish() # otherwise resumed by the next run
+
+def remove_pending(args, metadb):
+  """ remove the local entries not found on remote, which haven't been moved by apply_moves() """
+  for key, (name, loc, isdir, deleted) in sorted(args.removals.items()):
+    if key in args.moves: # moved by the plan
+      continue
+    if args.dry_run:
+      log(args, 1, "Dry-run Removing {0}".format(loc))
+      args.plan.add("remove", loc, key=key, name=name, dir=isdir)
+      continue
+    if os.path.lexists(loc):
+      log(args, 1, "Removing {0}".format(loc))
+      if isdir:
+        shutil.rmtree(loc, onerror=remove_readonly) # type: ignore[reportDeprecated] # TODO: As long as it is running on Python < 3.12 :(
+      else:
+        remove_readonly(os.remove, loc, None)
+      args.dirindex.remove(loc)
+    metadb.create_meta(name=name, path_lower=key, type=dbxmeta.LocalFolderMeta if isdir else dbxmeta.LocalFileMeta).remove(children=isdir)
+    if deleted is not None:
+      metadb.save_many([ deleted ], args.synctime)
+  args.removals = {}
+
+def remove_remote(args, dbx, metadb):
+  """ remove the remote entries, which have been removed locally, see prepare_folder() """
+  for key, meta in sorted(args.remote_removals.items()):
+    if args.direction == "both" and isfolder(meta) and changed_remotely(args, dbx, metadb, key):
+      log(args, 0, "WARNING: Changed remotely, removed locally: keeping remote {0}".format(meta.path_display))
+      if not args.dry_run: metadb.remove_subtree(key) # downloaded as new remote folder by the next sync
+      continue
+    log(args, 1, "{1}Removing remote {0}".format(meta.path_display, "Dry-run " if args.dry_run else ""))
+    if args.dry_run:
+      args.plan.add("remote_remove", meta.path_display, meta=meta)
+      continue
+    try:
+      dbx.files_delete_v2(meta.path_lower, parent_rev=meta.rev if isfile(meta) else None) # unless changed in the meantime
+    except dropbox.exceptions.ApiError as exc:
+      if not (isinstance(exc.error, dropbox.files.DeleteError) and exc.error.is_path_lookup() and exc.error.get_path_lookup().is_not_found()):
+        log(args, 0, "WARNING: Cannot remove remote {0}: {1}".format(meta.path_display, exc.error))
+        continue
+    metadb.create_meta(name=meta.name, path_lower=key, type=dbxmeta.LocalFolderMeta if isfolder(meta) else dbxmeta.LocalFileMeta).remove(children=isfolder(meta))
+  args.remote_removals = {}
+
+def sync_incremental(args, dbx, metadb, walk=None):
+  key, options = cursor_state(args)
+  failures = len(args.failed)
+  stored = json.loads(metadb.get_state(key, "null"))
+  entries = None
+
+  if stored is None or stored["options"] != options:
+    log(args, 1, "No valid cursor for {0}, full sync".format(args.remote or "/"))
+  else:
+    try:
+      entries, cursor = dbx_delta(args, dbx, stored["cursor"])
+    except dropbox.exceptions.ApiError as exc:
+      if not (isinstance(exc.error, dropbox.files.ListFolderContinueError) and exc.error.is_reset()):
+        raise
+      log(args, 1, "Cursor for {0} has been reset, full sync".format(args.remote or "/"))
+
+  if entries is None:
+    # get the cursor *before* listing, so we don't miss changes made during the sync (or an aborted one)
+    cursor = metadb.get_state(f"{key}:pending") or \
+             dbx.files_list_folder_get_latest_cursor(dbx_path(args.remote), recursive=True, include_deleted=True).cursor
+    metadb.set_state(f"{key}:pending", cursor)
+    sync_full(args, dbx, metadb, walk)
+  else:
+    log(args, 2, "Applying {0} remote changes".format(len(entries)))
+    apply_delta(args, dbx, metadb, entries)
 
-  # Recurse
-  for f in folders:
-    sync(args, dbx, f, metadb)
+  args.transfers.join()
+  if len(args.failed) > failures: # the next run applies the same changes again
+    return
+  metadb.set_state(f"{key}:pending", None)
+  metadb.set_state(key, json.dumps({ "cursor": cursor, "options": options }))
+
+def local_journal(args, metadb):
+  """
+  (sequence number, paths) of the local changes recorded by dbxinotify, or None if they might be incomplete:
+  The watcher isn't running, has been started after the last full scan or has lost events since then
+  """
+  watcher = json.loads(metadb.get_state("local_journal", "null"))
+  scanned = metadb.get_state("local_journal:scanned")
+  if watcher is None or scanned is None or watcher["since"] > scanned or \
+     (watcher["overflow"] is not None and watcher["overflow"] >= scanned) or not dbxutil.process_alive(watcher["pid"]):
+    return None
+  return metadb.local_changes()
+
+def sync_local(args, dbx, metadb, walk=None):
+  """ upload the local changes recorded by dbxinotify. A full sync, if they might be incomplete """
+  failures = len(args.failed)
+  journal = local_journal(args, metadb)
+  if journal is None:
+    log(args, 1, "No valid local change journal for {0}, full sync".format(args.local))
+    seq, _paths = metadb.local_changes() # recorded before the scan, so they are covered by it
+    started = utcnow().isoformat()
+    sync_full(args, dbx, metadb, walk)
+  else:
+    seq, paths = journal
+    log(args, 2, "Applying {0} local changes".format(len(paths)))
+    apply_local(args, dbx, metadb, paths)
+  if len(args.failed) == failures: # otherwise uploaded again by the next run, a full scan without a complete journal
+    if journal is None: metadb.set_state("local_journal:scanned", started)
+    metadb.local_changes_done(seq)
+
+def apply_local(args, dbx, metadb, paths):
+  """ upload the changed local 'paths' (relative to the local folder), remove the remote entries of the removed ones """
+  root    = args.remote.rstrip("/")
+  remote  = { rel: "/".join([root, rel.replace(os.sep, "/")]) for rel in paths }
+  batch   = metadb.batch([ path.lower() for path in remote.values() ])
+  uploads = []
+  trees   = [] # keys of the folders uploaded or removed as a whole
+  for rel in paths:
+    path, key = remote[rel], remote[rel].lower()
+    if any(key.startswith(tree + "/") for tree in trees): continue
+    loc    = localpath(args, rel)
+    parent = posixpath.dirname(key)
+    parent = "" if parent == root.lower() else parent
+    rec    = batch.get(key)
+    if args.matcher.excluded_tree(path) or dbxtransfer.part_target(os.path.basename(loc)) is not None: # e.g. below an excluded folder
+      log(args, 2, "Excluded: {0}".format(loc))
+    elif os.path.isdir(loc) and not os.path.islink(loc):
+      if not synced(rec):
+        with os.scandir(os.path.dirname(loc)) as entries: # upload_new() takes an os.DirEntry
+          entry = next(e for e in entries if e.name == os.path.basename(loc))
+        upload_new(args, dbx, entry, path, parent, batch, uploads)
+        trees += [ key ]
+    elif os.path.isfile(loc) and not os.path.islink(loc):
+      if args.dir_only or (synced(rec) and content_hash(args, loc, rec) == rec.content_hash):
+        continue # e.g. touched or rewritten unchanged
+      upload(args, dbx, loc, path, parent, batch, uploads)
+    elif not os.path.lexists(loc) and synced(rec) and not args.no_delete:
+      if keep(args, key):
+        log(args, 2, "Keeping remote {0}".format(rec.path))
+        continue
+      meta = dropbox.files.FolderMetadata if rec.type == "LocalFolderMeta" else dropbox.files.FileMetadata
+      args.remote_removals[key] = meta(name=rec.name, path_lower=key, path_display=rec.path, **({ "rev": rec.rev } if rec.rev else {}))
+      trees += [ key ]
+  args.transfers.after(lambda committed: commit_uploads(args, dbx, batch, uploads, committed), finish_uploads, args, dbx, uploads)
+  args.transfers.after(batch.flush)
+  args.transfers.join()
+  remove_remote(args, dbx, metadb)
+
+def make_plan(args, dbx, metadb, walk=None):
+  """ the operations of a full sync, as a dry run. Nothing is changed, the metadata included """
+  dry_run, args.dry_run = args.dry_run, True
+  checkpoint, metadb.checkpoint_entries, metadb.checkpoint_interval = (metadb.checkpoint_entries, metadb.checkpoint_interval), 0, 0
+  try:
+    sync_full(args, dbx, metadb, walk)
+  finally:
+    metadb.db.rollback()
+    args.dry_run = dry_run
+    args.moves   = {}
+    metadb.checkpoint_entries, metadb.checkpoint_interval = checkpoint
+  return args.plan
+
+def apply_plan(args, dbx, metadb, plan):
+  """ apply the operations of a plan by kind, see dbxplan.OPS. The transfers run in parallel, the largest first """
+  for e in plan.sorted("move"): # before the records are looked up
+    if not os.path.lexists(e["src"]) or os.path.lexists(e["path"]):
+      log(args, 0, "WARNING: Not moving {0} -> {1}, changed since it has been planned".format(e["src"], e["path"]))
+      continue
+    log(args, 1, "Moving {0} -> {1}".format(e["src"], e["path"]))
+    move(args, metadb, e["key"], e["src"], e["path"], plan.meta(e))
+
+  keys    = [ e["meta"]["path_lower"] for e in plan.ops if "meta" in e ] + [ e["remote"].lower() for e in plan.ops if "remote" in e ]
+  batch   = metadb.batch(keys)
+  uploads = []
+  for e in plan.sorted("mkdir"):
+    if not os.path.isdir(e["path"]):
+      log(args, 2, "Creating {0}".format(e["path"]))
+      os.makedirs(e["path"])
+      args.dirindex.add(e["path"])
+    batch.add(dbxmeta.MetaRecord.from_dbx(plan.meta(e), e["parent"]), args.synctime)
+  for e in plan.sorted("remote_mkdir"):
+    log(args, 1, "Creating remote {0}".format(e["remote"]))
+    meta = dbx.files_create_folder_v2(e["remote"]).metadata
+    batch.add(dbxmeta.MetaRecord.from_dbx(meta, e["parent"]), args.synctime)
+
+  for e in plan.sorted("download", "copy"):
+    meta, loc = plan.meta(e), e["path"]
+    save = saver(args, batch, meta, e["parent"])
+    if meta.symlink_info is not None:
+      download(args, dbx, meta, loc, done=save, metadb=metadb)
+      continue
+    src = local_copy(args, metadb, meta)
+    log(args, 1, "Copying {0} from {1}, {2}k".format(loc, src[0], int(meta.size/1024)) if src is not None else
+                 "Downloading {0}, {1}k".format(loc, int(meta.size/1024)))
+    submit_download(args, dbx, meta, loc, save, src)
+  for e in plan.sorted("upload"):
+    upload(args, dbx, e["path"], e["remote"], e["parent"], batch, uploads, plan.mode(e))
+  for e in plan.sorted("timestamp"):
+    # the content may have changed since it was planned, so it is hashed again by the next sync
+    downloaded(args, plan.meta(e), e["path"], False, saver(args, batch, plan.meta(e), e["parent"]))
+  args.transfers.join()
+  commit_uploads(args, dbx, batch, uploads)
+  batch.flush()
+
+  args.removals = { e["key"]: [ e["name"], e["path"], e["dir"], None ] for e in plan.sorted("remove") }
+  remove_pending(args, metadb)
+  args.remote_removals = { meta.path_lower: meta for meta in map(plan.meta, plan.sorted("remote_remove")) }
+  remove_remote(args, dbx, metadb)
+
+def watch(args, dbx, metadb, walk=None):
+  """
+  apply the remote changes, as soon as files_list_folder_longpoll() reports them. Until interrupted.
+  Rounds failing with transient errors (see Retry.transient()) are repeated after a growing delay
+  """
+  key, _options = cursor_state(args)
+  log(args, 1, "Watching {0} for changes".format(args.remote or "/"))
+  retries = 0 # failed rounds in a row
+  try:
+    while True:
+      failures = len(args.failed)
+      aborted  = False
+      args.dirindex = dbxutil.DirIndex(args.local) # the local folders might have been changed by others since the last round
+      try:
+        stored = json.loads(metadb.get_state(key, "null"))
+        res    = None # no valid cursor: reset, or not stored by a failed round
+        if stored is not None:
+          try:
+            res = dbx.files_list_folder_longpoll(stored["cursor"], timeout=args.watch_timeout)
+          except dropbox.exceptions.ApiError as exc:
+            if not (isinstance(exc.error, dropbox.files.ListFolderLongpollError) and exc.error.is_reset()):
+              raise
+            log(args, 1, "Cursor for {0} has been reset, full sync".format(args.remote or "/"))
+            metadb.set_state(key, None)
+        if res is None or res.changes:
+          args.synctime = utcnow()
+          sync_incremental(args, dbx, metadb, walk)
+          args.transfers.join()
+          metadb.commit()
+      except Exception as exc:
+        if not args.retry.transient(exc):
+          raise
+        log(args, -1, "ERROR: Syncing {0} failed: {1!r}".format(args.remote or "/", exc))
+        args.transfers.join()
+        metadb.commit()
+        res, aborted = None, True
+
+      if aborted or len(args.failed) > failures:
+        wait = min(args.retry.cap, args.retry.base * 2 ** retries)
+        retries += 1
+        log(args, 1, "Round failed, retrying in {0:.1f}s".format(wait))
+        time.sleep(wait)
+        continue
+      retries = 0
+      if res is not None and res.backoff:
+        time.sleep(res.backoff)
+  except KeyboardInterrupt:
+    args.transfers.join()
+    log(args, 1, "Stopped watching {0}".format(args.remote or "/"))
+
+def apply_delta(args, dbx, metadb, entries):
+  root     = args.remote.lower().rstrip("/")
+  selected = []
+  for e in entries:
+    if e.path_lower == root: continue # the root folder itself
+    if excluded_tree(args, e):
+      log(args, 2, "Excluded: {0}".format(e.path_display))
+      continue
+    selected += [ e ]
+  entries = selected
+
+  # moves are applied first, so the deletes of their old paths find nothing to remove
+  keys  = [ e.path_lower for e in entries ]
+  batch = metadb.batch(keys, ids=[ e.id for e in entries if not isdeleted(e) ])
+  if apply_moves(args, metadb, entries, batch.ids):
+    batch = metadb.batch(keys)
+  for e in entries:
+    loc    = localpath(args, relpath(args, e.path_display))
+    parent = parent_key(args, e)
+
+    if isfolder(e):
+      if not os.path.isdir(loc):
+        log(args, 2, "Creating {0}".format(loc))
+        os.makedirs(loc)
+        args.dirindex.add(loc)
+      batch.add(dbxmeta.MetaRecord.from_dbx(e, parent), args.synctime)
+
+    elif isfile(e):
+      if not os.path.isdir(os.path.dirname(loc)):
+        os.makedirs(os.path.dirname(loc))
+        args.dirindex.add(os.path.dirname(loc))
+      save = saver(args, batch, e, parent)
+      remove_parts(args, e, loc) # of previous revisions
+      if not args.dir_only:
+        download(args, dbx, e, loc, done=save, cached=batch.get(e.path_lower), metadb=metadb)
+      else:
+        save()
 
-    metadb.create_meta(f, parent=parent).save(args.synctime)
+    else:
+      remove_parts(args, e, loc) # regardless of --no-delete
+      if args.no_delete:
+        continue
+      if keep(args, e.path_lower):
+        log(args, 2, "Keeping {0}".format(loc))
+        continue
+      args.transfers.join() # the path might still be downloading...
+      batch.flush()         # ...or waiting to be written
+      if os.path.lexists(loc):
+        log(args, 1, "Removing {0}".format(loc))
+        if os.path.isdir(loc) and not os.path.islink(loc):
+          shutil.rmtree(loc, onerror=remove_readonly) # type: ignore[reportDeprecated]
+        else:
+          remove_readonly(os.remove, loc, None)
+        args.dirindex.remove(loc)
+      metadb.create_meta(name=e.name, path_lower=e.path_lower, type=dbxmeta.LocalFolderMeta).remove(children=True)
+      batch.add(dbxmeta.MetaRecord.from_dbx(e, parent), args.synctime)
 
-  if meta_new: # pragma: nocover
-    metadb.close()
+  args.transfers.after(batch.flush)
 
 def set_patterns(args):
   meta = "/" + args.metadb
@@ -252,6 +1048,8 @@ def set_patterns(args):
     for src in args.keep:
       args.keep_patt += [ re.compile(sep.join([root, src.lstrip("/")]), re.I) ]
 
+  args.matcher = dbxutil.PathMatcher(args.excl_patt, args.incl_patt, args.keep_patt, root=args.remote, shard=args.shard)
+
   if args.verbose >= 3:
     for what, patterns in (("Exclude", args.excl_patt), ("Include", args.incl_patt), ("Keep", args.keep_patt)):
       for patt in patterns:
@@ -275,7 +1073,76 @@ def login(args):
   elif args.token:
     login = dropbox.oauth.OAuth2FlowNoRedirectResult(args.token, None, None, None, None, None) # mocked...
 
-  return dbxmeta.DbxMetaDB(localpath(args), args.metadb, login=login, reset=args.resetmeta)
+  metadb = dbxmeta.DbxMetaDB(localpath(args), args.metadb, login=login, reset=args.resetmeta and args.shard is None,
+                             checkpoint=args.checkpoint, checkpoint_interval=args.checkpoint_interval,
+                             profile=args.metadb_profile)
+  if args.shard is not None: # the login is shared, the metadata is not
+    metadb.close()
+    metadb = dbxmeta.DbxMetaDB(localpath(args), shard_metadb(args.metadb, args.shard), reset=args.resetmeta,
+                               checkpoint=args.checkpoint, checkpoint_interval=args.checkpoint_interval,
+                               profile=args.metadb_profile)
+    metadb.copy_login(args.metadb)
+  return metadb
+
+def shard(spec):
+  """ --shard I/N (1 <= I <= N) -> (I-1, N) """
+  index, _, count = spec.partition("/")
+  index, count = int(index), int(count)
+  if not 1 <= index <= count:
+    raise argparse.ArgumentTypeError(f"invalid shard {spec}, expected I/N with 1 <= I <= N")
+  return index - 1, count
+
+SHARD_COMPLETE = "shard:complete" # state of a shard's metadata file, set by a finished sync (not a dry run), see merge_shards()
+
+def watch_timeout(value):
+  """ --watch-timeout, in the range files_list_folder_longpoll() accepts """
+  seconds = int(value)
+  if not 30 <= seconds <= 480:
+    raise argparse.ArgumentTypeError(f"invalid timeout {value}, expected 30-480 seconds")
+  return seconds
+
+def shard_metadb(metadb, shard):
+  """ the metadata file of a shard, next to the main one (so excluded along with it) """
+  return "{0}.shard{1}of{2}".format(metadb, shard[0] + 1, shard[1])
+
+def without(argv, flags=(), options=()):
+  """
+  'argv' without the 'flags' and the 'options' with their values, e.g. to pass the rest on to the shards.
+  Options are matched exactly, with their value as next argument, or as --option=value
+  """
+  result, skip = [], False
+  for arg in argv:
+    if skip:
+      skip = False
+    elif arg in flags:
+      continue
+    elif arg in options:
+      skip = True
+    elif not any(opt.startswith("--") and arg.startswith(opt + "=") for opt in options):
+      result += [ arg ]
+  return result
+
+def run_shards(args, argv, walk=None):
+  """ run --shards processes in parallel, each one syncing its part of the tree. Returns the first failed exit code """
+  module = "dropsync.aengine" if walk is not None else "dropsync.dbxmirror"
+  argv   = without(argv, flags=("-l", "--login"), options=("--shards", "-t", "--token")) # logged in already
+  procs  = [ subprocess.Popen([ sys.executable, "-m", module ] + argv + [ f"--shard={i}/{args.shards}" ]) for i in range(1, args.shards + 1) ]
+  rcs    = [ proc.wait() for proc in procs ]
+  for i, rc in enumerate(rcs, 1):
+    log(args, 1 if rc == 0 else -1, "{0}Shard {1}/{2} finished with exit code {3}".format("" if rc == 0 else "ERROR: ", i, args.shards, rc))
+  return next((rc for rc in rcs if rc != 0), 0)
+
+def merge_shards(args, metadb, count):
+  """ replace the metadata of each shard's part of the tree by the one of its metadata file, if the shard has completed a sync since """
+  for index in range(count):
+    name = shard_metadb(args.metadb, (index, count))
+    if not os.path.isfile(os.path.join(localpath(args), name)):
+      log(args, 0, "WARNING: No metadata of shard {0}/{1}".format(index + 1, count))
+      continue
+    log(args, 1, "Merging {0}".format(name))
+    if not metadb.merge(name, lambda key, index=index: dbxutil.shard_of(key, args.remote, count) == index, complete=SHARD_COMPLETE):
+      log(args, 0, "WARNING: Shard {0}/{1} hasn't completed a sync since it was merged, not merging it".format(index + 1, count))
+  metadb.set_state(cursor_state(args)[0], None) # covers the whole tree, and the shards have their own
 
 def utcnow():
   # TODO: Existing databases have TZ-UN-aware timestamps, so for compatibility reasons... :(
@@ -287,8 +1154,8 @@ def print_version():
     from requests import __version__ as rq_version
     print(f"{sys.argv[0]} - dropsync {__version__}, using dropbox API {dropbox.__version__} with requests {rq_version}, Python {sys.version}")
 
-def main(argv=sys.argv[1:]):
-  ap = argparse.ArgumentParser()
+def argparser(prog=None):
+  ap = argparse.ArgumentParser(prog=prog)
   ap.add_argument(      "local",       default=None)
   ap.add_argument(      "remote",      default="",          nargs="?")
   ap.add_argument("-d", "--direction", default="download",  choices=["download", "upload", "both"])
@@ -300,22 +1167,58 @@ def main(argv=sys.argv[1:]):
   ap.add_argument("-l", "--login",     default=False,       action="store_true", help="Force new login")
   ap.add_argument("-t", "--token",     default=None,        help=f"Use an existing token. E.g. from https://www.dropbox.com/developers/apps/info/{APPKEY}#settings")
   ap.add_argument("-T", "--timeout",   default=120.0,       type=float, help="Timeout for remote dropbox operations")
+  ap.add_argument(      "--retries",   default=3,           type=int, help="Retry failed remote operations and transfers this many times (rate limits with a backoff always wait)")
   ap.add_argument("-m", "--metadb",    default=".~dropsync.py.db3", help="Metadata file. Always located in local folder")
+  ap.add_argument(      "--metadb-profile", default="safe", choices=sorted(dbxmeta.DbxMetaDB.PROFILES), help="SQLite settings of the metadata file")
   ap.add_argument("-R", "--resetmeta", default=False,       action="store_true")
   ap.add_argument("-Y", "--ignsymlink",default=False,       action="store_true", help="Ignore symlink errors")
   ap.add_argument("-D", "--dir-only",  default=False,       action="store_true", help="Only synchronize directory structure")
+  ap.add_argument("-I", "--incremental", default=False,     action="store_true", help="Only apply changes since the last (incremental) run. Uploads need dbxinotify")
+  ap.add_argument("-W", "--watch",     default=False,       action="store_true", help="Keep running, applying remote changes as they happen (implies --incremental)")
+  ap.add_argument(      "--watch-timeout", default=30,      type=watch_timeout, help="Seconds to wait for remote changes per request (30-480)")
+  ap.add_argument("-j", "--jobs",      default=1,           type=int, help="Number of parallel downloads")
+  ap.add_argument(      "--list-jobs", default=1,           type=int, help="Number of parallel folder listings")
+  ap.add_argument(      "--hash-jobs", default=1,           type=int, help="Number of threads hashing blocks of large local files")
+  ap.add_argument(      "--dedup",     default=None,        choices=dbxtransfer.DEDUP_MODES, help="Create files from identical, already synced local files instead of downloading them")
+  ap.add_argument(      "--zip-min",   default=0,           type=int, help="Download the files of folders with at least this many new or changed files (and half of their bytes) as one zip archive (0: never)")
+  ap.add_argument(      "--zip-max-size", default=1024*1024, type=int, help="Only use zip archives for folders with files up to this size (bytes)")
+  ap.add_argument(      "--checkpoint", default=5000,      type=int, help="Commit metadata after this many entries (0: only at the end)")
+  ap.add_argument(      "--checkpoint-interval", default=300.0, type=float, help="Commit metadata after this many seconds (0: only at the end)")
   ap.add_argument("-v", "--verbose",   default=0,           action="count", help="Specify multiple times to increase verbosity")
-  ap.add_argument(      "--dry-run",   default=False,       action="store_true", help="Do not transfer or delete any files")
+  ap.add_argument(      "--dry-run",   default=False,       action="store_true", help="Do not transfer or delete any files, print the planned operations")
+  ap.add_argument(      "--plan",      default=None,        metavar="FILE", dest="plan_file", help="Save the planned operations of a full sync to FILE (JSON), instead of applying them")
+  ap.add_argument(      "--apply-plan", default=None,       metavar="FILE", help="Apply the operations saved by --plan, without listing the remote folders")
+  ap.add_argument(      "--max-download", default=None,     type=int, help="Plan first, and don't change anything, if more than this many bytes would be downloaded")
+  ap.add_argument(      "--shard",     default=None,        type=shard, metavar="I/N", help="Only sync the I-th of N parts of the tree (by top level entry), with its own metadata file")
+  ap.add_argument(      "--shards",    default=0,           type=int, help="Sync in this many --shard processes in parallel, then --merge-shards")
+  ap.add_argument(      "--merge-shards", default=0,        type=int, metavar="N", help="Merge the metadata files of N shards into the main one")
   ap.add_argument("-V", "--version",   default=False,       action="store_true", help="Print version and exit")
   ap.add_argument(      "--synctime",  default=utcnow(),    type=lambda dt:datetime.datetime.strptime(dt,"%Y%m%d%H%M%S"), help=argparse.SUPPRESS)
-  args = ap.parse_args(argv)
+  return ap
 
-  assert args.direction == "download", "Upload is not implemented yet"
+def main(argv=sys.argv[1:], walk=None, prog=None):
+  """ 'walk' replaces sync() for full syncs, see aengine """
+  ap   = argparser(prog)
+  args = ap.parse_args(argv)
+  args.dirindex = dbxutil.DirIndex(args.local) # case-insensitive path lookups
 
   if args.version:
     print_version()
     return 0
 
+  if args.watch and args.direction != "download":
+    log(args, -1, "ERROR: --watch only applies remote changes, use --direction=download")
+    return 2
+  if args.watch and args.dry_run:
+    log(args, -1, "ERROR: --watch applies the changes, --dry-run doesn't apply")
+    return 2
+  if (args.plan_file or args.apply_plan or args.max_download is not None) and (args.incremental or args.watch):
+    log(args, -1, "ERROR: Plans are made for full syncs, --incremental and --watch don't apply")
+    return 2
+  if (args.shard is not None and (args.shards or args.merge_shards)) or ((args.shard is not None or args.shards) and args.watch):
+    log(args, -1, "ERROR: --shard runs a single shard, --shards runs all of them. --watch doesn't apply")
+    return 2
+
   if args.verbose > 2:
     import logging # activates dropbox library logging
     logging.basicConfig(level=logging.DEBUG if args.verbose > 3 else logging.INFO)
@@ -325,26 +1228,96 @@ def main(argv=sys.argv[1:]):
   if not metadb or (not metadb.token and not metadb.refresh_token):
     log(args, -1, "ERROR: Could not log in. Try {0} --login {1}".format(ap.prog, args.local))
     return 2
+  log(args, 3, "Metadata profile {0}: {1}".format(args.metadb_profile,
+      ", ".join(f"{k}={v}" for k, v in metadb.pragmas().items())))
+
+  if args.shards or args.merge_shards:
+    rc = run_shards(args, argv, walk) if args.shards else 0
+    if args.dry_run or args.plan_file: # the shards haven't changed anything, neither does the merge
+      log(args, 1, "Dry-run, not merging the metadata of the shards")
+    elif rc == 0:
+      merge_shards(args, metadb, args.shards or args.merge_shards)
+    metadb.close()
+    return rc
+
+  args.transfers = dbxtransfer.Transfers(args.jobs)
+  args.resume    = set()
+  args.removals  = {} # key -> [ name, local path, is folder, deleted record ], see remove_pending()
+  args.moves     = {} # key -> (remote path, new key, new remote path) of the moves planned by a dry run, see apply_moves()
+  args.uploads   = {} # folder key -> [ local-only os.DirEntry ], see sync_files()
+  args.remote_removals = {} # key -> remote metadata, see remove_remote()
+  args.failed    = [] # keys of the files, whose transfer has failed, see failed()
+  args.listings  = dbxtransfer.Prefetch(None) # replaced as soon as the client exists
+  args.retry     = dbxretry.Retry(args.retries, log=lambda msg: log(args, 1, msg))
+  args.plan      = dbxplan.Plan(localpath(args), args.remote, args.direction) # see make_plan()
+  rc = 0
 
   try:
-    dbx = dropbox.Dropbox(
+    dbx = dbxretry.Retrying(dropbox.Dropbox(
       oauth2_access_token=metadb.token, oauth2_refresh_token=metadb.refresh_token,
       app_key=APPKEY, app_secret=APPSECRET,
-      timeout=args.timeout)
+      max_retries_on_error=0, max_retries_on_rate_limit=0, # see dbxretry
+      timeout=args.timeout), args.retry)
+    args.listings = dbxtransfer.Prefetch(lambda folder: dbx_list_entries(dbx, folder), args.list_jobs)
 
     set_patterns(args)
+    applies = not (args.dry_run or args.plan_file)
+    if args.shard is not None and applies: # until this sync has completed
+      metadb.set_state(SHARD_COMPLETE, None)
+      metadb.commit()
+
+    if args.apply_plan:
+      plan = dbxplan.Plan.load(args.apply_plan)
+      if (plan.local, plan.remote.lower(), plan.direction) != (localpath(args), args.remote.lower(), args.direction):
+        raise ValueError(f"The plan {args.apply_plan} has been made for {plan.local} {plan.remote} --direction={plan.direction}")
+      apply_plan(args, dbx, metadb, plan)
+    elif args.plan_file or args.max_download is not None or args.dry_run: # --incremental too, the cursor stays
+      plan = make_plan(args, dbx, metadb, walk)
+      log(args, 0, plan.summary())
+      if args.plan_file: plan.save(args.plan_file)
+      downloads = plan.totals()["download"][1]
+      if args.max_download is not None and downloads > args.max_download:
+        log(args, -1, f"ERROR: {downloads} bytes to download, more than --max-download={args.max_download}")
+        rc = 3
+      elif not (args.dry_run or args.plan_file): # within the limit: the regular sync, which stores the unchanged entries, too
+        args.plan = dbxplan.Plan(localpath(args), args.remote, args.direction)
+        sync_full(args, dbx, metadb, walk)
+    elif args.incremental and args.direction == "upload":
+      sync_local(args, dbx, metadb, walk)
+    elif args.incremental and args.direction != "download":
+      log(args, 1, "Incremental sync of remote changes only, full sync for direction {0}".format(args.direction))
+      sync_full(args, dbx, metadb, walk)
+    elif args.incremental or args.watch:
+      sync_incremental(args, dbx, metadb, walk)
+    else:
+      sync_full(args, dbx, metadb, walk)
 
-    sync(args, dbx, metadb=metadb)
+    args.transfers.join()
+    if args.watch:
+      metadb.commit()
+      watch(args, dbx, metadb, walk)
   except Exception as exc:
     import traceback
     traceback.print_exc()
-    metadb.close(commit=False)
+    args.transfers.close(cancel=True)
+    args.listings.close()
+    metadb.close(commit=False) # everything up to the last checkpoint is kept
     log(args, -1, f"ERROR: Exception during processing: {exc}")
+    if args.retry.count: log(args, 1, f"Remote errors: {args.retry.summary()}")
     return getattr(exc, "code", 8)
   else:
+    args.transfers.close()
+    args.listings.close()
+    if args.failed:
+      rc = rc or 4
+    if args.shard is not None and applies and rc == 0:
+      metadb.set_state(SHARD_COMPLETE, args.synctime.isoformat())
     metadb.close()
+    if args.retry.count: log(args, 1, f"Remote errors: {args.retry.summary()}")
+    if args.failed:
+      log(args, -1, f"ERROR: {len(args.failed)} transfers failed")
 
-  return 0
+  return rc
 
 if __name__ == "__main__": # pragma: nocover
   sys.exit(main())
@@ -0,0 +1,80 @@
+"""
+Sync plans: the operations of a full sync, recorded by a dry run (see dbxmirror.make_plan())
+and applied by dbxmirror.apply_plan() without listing the remote folders again.
+"""
+import json
+import dropbox.files
+from dropbox import stone_serializers
+
+# in the order they are applied
+OPS = ( "move", "mkdir", "remote_mkdir", "download", "copy", "upload", "timestamp", "remove", "remote_remove" )
+
+
+class Plan(object):
+  """
+  Operations by kind. Each one is a dict with the local 'path', its 'size' (bytes to be transferred),
+  the remote metadata ('meta') or path ('remote') and the 'parent' key of the stored record.
+  Moves have the local source 'src' and the stored 'key' of the moved entry, too
+  """
+  VERSION = 2 # 2: moves
+
+  def __init__(self, local=None, remote=None, direction=None, ops=()):
+    self.local     = local
+    self.remote    = remote
+    self.direction = direction
+    self.ops       = list(ops)
+
+  def add(self, op, path, size=0, meta=None, **kwargs):
+    assert op in OPS, op
+    entry = { "op": op, "path": path, "size": size, **kwargs }
+    if meta is not None:
+      entry["meta"] = json.loads(stone_serializers.json_encode(dropbox.files.Metadata_validator, meta))
+    self.ops += [ entry ]
+
+  @staticmethod
+  def meta(entry):
+    return stone_serializers.json_compat_obj_decode(dropbox.files.Metadata_validator, entry["meta"])
+
+  @staticmethod
+  def mode(entry):
+    """ the dropbox.files.WriteMode of an upload """
+    return stone_serializers.json_compat_obj_decode(dropbox.files.WriteMode_validator, entry["mode"]) if entry.get("mode") else None
+
+  @staticmethod
+  def encode_mode(mode):
+    return json.loads(stone_serializers.json_encode(dropbox.files.WriteMode_validator, mode)) if mode is not None else None
+
+  def sorted(self, *ops):
+    """
+    the operations of these kinds in the order they are applied: the largest transfers first, folders before their contents.
+    Moves in the order they have been planned, their sources might have been moved before
+    """
+    selected = [ entry for entry in self.ops if entry["op"] in ops ]
+    if set(ops) & { "download", "copy", "upload" }: return sorted(selected, key=lambda e: (-e["size"], e["path"]))
+    if "move" in ops:                               return selected
+    return sorted(selected, key=lambda e: e["path"])
+
+  def totals(self):
+    """ op -> (count, bytes) """
+    totals = { op: (0, 0) for op in OPS }
+    for entry in self.ops:
+      count, size = totals[entry["op"]]
+      totals[entry["op"]] = (count + 1, size + entry["size"])
+    return totals
+
+  def summary(self):
+    lines = [ f"  {op:<14} {count:>8} {size:>16} bytes" for op, (count, size) in self.totals().items() if count ]
+    return "\n".join([ f"Plan: {len(self.ops)} operations" ] + lines)
+
+  def save(self, path):
+    with open(path, "w", encoding="utf-8") as f:
+      json.dump({ "version": self.VERSION, "local": self.local, "remote": self.remote, "direction": self.direction,
+                  "ops": self.ops }, f, indent=1)
+
+  @classmethod
+  def load(cls, path):
+    with open(path, encoding="utf-8") as f:
+      data = json.load(f)
+    if not 1 <= data.get("version", 0) <= cls.VERSION:
+      raise ValueError(f"Unsupported plan version {data.get('version')} in {path}")
+    return cls(data["local"], data["remote"], data["direction"], data["ops"])
@@ -0,0 +1,136 @@
+"""
+Retrying Dropbox API calls and transfers on transient errors.
+"""
+import random, threading, functools
+from time import sleep
+import requests.exceptions
+import dropbox.exceptions, dropbox.files
+from .dbxtransfer import ContentHashMismatch
+
+TRANSIENT = (
+  requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError,
+  ContentHashMismatch, # e.g. a truncated response
+)
+
+class Retry(object):
+  """
+  Calls functions, retrying them up to 'retries' times on transient errors.
+
+  Rate limit errors wait as long as the server asks for (RateLimitError.backoff) and don't count
+  as retry. Other transient errors, and rate limits without a backoff, wait a random time up to
+  base * 2^attempt seconds (at most 'cap').
+  Nested calls (e.g. API calls during a retried transfer) aren't retried separately, the outermost
+  call is repeated. Safe to be used by multiple threads, log() may be called from any of them.
+  """
+  def __init__(self, retries=3, base=1.0, cap=60.0, log=None):
+    self.retries     = retries
+    self.base        = base
+    self.cap         = cap
+    self.log         = log
+    self.lock        = threading.Lock()
+    self.local       = threading.local()
+    self.count       = 0   # retried calls
+    self.ratelimited = 0   # ...of those, because of rate limits
+    self.waited      = 0.0 # seconds
+
+  @staticmethod
+  def transient(exc):
+    if isinstance(exc, dropbox.exceptions.RateLimitError): return True
+    if isinstance(exc, dropbox.exceptions.HttpError):      return exc.status_code >= 500
+    return isinstance(exc, TRANSIENT)
+
+  def delay(self, exc, attempt):
+    if isinstance(exc, dropbox.exceptions.RateLimitError) and exc.backoff is not None:
+      return exc.backoff + random.uniform(0, 1) # don't return all at once
+    return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+  def call(self, fn, *args, **kwargs):
+    if getattr(self.local, "active", False):
+      return fn(*args, **kwargs)
+
+    self.local.active = True
+    try:
+      attempt = 0
+      while True:
+        try:
+          return fn(*args, **kwargs)
+        except Exception as exc:
+          ratelimit = isinstance(exc, dropbox.exceptions.RateLimitError) and exc.backoff is not None
+          if not self.transient(exc) or (attempt >= self.retries and not ratelimit):
+            raise
+          wait = self.delay(exc, attempt)
+          if not ratelimit: attempt += 1
+          with self.lock:
+            self.count += 1
+            self.ratelimited += ratelimit
+            self.waited += wait
+          if self.log is not None:
+            self.log(f"Retrying {getattr(fn, '__name__', fn)} in {wait:.1f}s: {exc!r}")
+          sleep(wait)
+    finally:
+      self.local.active = False
+
+  def once(self, fn, *args, **kwargs):
+    """ call fn() without retrying it, or the calls it makes, e.g. when a failed call might have taken effect nevertheless """
+    if getattr(self.local, "active", False):
+      return fn(*args, **kwargs)
+
+    self.local.active = True
+    try:
+      return fn(*args, **kwargs)
+    finally:
+      self.local.active = False
+
+  def attempt(self, fn, *args, **kwargs):
+    """
+    call(), but returns (result, None), or (None, exception) once the retries of a transient error are exhausted,
+    or if an API error (e.g. restricted content) makes the call fail for good
+    """
+    return self._attempt(self.call, fn, *args, **kwargs)
+
+  def attempt_once(self, fn, *args, **kwargs):
+    """ once(), but returns (result, None), or (None, exception) like attempt() """
+    return self._attempt(self.once, fn, *args, **kwargs)
+
+  def _attempt(self, call, fn, *args, **kwargs):
+    try:
+      return call(fn, *args, **kwargs), None
+    except Exception as exc:
+      if not self.transient(exc) and not isinstance(exc, dropbox.exceptions.ApiError):
+        raise
+      return None, exc
+
+  def summary(self):
+    return f"{self.count} retries ({self.ratelimited} rate limited), waited {self.waited:.1f}s"
+
+
+class Retrying(object):
+  """
+  Calls the methods of a dropbox.Dropbox client through Retry.call(). Methods, whose failed calls
+  might have taken effect nevertheless (ONCE), are called through Retry.once()
+  """
+  ONCE = { "files_upload_session_finish_batch_v2" } # the sessions might have been committed, and can't be committed again
+
+  def __init__(self, dbx, retry):
+    self.dbx   = dbx
+    self.retry = retry
+
+  def __getattr__(self, name):
+    attr = getattr(self.dbx, name)
+    if name.startswith("_") or not callable(attr):
+      return attr
+    return functools.partial(self.retry.once if name in self.ONCE else self.retry.call, attr)
+
+  def files_create_folder_v2(self, path, *args, **kwargs):
+    """ a conflicting folder after a failed attempt has been created by that attempt """
+    attempts = []
+    def files_create_folder_v2():
+      attempts.append(path)
+      try:
+        return self.dbx.files_create_folder_v2(path, *args, **kwargs)
+      except dropbox.exceptions.ApiError as exc:
+        error = exc.error
+        if len(attempts) > 1 and error.is_path() and error.get_path().is_conflict() and error.get_path().get_conflict().is_folder():
+          return dropbox.files.CreateFolderResult(self.dbx.files_get_metadata(path))
+        raise
+    return self.retry.call(files_create_folder_v2)
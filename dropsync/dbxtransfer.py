@@ -0,0 +1,324 @@
+import os, shutil, tempfile, zipfile, hashlib, contextlib, collections, concurrent.futures
+from typing import Callable, Dict, List, Optional, Tuple
+import dropbox.files
+from .dropbox_content_hasher import DropboxContentHasher, StreamHasher
+try:
+  import fcntl
+except ImportError: # pragma: linux-nocover
+  fcntl = None
+
+CHUNK_SIZE  = 1024 * 1024
+PART_PREFIX = ".~"
+PART_SUFFIX = ".dropsync-part"
+FICLONE     = 0x40049409 # _IOW(0x94, 9, int), see linux/fs.h
+DEDUP_MODES = ("copy", "reflink", "hardlink")
+ZIP_MAX_ENTRIES = 10000            # including the folder itself, see Dropbox.files_download_zip()
+ZIP_MIN_SHARE   = 0.5              # of the bytes of a folder, to be downloaded to use a zip archive (which contains all of them)
+ZIP_SPOOL_SIZE  = 64 * 1024 * 1024 # larger archives are spooled to a temporary file
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024 # a multiple of 4 MiB, as required by concurrent upload sessions
+UPLOAD_BATCH_SIZE = 1000            # entries per files_upload_session_finish_batch_v2() call
+
+class ContentHashMismatch(IOError):
+  pass
+
+class UploadFailed(IOError):
+  pass
+
+class Transfers(object):
+  """
+  Runs transfers in a bounded pool of worker threads.
+
+  Completion callbacks are always called in the thread calling submit(), after(), drain() or join(),
+  so they may safely write to the (single threaded) metadata DB.
+  With jobs=1, transfers and callbacks are simply called synchronously.
+  """
+  def __init__(self, jobs=1, backlog=None):
+    self.jobs    = max(1, jobs)
+    self.backlog = backlog if backlog is not None else 4 * self.jobs
+    self.pool    = concurrent.futures.ThreadPoolExecutor(self.jobs, thread_name_prefix="dropsync") if self.jobs > 1 else None
+    self.pending: List[Tuple[Optional[concurrent.futures.Future], Optional[Callable]]] = [] # in submission order
+
+  @property
+  def busy(self):
+    return sum(1 for fut, _done in self.pending if fut is not None)
+
+  def submit(self, fn, done=None, *args, **kwargs):
+    if self.pool is None:
+      result = fn(*args, **kwargs)
+      if done is not None: done(result)
+      return
+
+    self.pending += [ (self.pool.submit(fn, *args, **kwargs), done) ]
+    while self.busy >= self.backlog: # back pressure
+      self.drain(block=True)
+    self.drain()
+
+  def after(self, done, fn=None, *args):
+    """ call done() as soon as all transfers submitted so far are finished. With 'fn': done(fn(*args)) """
+    call = done if fn is None else lambda: done(fn(*args))
+    if not self.pending: call()
+    else:                self.pending += [ (None, call) ]
+
+  def drain(self, block=False):
+    if block:
+      futures = [ fut for fut, _done in self.pending if fut is not None ]
+      if futures: concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+
+    running = False
+    for entry in list(self.pending):
+      fut, done = entry
+      if fut is None and running: continue # wait for previous transfers
+      if fut is not None and not fut.done():
+        running = True
+        continue
+      self.pending.remove(entry)
+      if fut is None:         done()                # type: ignore[reportOptionalCall]
+      elif done is not None:  done(fut.result())    # re-raises exceptions of the transfer
+      else:                   fut.result()
+
+  def join(self):
+    while self.pending:
+      self.drain(block=True)
+
+  def close(self, cancel=False):
+    if self.pool is None: return
+    if cancel:
+      for fut, _done in self.pending:
+        if fut is not None: fut.cancel()
+      self.pending = []
+    else:
+      self.join()
+    self.pool.shutdown(wait=True)
+    self.pool = None
+
+
+class Prefetch(object):
+  """
+  Calls fn(key) for keys, which will probably be needed soon, in a bounded pool of worker threads.
+
+  get() returns the prefetched result (or calls fn() itself). At most 'limit' results are
+  prefetched at a time, further keys are queued. Keys added last are fetched first, which
+  matches the order of a depth-first walk adding the subfolders of each listed folder.
+  With jobs=1, nothing is prefetched.
+  """
+  def __init__(self, fn, jobs=1, limit=None):
+    self.fn      = fn
+    self.limit   = limit if limit is not None else 4 * max(1, jobs)
+    self.pool    = concurrent.futures.ThreadPoolExecutor(jobs, thread_name_prefix="dropsync-list") if jobs > 1 else None
+    self.pending: Dict[str, concurrent.futures.Future] = {}
+    self.queued  = collections.deque()
+    self.taken   = set() # keys fetched by get() without being prefetched, skipped when they are dequeued
+
+  def add(self, keys):
+    if self.pool is None: return
+    self.queued.extendleft(reversed(keys))
+    self.fill()
+
+  def fill(self):
+    while self.queued and len(self.pending) < self.limit:
+      key = self.queued.popleft()
+      if key not in self.taken and key not in self.pending:
+        self.pending[key] = self.pool.submit(self.fn, key) # type: ignore[reportOptionalMemberAccess]
+
+  def get(self, key):
+    fut = self.pending.pop(key, None)
+    if fut is None:
+      if self.pool is not None: self.taken.add(key)
+      result = self.fn(key)
+    else:
+      result = fut.result() # re-raises exceptions of fn()
+    self.fill()
+    return result
+
+  def close(self):
+    if self.pool is None: return
+    for fut in self.pending.values(): fut.cancel()
+    self.pending, self.queued = {}, collections.deque()
+    self.pool.shutdown(wait=True)
+    self.pool = None
+
+
+def partpath(loc, rev):
+  head, tail = os.path.split(loc)
+  return os.path.join(head, f"{PART_PREFIX}{tail}.{rev}{PART_SUFFIX}")
+
+def part_target(name):
+  """ (name, rev) of the file a partial download belongs to, or None """
+  if not (name.startswith(PART_PREFIX) and name.endswith(PART_SUFFIX)):
+    return None
+  target, _, rev = name[len(PART_PREFIX):-len(PART_SUFFIX)].rpartition(".")
+  return (target, rev) if target else None
+
+def _hash_part(f, size, hasher):
+  buf  = bytearray(CHUNK_SIZE)
+  view = memoryview(buf)
+  while size > 0:
+    n = f.readinto(view[:min(size, len(buf))])
+    if not n: break
+    hasher.update(view[:n])
+    size -= n
+
+def download_file(dbx, meta, loc):
+  """
+  Download the remote file 'meta' to 'loc', hashing the data while it is written.
+
+  The data is written to a partial file next to 'loc', which atomically replaces
+  'loc' after the content hash has been verified. If a partial file of the same
+  revision already exists, the download is resumed with an HTTP range request.
+  """
+  part   = partpath(loc, meta.rev)
+  path   = f"rev:{meta.rev}" if meta.rev else meta.path_lower # ranges only make sense for the same revision
+  offset = os.path.getsize(part) if os.path.isfile(part) else 0
+  if offset > meta.size: offset = 0
+
+  hasher = DropboxContentHasher()
+  if offset == 0 or offset < meta.size:
+    headers = { "Range": f"bytes={offset}-" } if offset > 0 else None
+    _meta, resp = dbx.files_download(path, extra_headers=headers)
+    with contextlib.closing(resp):
+      if resp.status_code != 206: offset = 0 # range not supported (or not requested), start over
+      with open(part, "r+b" if offset > 0 else "wb") as f:
+        _hash_part(f, offset, hasher)
+        f.seek(offset); f.truncate()
+        out = StreamHasher(f, hasher)
+        for chunk in resp.iter_content(CHUNK_SIZE):
+          out.write(chunk)
+  else: # complete, but not verified and renamed yet
+    with open(part, "rb") as f:
+      _hash_part(f, offset, hasher)
+
+  digest = hasher.hexdigest()
+  if meta.content_hash is not None and digest != meta.content_hash:
+    os.remove(part)
+    raise ContentHashMismatch(f"Content hash mismatch for {meta.path_lower}: {digest} != {meta.content_hash}")
+
+  os.replace(part, loc)
+  return meta
+
+def _extract(archive, info, meta, loc):
+  part   = partpath(loc, meta.rev)
+  hasher = DropboxContentHasher()
+  with archive.open(info) as src, open(part, "wb") as f:
+    shutil.copyfileobj(src, StreamHasher(f, hasher), CHUNK_SIZE)
+  if meta.content_hash is not None and hasher.hexdigest() != meta.content_hash:
+    os.remove(part)
+    return False
+  os.replace(part, loc)
+  return True
+
+def download_zip(dbx, path, files):
+  """
+  Download the files [ (meta, loc) ] of the folder 'path' with a single request, as zip archive.
+
+  Zip files can't be read as a stream, so the archive is spooled first. Each file is
+  extracted into a partial file, verified and renamed like in download_file(). Files
+  missing in the archive, or changed in the meantime, are downloaded separately.
+  """
+  wanted = { meta.name.lower(): (meta, loc) for meta, loc in files }
+  _result, resp = dbx.files_download_zip(path)
+  with contextlib.closing(resp), tempfile.SpooledTemporaryFile(ZIP_SPOOL_SIZE) as spool:
+    for chunk in resp.iter_content(CHUNK_SIZE):
+      spool.write(chunk)
+    spool.seek(0)
+    with zipfile.ZipFile(spool) as archive:
+      for info in archive.infolist():
+        _top, _, name = info.filename.partition("/") # entries are below the folder name
+        if info.is_dir() or "/" in name or name.lower() not in wanted:
+          continue
+        meta, loc = wanted[name.lower()]
+        if _extract(archive, info, meta, loc):
+          del wanted[name.lower()]
+
+  for meta, loc in wanted.values():
+    download_file(dbx, meta, loc)
+  return files
+
+def clone_file(src, loc, rev, mode="copy", check=None):
+  """
+  Create 'loc' from the identical local file 'src', instead of downloading it.
+
+  'mode' is one of DEDUP_MODES. Reflinks and hardlinks fall back to copying, if
+  the filesystem doesn't support them. check(stat) verifies, that the opened
+  source still is the synced file, otherwise nothing is done and False returned.
+  """
+  part = partpath(loc, rev)
+  with open(src, "rb") as fsrc:
+    st = os.fstat(fsrc.fileno())
+    if check is not None and not check(st):
+      return False
+    if os.path.lexists(part): os.remove(part)
+
+    if mode == "hardlink":
+      try:
+        os.link(src, part)
+      except OSError: # e.g. different filesystems
+        pass
+      else:
+        if os.path.samestat(os.stat(part), st):
+          os.replace(part, loc)
+          return True
+        os.remove(part) # 'src' has been replaced in the meantime
+
+    with open(part, "wb") as fdst:
+      cloned = False
+      if mode == "reflink" and fcntl is not None:
+        try:
+          fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+          cloned = True
+        except OSError: # not supported by the filesystem
+          pass
+      if not cloned:
+        shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+
+  os.replace(part, loc)
+  return True
+
+def _block_digests(data):
+  block = DropboxContentHasher.BLOCK_SIZE
+  return [ hashlib.sha256(data[start:start + block]).digest() for start in range(0, len(data), block) ]
+
+def upload_file(dbx, loc, commit, jobs=1):
+  """
+  Upload the data of 'loc' into an upload session, to be committed by finish_uploads().
+
+  Files up to UPLOAD_CHUNK_SIZE are uploaded with a single request. Larger files are
+  appended in chunks to a concurrent session, up to 'jobs' chunks at the same time.
+  The content hash is computed from the uploaded data, so dropbox verifies it on commit.
+  'commit' is the dropbox.files.CommitInfo. Returns the dropbox.files.UploadSessionFinishArg and the
+  os.stat_result of 'loc' when it has been read: the uploaded data is only known to match the file, as long as that doesn't change.
+  """
+  with open(loc, "rb") as f:
+    st   = os.fstat(f.fileno())
+    size = st.st_size
+    if size <= UPLOAD_CHUNK_SIZE:
+      data = f.read()
+      session = dbx.files_upload_session_start(data, close=True).session_id
+      size, digests = len(data), _block_digests(data)
+    else:
+      session = dbx.files_upload_session_start(b"", session_type=dropbox.files.UploadSessionType.concurrent).session_id
+      def append(offset):
+        with open(loc, "rb") as f:
+          f.seek(offset)
+          data = f.read(UPLOAD_CHUNK_SIZE)
+        dbx.files_upload_session_append_v2(data, dropbox.files.UploadSessionCursor(session, offset), close=offset + len(data) >= size)
+        return _block_digests(data)
+      offsets = list(range(0, size, UPLOAD_CHUNK_SIZE))
+      with concurrent.futures.ThreadPoolExecutor(max(1, jobs), thread_name_prefix="dropsync-upload") as pool:
+        chunks = list(pool.map(append, offsets[:-1])) # in order, re-raises exceptions
+      chunks += [ append(offsets[-1]) ] # closes the session, after all other chunks
+      digests = [ digest for chunk in chunks for digest in chunk ]
+  content_hash = hashlib.sha256(b"".join(digests)).hexdigest()
+  return dropbox.files.UploadSessionFinishArg(dropbox.files.UploadSessionCursor(session, size), commit, content_hash=content_hash), st
+
+def finish_uploads(dbx, entries):
+  """
+  commit the upload sessions [ UploadSessionFinishArg ]. Returns the FileMetadata of each entry,
+  or an UploadFailed exception, if dropbox hasn't committed it. The others have been committed nevertheless
+  """
+  uploaded = []
+  for start in range(0, len(entries), UPLOAD_BATCH_SIZE):
+    batch = entries[start:start + UPLOAD_BATCH_SIZE]
+    result = dbx.files_upload_session_finish_batch_v2(batch)
+    for arg, entry in zip(batch, result.entries):
+      uploaded += [ entry.get_success() if entry.is_success() else UploadFailed(f"Upload of {arg.commit.path} failed: {entry.get_failure()}") ]
+  return uploaded
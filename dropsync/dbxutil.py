@@ -1,7 +1,17 @@
-import os, tempfile
+import os, re, posixpath, tempfile, zlib
 
 _fs_case_sensitive = {}
 
+def process_alive(pid):
+    """ True, if the process 'pid' (of this host) is running. POSIX only, os.kill() terminates it on Windows """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # pragma: nocover
+        pass
+    return True
+
 # https://stackoverflow.com/a/36580834/10545609
 def fs_case_sensitive(path):
     tmp = path if os.path.isdir(path) else os.path.dirname(path) # try to use parent dir if path is not yet created
@@ -11,10 +21,13 @@ def fs_case_sensitive(path):
     return _fs_case_sensitive[path]
 
 # https://stackoverflow.com/a/8462613/10545609
-def path_insensitive(path):
+def path_insensitive(path, index=None):
     """
     Recursive part of path_insensitive to do the work.
+    With a DirIndex, directory listings below its root are cached.
     """
+    if index is not None:
+        return index.resolve(path)
 
     if path == '' or os.path.exists(path):
         return path
@@ -52,3 +65,146 @@ def path_insensitive(path):
         return os.path.join(dirname, basefinal) + suffix
     else: # pragma: nocover
         return None
+
+
+class DirIndex(object):
+    """
+    Per-run cache for case-insensitive path resolution below 'root'.
+
+    Maps the lower case names of each directory to the real names. Listings are read
+    lazily and kept up to date with add() and remove() for entries created or removed
+    by the sync, so each directory is listed at most once.
+    """
+    def __init__(self, root):
+        self.root = os.path.realpath(os.path.normpath(root))
+        self.dirs = {} # real directory path -> { lower case name: [ real names ] }, None if it can't be listed
+
+    def names(self, dirname):
+        if dirname not in self.dirs:
+            try:
+                entries = os.listdir(dirname)
+            except OSError:
+                self.dirs[dirname] = None
+            else:
+                self.dirs[dirname] = names = {}
+                for name in entries:
+                    names.setdefault(name.lower(), []).append(name)
+        return self.dirs[dirname]
+
+    def inside(self, path):
+        return path.startswith(self.root + os.sep)
+
+    def resolve(self, path):
+        """ 'path' with the real case of existing entries (like path_insensitive), or None """
+        stripped = path.rstrip(os.sep)
+        if stripped == self.root or not self.inside(stripped):
+            return path_insensitive(path)
+        suffix = path[len(stripped):]
+
+        dirname, base = os.path.split(stripped)
+        realdir = self.resolve(dirname)
+        names   = self.names(realdir) if realdir is not None else None
+        found   = names.get(base.lower()) if names is not None else None
+        if not found:
+            return None
+        return os.path.join(realdir, base if base in found else found[0]) + suffix
+
+    def add(self, path):
+        """ 'path' (and missing parent directories) has been created """
+        path = path.rstrip(os.sep)
+        while self.inside(path):
+            dirname, base = os.path.split(path)
+            if self.dirs.get(path, {}) is None: # couldn't be listed before
+                del self.dirs[path]
+            names = self.dirs.get(dirname)
+            if names is not None:
+                found = names.setdefault(base.lower(), [])
+                if base in found: break # parents are known, too
+                found.append(base)
+            path = dirname
+
+    def remove(self, path):
+        """ 'path' (and everything below it) has been removed """
+        path = path.rstrip(os.sep)
+        dirname, base = os.path.split(path)
+        names = self.dirs.get(dirname)
+        found = names.get(base.lower()) if names is not None else None
+        if found and base in found:
+            found.remove(base)
+            if not found: del names[base.lower()]
+        if path in self.dirs:
+            prefix = path + os.sep
+            for key in [ k for k in self.dirs if k == path or k.startswith(prefix) ]:
+                del self.dirs[key]
+
+
+def shard_of(path, root, count):
+    """ the shard (0..count-1) of the top level entry of 'path' below 'root', None for root itself (or outside of it) """
+    path, root = path.lower(), root.lower().rstrip("/")
+    if not path.startswith(root + "/"):
+        return None
+    top = path[len(root) + 1:].split("/", 1)[0]
+    return zlib.crc32(top.encode("utf-8")) % count if top else None
+
+class PathMatcher(object):
+    """
+    Exclude, include and keep patterns, each list compiled into a single regular expression.
+
+    excluded_tree() caches its decision per folder, so all entries below an excluded
+    folder are pruned without evaluating the patterns again.
+
+    'shard' (index, count) excludes and keeps the entries of the other shards, see shard_of()
+    """
+    BACKREF = re.compile(r"\\[1-9]|\(\?P=") # numbered or named group references can't be combined
+
+    def __init__(self, exclude=(), include=(), keep=(), root="", flags=re.I, shard=None):
+        self.shard = shard
+        self.excl = self.combine(exclude, flags)
+        self.incl = self.combine(include, flags)
+        self.keep = self.combine(keep, flags)
+        self.root = root.lower().rstrip("/")
+        self._folders = {} # lower case folder path -> excluded (including ancestors)
+
+    @classmethod
+    def combine(cls, patterns, flags=0):
+        """ a list with one regex matching any of 'patterns', or the separate patterns, if they can't be combined """
+        patterns = [ p if isinstance(p, str) else p.pattern for p in patterns ]
+        single   = [ re.compile(p, flags) for p in patterns ] # report errors for the offending pattern
+        if len(single) <= 1 or any(cls.BACKREF.search(p) for p in patterns):
+            return single
+        try:
+            return [ re.compile("|".join(f"(?:{p})" for p in patterns), flags) ]
+        except re.error: # e.g. the same group name in multiple patterns, or global flags not at the start
+            return single
+
+    @staticmethod
+    def matches(compiled, path):
+        for patt in compiled:
+            if patt.match(path):
+                return True
+        return False
+
+    def foreign(self, path):
+        """ 'path' belongs to another shard """
+        if self.shard is None:
+            return False
+        index, count = self.shard
+        return shard_of(path, self.root, count) not in (None, index)
+
+    def excluded(self, path):
+        return self.foreign(path) or (self.matches(self.excl, path) and not self.matches(self.incl, path))
+
+    def kept(self, path):
+        return self.foreign(path) or self.matches(self.keep, path)
+
+    def excluded_tree(self, path):
+        """ 'path' or one of its ancestors below root is excluded. The cached ancestors first, so pruned entries aren't matched """
+        return self._excluded_folder(posixpath.dirname(path.rstrip("/"))) or self.excluded(path)
+
+    def _excluded_folder(self, folder):
+        key = folder.lower().rstrip("/")
+        if not key or key == self.root:
+            return False
+        if key not in self._folders:
+            self._folders[key] = self.excluded(folder) or self._excluded_folder(posixpath.dirname(folder.rstrip("/")))
+        return self._folders[key]
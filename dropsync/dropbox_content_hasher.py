@@ -2,8 +2,9 @@
 # type: ignore[reportOptionalMemberAccess]
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import collections
+import concurrent.futures
 import hashlib
-import six
 
 class DropboxContentHasher(object): # pragma: nocover
     """
@@ -44,8 +45,9 @@ class DropboxContentHasher(object): # pragma: nocover
             raise AssertionError(
                 "can't use this object anymore; you already called digest()")
 
-        assert isinstance(new_data, six.binary_type), (
-            "Expecting a byte string, got {!r}".format(new_data))
+        # any bytes-like object (bytes, bytearray, mmap, memoryview, ...) is accepted.
+        # Slicing the memoryview below doesn't copy any data.
+        new_data = memoryview(new_data).cast("B")
 
         new_data_pos = 0
         while new_data_pos < len(new_data):
@@ -87,6 +89,53 @@ class DropboxContentHasher(object): # pragma: nocover
         return c
 
 
+def hash_file(path, chunk_size=DropboxContentHasher.BLOCK_SIZE, workers=1):
+    """
+    Returns the hexadecimal content hash of the file at 'path'.
+
+    The file is read in chunks into a single reusable buffer, so memory usage
+    doesn't depend on the size of the file.
+
+    With workers > 1, the 4 MB blocks are hashed concurrently by a pool of
+    threads (hashlib releases the GIL) and their digests are combined in
+    order. At most 2 * workers blocks are kept in memory.
+    """
+    if workers > 1:
+        return _hash_file_parallel(path, workers)
+
+    hasher = DropboxContentHasher()
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+    return hasher.hexdigest()
+
+
+def _block_digest(block):
+    return hashlib.sha256(block).digest()
+
+
+def _hash_file_parallel(path, workers):
+    overall = hashlib.sha256()
+    pending = collections.deque()
+    eof = False
+    with open(path, "rb") as f, concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        while not eof or pending:
+            if not eof and len(pending) < 2 * workers:
+                block = f.read(DropboxContentHasher.BLOCK_SIZE)
+                if block:
+                    pending.append(pool.submit(_block_digest, block))
+                else:
+                    eof = True
+            else:
+                overall.update(pending.popleft().result())
+    return overall.hexdigest()
+
+
 class StreamHasher(object): # pragma: nocover
     """
     A wrapper around a file-like object (either for reading or writing)
@@ -24,6 +24,7 @@ class TestBase(unittest.TestCase):
         if not online: # pragma: nobranch
             p = patch.object(dbxmirror.dropbox, "Dropbox", new=self.dbx); p.start()
         p = patch.object(dbxmirror.os, "makedirs", new=self.dbx.makedirs_mock); p.start()
+        self.sleep = patch.object(dbxmirror.dbxretry, "sleep").start() # retries don't wait
         self.addCleanup(patch.stopall)
 
     def tearDown(self):
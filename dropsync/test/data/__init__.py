@@ -99,3 +99,84 @@ MORE_FILES_1 = {
         "f5.txt": { "data": b"Hello 5!", "client_modified": t(1972, 5, 8, 5, 0, 0)},
     }
 }
+
+SIMPLE_CHANGE_1 = {
+    "folders": {
+        "Test": {
+            "files": {
+                "new.txt": { "data": b"I'm new here!", "client_modified": t(2024, 11, 15, 12, 0, 0) },
+            }
+        },
+        "Added": {
+            "files": {
+                "added.txt": { "data": b"Me too!", "client_modified": t(2024, 11, 15, 12, 0, 0) },
+            }
+        }
+    },
+    "deleted": {
+        "foo.txt": {},
+    }
+}
+
+TWO_FOLDERS_1 = {
+    "folders": {
+        "A": { "files": { "a.txt": { "data": b"Hello A!", "client_modified": t(2024, 11, 15, 12, 0, 0) } } },
+        "B": { "files": { "b.txt": { "data": b"Hello B!", "client_modified": t(2024, 11, 15, 12, 0, 0) } } },
+    }
+}
+
+DUPLICATES_1 = {
+    "folders": {
+        "A": { "files": { "setup.exe": { "data": b"Installer" * 1000, "client_modified": t(2024, 11, 15, 12, 0, 0) } } },
+        "B": { "files": { "setup.exe": { "data": b"Installer" * 1000, "client_modified": t(2024, 11, 16, 12, 0, 0) } } },
+    },
+    "files": {
+        "setup.exe": { "data": b"Installer" * 1000, "client_modified": t(2024, 11, 14, 12, 0, 0) },
+    }
+}
+
+SIMPLE_MOVED_1 = { # the folder "Test" of SIMPLE_1 was renamed and "foo.txt" moved into it
+    "folders": {
+        "Renamed": {
+            "id": str(hash("/Test")),
+            "folders": {
+                "empty": { "id": str(hash("/Test/empty")) },
+            },
+            "files": {
+                "bar.txt":   { "id": str(hash("/Test/bar.txt")),   "data": b"Hello Test folder!", "client_modified": t(2007, 6, 19, 15, 0, 0) },
+                "empty.txt": { "id": str(hash("/Test/empty.txt")), "data": b"", "client_modified": t(1998, 12, 15, 15, 0, 0) },
+                "foo.txt":   { "id": str(hash("/foo.txt")),        "data": b"Hello World!", "client_modified": t(1972, 5, 8, 0, 0, 0)},
+            }
+        }
+    },
+    "deleted": {
+        "Test": {},
+        "foo.txt": {},
+    }
+}
+
+SMALL_FILES_1 = {
+    "folders": {
+        "Small": deepcopy(MORE_FILES_1),
+    },
+    "files": {
+        "f0.txt": { "data": b"Hello 0!", "client_modified": t(1972, 5, 8, 0, 0, 0)},
+    }
+}
+
+UPLOAD_1 = deepcopy(SIMPLE_EXIST_1) # local changes, to be uploaded
+UPLOAD_1["files"].update({
+    "remote.txt": { "data": b"Remote only", "client_modified": t(2024, 11, 15, 12, 0, 0) },
+})
+UPLOAD_1["target"]["files"]["foo.txt"].update({
+    "data": b"Hello Upload!", "client_modified": t(2024, 11, 16, 12, 0, 0)
+})
+UPLOAD_1["target"]["folders"]["Test"]["files"].update({
+    "added.txt": { "data": b"Local only", "client_modified": t(2024, 11, 16, 12, 0, 0) },
+})
+UPLOAD_1["target"]["folders"].update({
+    "New": {
+        "folders": { "sub": { } },
+        "files": { "new.txt": { "data": b"New local folder", "client_modified": t(2024, 11, 16, 12, 0, 0) } },
+    }
+})
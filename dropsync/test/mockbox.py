@@ -1,7 +1,10 @@
-import unittest, os, json, shutil, datetime
+import unittest, os, io, json, shutil, datetime, hashlib, zipfile
 from os import makedirs as os_makedirs
 from unittest.mock import MagicMock, NonCallableMagicMock
 from dropbox.files import FolderMetadata, FileMetadata, DeletedMetadata, ListFolderResult, Metadata, SymlinkInfo
+from dropbox.files import ListFolderGetLatestCursorResult, DownloadZipResult
+from dropbox.files import UploadSessionStartResult, UploadSessionFinishBatchResult, UploadSessionFinishBatchResultEntry
+from dropbox.files import CreateFolderResult, DeleteResult
 from ..dropbox_content_hasher import DropboxContentHasher
 from ..dbxmirror import isfile, isfolder, isdeleted
 from ..dbxmeta import LocalFolderMeta, LocalFileMeta, LocalDeletedMeta
@@ -12,19 +15,45 @@ def chash(data):
     hasher.update(data)
     return hasher.hexdigest()
 
+class MockResponse(object):
+    """ the parts of requests.Response used for downloads """
+    def __init__(self, data : bytes, status_code=200):
+        self.data = data
+        self.status_code = status_code
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        for pos in range(0, len(self.data), chunk_size):
+            yield self.data[pos:pos+chunk_size]
+
+    def close(self):
+        self.closed = True
+
 class Mockbox(NonCallableMagicMock):
     def __init__(self, testcase : unittest.TestCase, test_data : Optional[dict] = None, max_return=None, target=None, **kwargs):
         super().__init__(**kwargs)
         self.testcase = testcase
         self.test_data = {}
         self.files_list_folder.side_effect = self._files_list_folder
-        self.files_download_to_file.side_effect = self._files_download_to_file
+        self.files_download.side_effect = self._files_download
+        self.files_download_zip.side_effect = self._files_download_zip
         self.files_list_folder_continue.side_effect = self._files_list_folder_continue
+        self.files_list_folder_get_latest_cursor.side_effect = self._files_list_folder_get_latest_cursor
+        self.files_upload_session_start.side_effect = self._files_upload_session_start
+        self.files_upload_session_append_v2.side_effect = self._files_upload_session_append_v2
+        self.files_upload_session_finish_batch_v2.side_effect = self._files_upload_session_finish_batch_v2
+        self.files_create_folder_v2.side_effect = self._files_create_folder_v2
+        self.files_delete_v2.side_effect = self._files_delete_v2
         self.makedirs_mock = MagicMock()
         self.makedirs_mock.side_effect = self._makedirs
         self.target = target
         self.remote = {}
+        self.changes = []
         self.downloaded = []
+        self.zipped = []
+        self.sessions = {}
+        self.uploaded = []
+        self.removed = []
         self.dirs_made = []
         self.max_return = max_return
         if test_data: # pragma: nocover
@@ -35,28 +64,133 @@ class Mockbox(NonCallableMagicMock):
         self.remote[""] = (None, self.build(self.test_data, all=self.remote))
         self.create_target()
 
-    def _files_list_folder(self, path, _cursor=None, *args, **kwars):
+    def _files_list_folder(self, path, _cursor=None, recursive=False, *args, **kwars):
         next    = 0
         if _cursor is not None:
-            path, next = json.loads(_cursor)
-        _meta, local = self.remote[path]
-        entries = [ l[0] for l in local ]
+            path, next, recursive = json.loads(_cursor)
+        if recursive: # the folder itself and everything below it
+            entries = [ meta for key, (meta, _sub) in sorted(self.remote.items()) if meta is not None and (key == path or key.startswith(path + "/")) ]
+        else:
+            _meta, local = self.remote[path]
+            entries = [ l[0] for l in local ]
         start, end = (0, len(entries))
         if self.max_return is not None:
             start, end = (next, next + self.max_return)
-            _cursor = json.dumps([path, end])
+            _cursor = json.dumps([path, end, recursive])
         return ListFolderResult(entries=entries[start:end], cursor=_cursor, has_more=(end < len(entries)))
 
     def _files_list_folder_continue(self, cursor, *args, **kwargs):
+        path, next = json.loads(cursor)[:2]
+        if path == "#delta":
+            return ListFolderResult(entries=self.changes[next:], cursor=json.dumps([path, len(self.changes)]), has_more=False)
         return self._files_list_folder(None, _cursor=cursor)
 
-    def _files_download_to_file(self, local : str, remote : str):
+    def _files_list_folder_get_latest_cursor(self, path, recursive=False, *args, **kwargs):
+        self.testcase.assertTrue(recursive)
+        return ListFolderGetLatestCursorResult(cursor=json.dumps(["#delta", len(self.changes)]))
+
+    def change(self, test_data):
+        """ apply changes to the remote data, the next delta will return them """
+        before = dict(self.remote)
+        self.build(test_data, all=self.remote)
+        changed = sorted([ (k, e[0]) for k, e in self.remote.items() if before.get(k) is not e ], key=lambda c: c[0])
+        for key, meta in changed:
+            if isdeleted(meta): # remove entries below deleted folders
+                for sub in [ k for k in self.remote if k.startswith(key + "/") ]: del self.remote[sub]
+        self.changes += [ meta for _key, meta in changed ]
+        self._relist()
+
+    def _relist(self):
+        for key, (meta, _sub) in list(self.remote.items()): # update folder listings
+            if key == "" or isfolder(meta):
+                self.remote[key] = (meta, [ e for k, e in self.remote.items() if k and k.rsplit("/", 1)[0] == key ])
+
+    def _put(self, meta, data):
+        """ add or replace a remote entry, like a change made by this client """
+        self.remote[meta.path_lower] = (meta, data)
+        self.changes += [ meta ]
+        self._relist()
+
+    def _display(self, path):
+        """ the display path, with the case of existing parent folders """
+        parent, name = path.rsplit("/", 1)
+        if not parent: return path
+        meta = self.remote.get(parent.lower(), (None,))[0]
+        return "/".join([ meta.path_display if meta is not None and isfolder(meta) else self._folder(parent).path_display, name ])
+
+    def _folder(self, path):
+        if path.lower() in self.remote: return self.remote[path.lower()][0]
+        pth  = self._display(path)
+        meta = FolderMetadata(name=pth.rsplit("/", 1)[1], id=str(hash(pth)), path_lower=pth.lower(), path_display=pth)
+        self._put(meta, [])
+        return meta
+
+    def _files_upload_session_start(self, f, close=False, session_type=None, content_hash=None):
+        session = f"session-{len(self.sessions)}"
+        self.sessions[session] = { 0: bytes(f) }
+        return UploadSessionStartResult(session_id=session)
+
+    def _files_upload_session_append_v2(self, f, cursor, close=False, content_hash=None):
+        self.testcase.assertIn(cursor.session_id, self.sessions)
+        self.sessions[cursor.session_id][cursor.offset] = bytes(f)
+
+    def _files_upload_session_finish_batch_v2(self, entries):
+        results = []
+        for arg in entries:
+            chunks = self.sessions.pop(arg.cursor.session_id)
+            data = b"".join(chunk for _offset, chunk in sorted(chunks.items()))
+            self.testcase.assertEqual(arg.cursor.offset, len(data))
+            if arg.content_hash is not None: self.testcase.assertEqual(arg.content_hash, chash(data))
+            pth, mode = self._display(arg.commit.path), arg.commit.mode
+            old = self.remote.get(pth.lower(), (None,))[0]
+            if old is not None and not isdeleted(old) and (mode.is_add() or (mode.is_update() and mode.get_update() != old.rev)):
+                self.testcase.assertTrue(arg.commit.autorename)
+                name, ext = os.path.splitext(pth)
+                pth = f"{name} (1){ext}"
+            cmod = arg.commit.client_modified
+            meta = FileMetadata(name=pth.rsplit("/", 1)[1], id=str(hash(pth)), path_lower=pth.lower(), path_display=pth,
+                                client_modified=cmod, server_modified=cmod, content_hash=chash(data),
+                                rev=hashlib.md5((str(cmod) + pth.lower()).encode("utf-8") + data).hexdigest()[:16], size=len(data),
+                                is_downloadable=True)
+            self._put(meta, data)
+            self.uploaded += [ pth ]
+            results += [ UploadSessionFinishBatchResultEntry("success", meta) ]
+        return UploadSessionFinishBatchResult(entries=results)
+
+    def _files_create_folder_v2(self, path, autorename=False):
+        self.testcase.assertFalse(path.lower() in self.remote and not isdeleted(self.remote[path.lower()][0]))
+        self.remote.pop(path.lower(), None) # deleted before
+        return CreateFolderResult(metadata=self._folder(path))
+
+    def _files_delete_v2(self, path, parent_rev=None):
+        meta = self.remote[path][0]
+        if parent_rev is not None: self.testcase.assertEqual(parent_rev, meta.rev)
+        for key in [ k for k in self.remote if k == path or k.startswith(path + "/") ]: del self.remote[key]
+        self._put(DeletedMetadata(name=meta.name, path_lower=meta.path_lower, path_display=meta.path_display), [])
+        self.removed += [ path ]
+        return DeleteResult(metadata=meta)
+
+    def _files_download(self, remote : str, rev=None, extra_headers=None):
+        if remote.startswith("rev:"):
+            remote = next(k for k, e in self.remote.items() if isfile(e[0]) and e[0].rev == remote[4:])
         self.testcase.assertIn(remote, self.remote)
         meta, data = self.remote[remote]
-        with open(local, "wb") as f:
-            f.write(data)
-        self.downloaded += [ (local, remote) ]
-        return meta
+        self.downloaded += [ (None, remote) ]
+        if extra_headers and "Range" in extra_headers:
+            start = int(extra_headers["Range"].split("=")[1].rstrip("-"))
+            return meta, MockResponse(data[start:], status_code=206)
+        return meta, MockResponse(data)
+
+    def _files_download_zip(self, remote : str):
+        meta, _sub = self.remote[remote]
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w") as archive:
+            archive.writestr(meta.name + "/", b"")
+            for key, (entry, data) in sorted(self.remote.items()):
+                if key.startswith(remote + "/") and isfile(entry):
+                    archive.writestr(meta.name + entry.path_display[len(meta.path_display):], data)
+        self.zipped += [ remote ]
+        return DownloadZipResult(metadata=meta), MockResponse(buf.getvalue())
 
     def _makedirs(self, dir, *args, **kwargs):
         os_makedirs(dir, *args, **kwargs)
@@ -74,7 +208,7 @@ class Mockbox(NonCallableMagicMock):
             pth = path + "/" + f
             subentries = self.build(d, pth, all)
             if not pth.lower() in all:
-                meta = folder_class(name=f, id=str(hash(pth)), path_lower=pth.lower(), path_display=pth)
+                meta = folder_class(name=f, id=d.get("id", str(hash(pth))), path_lower=pth.lower(), path_display=pth)
                 entry = (meta, subentries)
             else: # handle case sensitivity
                 entry = all[pth.lower()]
@@ -90,9 +224,9 @@ class Mockbox(NonCallableMagicMock):
             cmod = d["client_modified"]
             smod = d.get("server_modified", cmod)
             slnk = SymlinkInfo(target=d["symlink"]) if d.get("symlink") else None
-            meta = file_class(name=f, id=str(hash(pth)), path_lower=pth.lower(), path_display=pth,
+            meta = file_class(name=f, id=d.get("id", str(hash(pth))), path_lower=pth.lower(), path_display=pth,
                               client_modified=cmod, server_modified=cmod, content_hash=chash(d["data"]),
-                              rev=str(cmod).encode("utf-8").hex(), size=len(d["data"]),
+                              rev=hashlib.md5((str(cmod) + pth.lower()).encode("utf-8")).hexdigest()[:16], size=len(d["data"]),
                               symlink_info=slnk, is_downloadable=True)
             entry = (meta, d["data"])
             local += [ entry ]
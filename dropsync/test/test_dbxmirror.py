@@ -1,9 +1,9 @@
-import unittest, shutil, json, io
-from contextlib import redirect_stdout
-from datetime import datetime
+import sys, unittest, shutil, tempfile, json, io, os, hashlib
+from contextlib import redirect_stdout, redirect_stderr
+from datetime import datetime, timezone
 import dropbox, dropbox.oauth
 from .. import dbxmirror
-from .  import data, TestBase, TEST_ARGS, TEST_TARGET, patch, MagicMock
+from .  import data, TestBase, TEST_ARGS, TEST_TARGET, TEST_DBNAME, patch, MagicMock
 
 class TestDbxmirror(TestBase):
 
@@ -215,3 +215,989 @@ class TestDbxmirror(TestBase):
 
         self.assertEqual(rc, 0)
         self.assertEqual("foobar", self.meta.db.execute("select token from login").fetchone()[0])
+
+    def test_incremental(self):
+        """ apply only remote changes, using the stored cursor """
+        self.dbx.set_data(data.SIMPLE_1)
+
+        with self.subTest("initial full sync"):
+            rc = dbxmirror.main(TEST_ARGS + [ "--incremental" ])
+
+            self.assertEqual(rc, 0)
+            self.assertTargetMatchesRemote()
+            self.assertEqual(1, self.dbx.files_list_folder_get_latest_cursor.call_count)
+
+        with self.subTest("dry run"):
+            self.dbx.change(data.SIMPLE_CHANGE_1)
+            self.dbx.downloaded = []
+            files = self.listTarget()
+
+            with redirect_stdout(io.StringIO()):
+                rc = dbxmirror.main(TEST_ARGS + [ "--incremental", "--dry-run" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(0, len(self.dbx.downloaded))
+            self.assertEqual(files, self.listTarget())
+
+        with self.subTest("changes only"):
+            self.dbx.files_list_folder.reset_mock(); self.dbx.downloaded = []
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--incremental" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(0, self.dbx.files_list_folder.call_count)
+            self.assertEqual(2, len(self.dbx.downloaded))
+            self.assertFalse((TEST_TARGET / "foo.txt").exists())
+            self.assertEqual(len(self.dbx.existing), len(self.listTarget()))
+            meta = self.meta.db.execute("select count(*) from meta where type <> 'LocalDeletedMeta'").fetchone()[0]
+            self.assertEqual(len(self.dbx.existing), meta)
+
+        with self.subTest("no changes"):
+            self.dbx.downloaded = []
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--incremental" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(0, self.dbx.files_list_folder.call_count)
+            self.assertEqual(0, len(self.dbx.downloaded))
+
+        with self.subTest("changed options"):
+            rc = dbxmirror.main(TEST_ARGS + [ "--incremental", "--exclude=/Added" ])
+
+            self.assertEqual(rc, 0)
+            self.assertGreater(self.dbx.files_list_folder.call_count, 0)
+
+    def test_incremental_dir_only(self):
+        """ a cursor stored by a --dir-only run doesn't apply to a sync of the files """
+        self.dbx.set_data(data.SIMPLE_1)
+
+        rc = dbxmirror.main(TEST_ARGS + [ "--incremental", "--dir-only" ])
+
+        self.assertEqual(rc, 0)
+        self.assertEqual(0, len(self.dbx.downloaded))
+
+        rc = dbxmirror.main(TEST_ARGS + [ "--incremental" ])
+
+        self.assertEqual(rc, 0)
+        self.assertEqual(len(self.dbx.files), len(self.dbx.downloaded))
+        self.assertTargetMatchesRemote()
+
+    def test_watch(self):
+        """ wait for remote changes and apply them, until interrupted """
+        from dropbox.files import ListFolderLongpollResult
+        self.dbx.set_data(data.SIMPLE_1)
+        def longpoll(cursor, timeout=30):
+            if self.dbx.files_list_folder_longpoll.call_count == 1:
+                self.dbx.change(data.SIMPLE_CHANGE_1)
+                return ListFolderLongpollResult(changes=True)
+            if self.dbx.files_list_folder_longpoll.call_count == 2:
+                return ListFolderLongpollResult(changes=False)
+            raise KeyboardInterrupt()
+        self.dbx.files_list_folder_longpoll.side_effect = longpoll
+
+        with patch.object(dbxmirror.dbxutil, "DirIndex", wraps=dbxmirror.dbxutil.DirIndex) as mock_dirindex:
+            rc = dbxmirror.main(TEST_ARGS + [ "--watch" ])
+
+        self.assertEqual(rc, 0)
+        self.assertEqual(3, self.dbx.files_list_folder_longpoll.call_count)
+        self.assertEqual(1 + 3, mock_dirindex.call_count) # a fresh one for each round
+        self.assertEqual(1, self.dbx.files_list_folder_get_latest_cursor.call_count) # one initial full sync
+        self.assertEqual(3, self.dbx.files_list_folder.call_count) # "", "/Test" and "/Test/empty", by the initial full sync
+        self.assertFalse((TEST_TARGET / "foo.txt").exists())
+        self.assertTrue((TEST_TARGET / "Added" / "added.txt").exists())
+        self.assertEqual(len(self.dbx.existing), len(self.listTarget()))
+
+        with self.subTest("reset cursor"):
+            from dropbox.files import ListFolderLongpollError
+            reset = dropbox.exceptions.ApiError("req", ListFolderLongpollError.reset, None, None)
+            self.dbx.files_list_folder_longpoll.side_effect = [ reset, KeyboardInterrupt() ]
+            self.dbx.files_list_folder_get_latest_cursor.reset_mock(); self.dbx.files_list_folder.reset_mock()
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--watch" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(1, self.dbx.files_list_folder_get_latest_cursor.call_count) # a full sync
+            self.assertGreater(self.dbx.files_list_folder.call_count, 0)
+            self.assertEqual(len(self.dbx.existing), len(self.listTarget()))
+
+        with self.subTest("transient errors"), redirect_stderr(io.StringIO()) as mock_stderr, \
+             patch.object(dbxmirror.time, "sleep") as mock_sleep:
+            import requests.exceptions
+            error = requests.exceptions.ConnectionError("offline")
+            self.dbx.files_list_folder_longpoll.reset_mock()
+            self.dbx.files_list_folder_longpoll.side_effect = [ error, error, ListFolderLongpollResult(changes=False),
+                                                                error, KeyboardInterrupt() ]
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--watch", "--retries=0" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(5, self.dbx.files_list_folder_longpoll.call_count)
+            self.assertEqual([ 1.0, 2.0, 1.0 ], [ c.args[0] for c in mock_sleep.call_args_list ]) # reset by the successful round
+            self.assertIn("ConnectionError('offline')", mock_stderr.getvalue())
+
+        with self.subTest("upload"), redirect_stderr(io.StringIO()):
+            self.assertEqual(2, dbxmirror.main(TEST_ARGS + [ "--watch", "--direction=upload" ]))
+
+        with self.subTest("timeout"), redirect_stderr(io.StringIO()) as mock_stderr:
+            with self.assertRaises(SystemExit) as thrown:
+                dbxmirror.main(TEST_ARGS + [ "--watch", "--watch-timeout=10" ])
+            self.assertEqual(2, thrown.exception.code)
+            self.assertIn("expected 30-480 seconds", mock_stderr.getvalue())
+
+    def test_parallel(self):
+        """ download with multiple worker threads """
+        self.dbx.set_data(data.MORE_FILES_1)
+
+        rc = dbxmirror.main(TEST_ARGS + [ "--jobs=3" ])
+
+        self.assertEqual(rc, 0)
+        self.assertTargetMatchesRemote()
+        for _local, remote in self.dbx.downloaded: # timestamps are adjusted after the transfer
+            self.assertEqual(self.dbx.remote[remote][0].client_modified.replace(tzinfo=timezone.utc).timestamp(),
+                             os.stat(TEST_TARGET / remote.lstrip("/")).st_mtime)
+
+    def test_list_jobs(self):
+        """ subfolders are listed in parallel, each of them once """
+        self.dbx.set_data(data.MORE_FILES_1)
+
+        rc = dbxmirror.main(TEST_ARGS + [ "--list-jobs=3" ])
+
+        self.assertEqual(rc, 0)
+        self.assertTargetMatchesRemote()
+        self.assertEqual(len(self.dbx.folders) + 1, self.dbx.files_list_folder.call_count)
+
+        with self.subTest("skipped folders"):
+            self.dbx.set_data(data.SIMPLE_1)
+            self.dbx.files_list_folder.reset_mock()
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--list-jobs=3", "--direction=upload", "--no-delete" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(1, self.dbx.files_list_folder.call_count) # remote only, not prefetched
+
+        with self.subTest("bounded"):
+            import threading
+            from .. import dbxtransfer
+            started, release = [], threading.Event()
+            def fetch(key):
+                started.append(key)
+                release.wait()
+                return key.upper()
+            listings = dbxtransfer.Prefetch(fetch, jobs=2, limit=2)
+            listings.add([ "a", "b", "c" ])
+            listings.add([ "a1", "a2" ]) # e.g. subfolders of "a", needed before "b" and "c"
+            self.assertEqual([ "a", "b" ], sorted(listings.pending))
+            self.assertEqual([ "a1", "a2", "c" ], list(listings.queued))
+            release.set()
+            self.assertEqual("A", listings.get("a"))
+            self.assertEqual([ "a1", "b" ], sorted(listings.pending))
+            self.assertEqual("C", listings.get("c")) # not prefetched yet
+            self.assertEqual("B", listings.get("b"))
+            self.assertEqual("A1", listings.get("a1"))
+            self.assertEqual("A2", listings.get("a2"))
+            self.assertEqual({}, listings.pending)
+            listings.close()
+            self.assertEqual(sorted(started), [ "a", "a1", "a2", "b", "c" ])
+
+    def test_upload(self):
+        """ upload local changes, remove remote files not found locally """
+        self.dbx.set_data(data.UPLOAD_1)
+
+        rc = dbxmirror.main(TEST_ARGS + [ "--direction=upload" ])
+
+        self.assertEqual(rc, 0)
+        self.assertEqual(sorted([ "/foo.txt", "/Test/added.txt", "/New/new.txt" ]), sorted(self.dbx.uploaded))
+        self.assertEqual([ "/remote.txt" ], self.dbx.removed)
+        self.assertEqual(0, len(self.dbx.downloaded))
+        self.assertEqual(b"Hello Upload!", self.dbx.remote["/foo.txt"][1])
+        self.assertIn("/new/sub", self.dbx.remote)
+        self.assertEqual(2, self.dbx.files_upload_session_finish_batch_v2.call_count) # "/" (with "/New") and "/Test"
+        self.assertEqual(len(self.dbx.existing), len(self.listTarget()))
+        meta = self.meta.db.execute("select count(*) from meta where type <> 'LocalDeletedMeta'").fetchone()[0]
+        self.assertEqual(len(self.dbx.existing), meta)
+
+        with self.subTest("unchanged"):
+            self.dbx.uploaded = []; self.dbx.files_upload_session_start.reset_mock()
+            with patch.object(dbxmirror.dropbox_content_hasher, "hash_file") as mock_hasher:
+                rc = dbxmirror.main(TEST_ARGS + [ "--direction=upload" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual([], self.dbx.uploaded)
+            self.assertEqual(0, self.dbx.files_upload_session_start.call_count)
+            self.assertEqual(0, mock_hasher.call_count) # fingerprints of the uploaded files
+
+        with self.subTest("large file"):
+            from .. import dbxtransfer
+            with open(TEST_TARGET / "New" / "new.txt", "wb") as f: f.write(b"Large" * 10)
+            with patch.object(dbxtransfer, "UPLOAD_CHUNK_SIZE", 8), patch.object(dbxtransfer.DropboxContentHasher, "BLOCK_SIZE", 4):
+                rc = dbxmirror.main(TEST_ARGS + [ "--direction=upload", "--jobs=2" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(b"Large" * 10, self.dbx.remote["/new/new.txt"][1])
+            self.assertEqual(7, self.dbx.files_upload_session_append_v2.call_count)
+
+        with self.subTest("changed during upload"):
+            from .. import dbxtransfer
+            upload_file = dbxtransfer.upload_file
+            def write_during(dbx, loc, commit, jobs=1):
+                res = upload_file(dbx, loc, commit, jobs)
+                with open(loc, "ab") as f: f.write(b" and more")
+                return res
+            with open(TEST_TARGET / "foo.txt", "wb") as f: f.write(b"Hello during")
+
+            with patch.object(dbxtransfer, "upload_file", side_effect=write_during):
+                rc = dbxmirror.main(TEST_ARGS + [ "--direction=upload" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(b"Hello during", self.dbx.remote["/foo.txt"][1])
+            self.assertIsNone(self.meta.find_records([ "/foo.txt" ])["/foo.txt"].fingerprint)
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--direction=upload" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(b"Hello during and more", self.dbx.remote["/foo.txt"][1])
+
+        with self.subTest("no delete"):
+            with open(TEST_TARGET / "foo.txt", "wb") as f: f.write(b"Hello again!")
+            self.dbx.change({ "files": { "remote.txt": { "data": b"Again", "client_modified": datetime(2024, 11, 17) } } })
+            self.dbx.removed = []
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--direction=upload", "--no-delete" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual([], self.dbx.removed)
+            self.assertEqual(b"Hello again!", self.dbx.remote["/foo.txt"][1])
+            self.assertFalse((TEST_TARGET / "remote.txt").exists())
+
+    def test_plan(self):
+        """ save the plan of a full sync, apply it later """
+        self.dbx.set_data(data.SIMPLE_1)
+        tmp  = tempfile.mkdtemp(); self.addCleanup(shutil.rmtree, tmp)
+        plan = os.path.join(tmp, "plan.json")
+
+        rc = dbxmirror.main(TEST_ARGS + [ f"--plan={plan}" ])
+
+        self.assertEqual(rc, 0)
+        self.assertEqual(0, len(self.dbx.downloaded))
+        self.assertEqual([], self.listTarget())
+        with open(plan) as f: ops = json.load(f)["ops"]
+        self.assertEqual(len(self.dbx.files), len([ op for op in ops if op["op"] == "download" ]))
+
+        self.dbx.files_list_folder.reset_mock()
+        rc = dbxmirror.main(TEST_ARGS + [ f"--apply-plan={plan}" ])
+
+        self.assertEqual(rc, 0)
+        self.assertEqual(0, self.dbx.files_list_folder.call_count)
+        self.assertTargetMatchesRemote()
+
+        with self.subTest("other target"):
+            rc = dbxmirror.main(TEST_ARGS + [ f"--apply-plan={plan}", "--direction=both" ])
+            self.assertEqual(rc, 8)
+
+        with self.subTest("max download"):
+            self.dbx.change({ "files": { "big.txt": { "data": b"Big" * 100, "client_modified": datetime(2024, 11, 17) } } })
+            self.dbx.downloaded = []
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--max-download=299" ])
+
+            self.assertEqual(rc, 3)
+            self.assertEqual([], self.dbx.downloaded)
+            self.assertFalse((TEST_TARGET / "big.txt").exists())
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--max-download=300" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(b"Big" * 100, (TEST_TARGET / "big.txt").read_bytes())
+
+        with self.subTest("max download, unchanged entries"):
+            self.meta.db.execute("delete from meta"); self.meta.db.commit()
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--max-download=0" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(len(self.listTarget()), self.meta.db.execute("select count(*) from meta").fetchone()[0])
+
+        with self.subTest("upload"):
+            self.dbx.uploaded = []
+            os.makedirs(TEST_TARGET / "New" / "sub")
+            with open(TEST_TARGET / "New" / "new.txt", "wb") as f: f.write(b"New local file")
+            os.remove(TEST_TARGET / "big.txt")
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--direction=upload", f"--plan={plan}" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual([], self.dbx.uploaded)
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--direction=upload", f"--apply-plan={plan}" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual([ "/New/new.txt" ], self.dbx.uploaded)
+            self.assertIn("/new/sub", self.dbx.remote)
+            self.assertEqual([ "/big.txt" ], self.dbx.removed)
+
+    def test_shards(self):
+        """ sync the parts of the tree separately, merge their metadata """
+        from .. import dbxutil
+        self.dbx.set_data(data.MORE_FILES_1)
+        shards = 3
+        for i in range(1, shards + 1):
+            rc = dbxmirror.main(TEST_ARGS + [ f"--shard={i}/{shards}" ])
+
+            self.assertEqual(rc, 0)
+            expected = [ f[0].path_display for f in self.dbx.files if dbxutil.shard_of(f[0].path_lower, "", shards) < i ]
+            self.assertEqual(sorted(expected), sorted(f[1] for f in self.dbx.downloaded))
+            self.assertEqual(0, self.meta.db.execute("select count(*) from meta").fetchone()[0])
+
+        rc = dbxmirror.main(TEST_ARGS + [ f"--merge-shards={shards}" ])
+
+        self.assertEqual(rc, 0)
+        self.assertTargetMatchesRemote()
+
+        with self.subTest("parallel"):
+            self.dbx.change({ "files": { "foo.txt": { "data": b"Changed", "client_modified": datetime(2024, 11, 17) } } })
+            def popen(cmd):
+                proc = MagicMock()
+                proc.wait.return_value = dbxmirror.main(cmd[3:]) # in this process, with the mocked dropbox
+                return proc
+
+            with patch.object(dbxmirror.subprocess, "Popen", side_effect=popen) as mock_popen:
+                rc = dbxmirror.main(TEST_ARGS + [ f"--shards={shards}", "--token=foobar" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(shards, mock_popen.call_count)
+            self.assertEqual(TEST_ARGS + [ f"--shard=2/{shards}" ], mock_popen.call_args_list[1][0][0][3:])
+            self.assertEqual([ "-tx", "--tokens=2", "-v" ], dbxmirror.without([ "-t", "secret", "-tx", "--token=secret", "--tokens=2", "-l", "-v" ],
+                                                                              flags=("-l",), options=("-t", "--token")))
+            self.assertEqual(b"Changed", (TEST_TARGET / "foo.txt").read_bytes())
+            self.assertEqual(len(self.dbx.existing), self.meta.db.execute("select count(*) from meta").fetchone()[0])
+
+        with self.subTest("dry run"):
+            (TEST_TARGET / f"{TEST_DBNAME}.shard1of{shards}").unlink() # as if it had never been synced
+            with patch.object(dbxmirror.subprocess, "Popen", side_effect=popen) as mock_popen:
+                rc = dbxmirror.main(TEST_ARGS + [ f"--shards={shards}", "--token=foobar", "--dry-run" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(shards, mock_popen.call_count)
+            self.assertEqual(len(self.dbx.existing), self.meta.db.execute("select count(*) from meta").fetchone()[0])
+
+            rc = dbxmirror.main(TEST_ARGS + [ f"--merge-shards={shards}" ]) # merged already, or not synced since
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(len(self.dbx.existing), self.meta.db.execute("select count(*) from meta").fetchone()[0])
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "inotify")
+    def test_local_journal(self):
+        """ upload only the local changes recorded by dbxinotify """
+        from .. import dbxinotify
+        self.dbx.set_data(data.UPLOAD_1)
+        watcher = dbxinotify.Inotify(str(TEST_TARGET), lambda rel: os.path.basename(rel).startswith(TEST_DBNAME))
+        self.addCleanup(watcher.close)
+        self.meta.set_state("local_journal", json.dumps({ "pid": os.getpid(), "since": dbxmirror.utcnow().isoformat(), "overflow": None }))
+        self.meta.commit()
+
+        rc = dbxmirror.main(TEST_ARGS + [ "--direction=upload", "--incremental" ]) # no full scan yet
+
+        self.assertEqual(rc, 0)
+        self.assertEqual(sorted([ "/foo.txt", "/Test/added.txt", "/New/new.txt" ]), sorted(self.dbx.uploaded))
+        watcher.read(0) # e.g. temporary files of fs_case_sensitive()
+
+        with self.subTest("changes"):
+            with open(TEST_TARGET / "foo.txt", "wb") as f: f.write(b"Changed")
+            unchanged = (TEST_TARGET / "Test" / "bar.txt").read_bytes()
+            with open(TEST_TARGET / "Test" / "bar.txt", "wb") as f: f.write(unchanged)
+            os.makedirs(TEST_TARGET / "Newer" / "sub")
+            with open(TEST_TARGET / "Newer" / "sub" / "newer.txt", "wb") as f: f.write(b"Newer")
+            os.remove(TEST_TARGET / "Test" / "added.txt")
+            shutil.rmtree(TEST_TARGET / "New")
+            changed = watcher.read(0.1)
+            self.assertIn(os.path.join("Test", "added.txt"), changed)
+            self.meta.journal_local(changed)
+            self.meta.commit()
+            self.dbx.uploaded, self.dbx.removed = [], []
+            self.dbx.files_list_folder.reset_mock()
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--direction=upload", "--incremental" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(0, self.dbx.files_list_folder.call_count)
+            self.assertEqual(sorted([ "/foo.txt", "/Newer/sub/newer.txt" ]), sorted(self.dbx.uploaded))
+            self.assertEqual(sorted([ "/new", "/test/added.txt" ]), sorted(self.dbx.removed))
+            self.assertEqual(b"Changed", self.dbx.remote["/foo.txt"][1])
+            self.assertIn("/newer/sub", self.dbx.remote)
+            self.assertEqual((0, []), self.meta.local_changes())
+
+        with self.subTest("excluded folder"):
+            os.makedirs(TEST_TARGET / "Build")
+            with open(TEST_TARGET / "Build" / "artifact.o", "wb") as f: f.write(b"Built")
+            ignore = dbxinotify.ignorer(dbxinotify.argparser().parse_args([ str(TEST_TARGET), "-m", TEST_DBNAME, "--exclude=/Build$" ]))
+            self.assertTrue(ignore(os.path.join("Build", "artifact.o")))
+            self.assertFalse(ignore("Builder.txt"))
+            self.meta.journal_local([ "Build", os.path.join("Build", "artifact.o") ])
+            self.meta.commit()
+            self.dbx.uploaded = []
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--direction=upload", "--incremental", "--exclude=/Build$" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual([], self.dbx.uploaded)
+            self.assertNotIn("/build", self.dbx.remote)
+
+        with self.subTest("overflow"):
+            self.meta.set_state("local_journal", json.dumps({ "pid": os.getpid(), "since": "", "overflow": dbxmirror.utcnow().isoformat() }))
+            self.meta.commit()
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--direction=upload", "--incremental" ])
+
+            self.assertEqual(rc, 0)
+            self.assertLess(0, self.dbx.files_list_folder.call_count)
+
+    def test_both(self):
+        """ upload local and download remote changes """
+        self.dbx.set_data(data.SIMPLE_1)
+        rc = dbxmirror.main(TEST_ARGS + [ "--direction=both" ])
+        self.assertEqual(rc, 0)
+        self.assertTargetMatchesRemote()
+
+        with self.subTest("changes on both sides"):
+            self.dbx.change({ "files": { "foo.txt": { "data": b"Changed remotely", "client_modified": datetime(2024, 11, 17) },
+                                         "new.txt": { "data": b"New remotely", "client_modified": datetime(2024, 11, 17) } } })
+            with open(TEST_TARGET / "Test" / "bar.txt", "wb") as f: f.write(b"Changed locally")
+            with open(TEST_TARGET / "Test" / "local.txt", "wb") as f: f.write(b"New locally")
+            os.remove(TEST_TARGET / "Test" / "empty.txt")
+            self.dbx.downloaded = []
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--direction=both" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual([ "/foo.txt", "/new.txt" ], sorted(remote for _local, remote in self.dbx.downloaded))
+            self.assertEqual([ "/Test/bar.txt", "/Test/local.txt" ], sorted(self.dbx.uploaded))
+            self.assertEqual([ "/test/empty.txt" ], self.dbx.removed)
+            self.assertEqual(b"Changed locally", self.dbx.remote["/test/bar.txt"][1])
+            self.assertEqual(b"Changed remotely", (TEST_TARGET / "foo.txt").read_bytes())
+            self.assertEqual(len(self.dbx.existing), len(self.listTarget()))
+
+        with self.subTest("conflict"):
+            self.dbx.change({ "files": { "foo.txt": { "data": b"Changed remotely again", "client_modified": datetime(2024, 11, 18) } } })
+            with open(TEST_TARGET / "foo.txt", "wb") as f: f.write(b"Changed locally, too")
+            self.dbx.downloaded, self.dbx.uploaded = [], []
+            mock_stdout = io.StringIO()
+
+            with redirect_stdout(mock_stdout):
+                rc = dbxmirror.main(TEST_ARGS + [ "--direction=both" ])
+
+            self.assertEqual(rc, 0)
+            self.assertRegex(mock_stdout.getvalue(), r"WARNING: Changed on both sides")
+            self.assertEqual(b"Changed remotely again", (TEST_TARGET / "foo.txt").read_bytes())
+            copy = [ p for p in self.dbx.uploaded if "conflicted copy" in p ]
+            self.assertEqual(1, len(copy))
+            self.assertEqual(b"Changed locally, too", self.dbx.remote[copy[0].lower()][1])
+
+        with self.subTest("removed remotely"):
+            self.dbx.change({ "deleted": { "new.txt": {} } })
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--direction=both" ])
+
+            self.assertEqual(rc, 0)
+            self.assertFalse((TEST_TARGET / "new.txt").exists())
+            self.assertEqual(len(self.dbx.existing), len(self.listTarget()))
+
+    def test_both_removals(self):
+        """ entries removed on one side are kept on the other one, if they have been changed there """
+        self.dbx.set_data(data.SIMPLE_1)
+        rc = dbxmirror.main(TEST_ARGS + [ "--direction=both" ])
+        self.assertEqual(rc, 0)
+
+        with self.subTest("changed locally"):
+            with open(TEST_TARGET / "foo.txt", "wb") as f: f.write(b"Changed locally")
+            with open(TEST_TARGET / "Test" / "empty" / "mine.txt", "wb") as f: f.write(b"New locally")
+            self.dbx.change({ "deleted": { "foo.txt": {} }, "folders": { "Test": { "deleted": { "empty": {} } } } })
+            self.dbx.uploaded = []
+            mock_stdout = io.StringIO()
+
+            with redirect_stdout(mock_stdout):
+                rc = dbxmirror.main(TEST_ARGS + [ "--direction=both" ])
+
+            self.assertEqual(rc, 0)
+            self.assertRegex(mock_stdout.getvalue(), r"WARNING: Changed locally, removed remotely: uploading foo.txt again")
+            self.assertEqual([ "/foo.txt", "/test/empty/mine.txt" ], sorted(path.lower() for path in self.dbx.uploaded))
+            self.assertEqual(b"Changed locally", self.dbx.remote["/foo.txt"][1])
+            self.assertEqual(b"New locally", (TEST_TARGET / "Test" / "empty" / "mine.txt").read_bytes())
+
+        with self.subTest("changed remotely"):
+            shutil.rmtree(TEST_TARGET / "Test")
+            self.dbx.change({ "folders": { "Test": { "files": { "remote.txt": { "data": b"New remotely", "client_modified": datetime(2024, 11, 17) } } } } })
+            self.dbx.removed = []
+            mock_stdout = io.StringIO()
+
+            with redirect_stdout(mock_stdout):
+                rc = dbxmirror.main(TEST_ARGS + [ "--direction=both" ])
+
+            self.assertEqual(rc, 0)
+            self.assertRegex(mock_stdout.getvalue(), r"WARNING: Changed remotely, removed locally: keeping remote /Test")
+            self.assertEqual([], self.dbx.removed)
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--direction=both" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(b"New remotely", (TEST_TARGET / "Test" / "remote.txt").read_bytes())
+            self.assertEqual(b"New locally", (TEST_TARGET / "Test" / "empty" / "mine.txt").read_bytes())
+            self.assertEqual(len(self.dbx.existing), len(self.listTarget()))
+
+    def test_fingerprint(self):
+        """ unchanged local files are not hashed again """
+        self.dbx.set_data(data.SIMPLE_EXIST_1)
+        hasher = dbxmirror.dropbox_content_hasher.hash_file
+
+        with patch.object(dbxmirror.dropbox_content_hasher, "hash_file", wraps=hasher) as mock_hasher:
+            rc = dbxmirror.main(TEST_ARGS)
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(len(self.dbx.files), mock_hasher.call_count)
+            fingerprints = self.meta.db.execute("select count(*) from meta where local_size is not null").fetchone()[0]
+            self.assertEqual(len(self.dbx.files), fingerprints)
+
+        with self.subTest("unchanged"), patch.object(dbxmirror.dropbox_content_hasher, "hash_file", wraps=hasher) as mock_hasher:
+            rc = dbxmirror.main(TEST_ARGS)
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(0, mock_hasher.call_count)
+            self.assertEqual(0, len(self.dbx.downloaded))
+
+        with self.subTest("changed"), patch.object(dbxmirror.dropbox_content_hasher, "hash_file", wraps=hasher) as mock_hasher:
+            with open(TEST_TARGET / "foo.txt", "wb") as f: f.write(b"Hello Changed!")
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--hash-jobs=2" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(1, mock_hasher.call_count)
+            self.assertEqual(1, len(self.dbx.downloaded))
+
+    def test_content_hasher(self):
+        """ hash buffers without copying, and files in chunks """
+        from ..dropbox_content_hasher import DropboxContentHasher, hash_file
+        block = DropboxContentHasher.BLOCK_SIZE
+        data  = bytes(range(256)) * (2 * block // 256) + b"tail"
+        expected = hashlib.sha256(b"".join(hashlib.sha256(data[i:i+block]).digest() for i in range(0, len(data), block))).hexdigest()
+
+        for what in (data, bytearray(data), memoryview(data)):
+            hasher = DropboxContentHasher()
+            hasher.update(what)
+            self.assertEqual(expected, hasher.hexdigest())
+
+        TEST_TARGET.mkdir(exist_ok=True)
+        path = TEST_TARGET / "big.bin"
+        with open(path, "wb") as f: f.write(data)
+        self.assertEqual(expected, hash_file(path))
+        self.assertEqual(expected, hash_file(path, chunk_size=1000 * 1000)) # not aligned to blocks
+        self.assertEqual(expected, hash_file(path, workers=2))
+        path.write_bytes(b"")
+        self.assertEqual(hashlib.sha256(b"").hexdigest(), hash_file(path))
+        self.assertEqual(hashlib.sha256(b"").hexdigest(), hash_file(path, workers=2))
+
+    def test_resume(self):
+        """ interrupted downloads are resumed from partial files """
+        from ..dbxtransfer import partpath, PART_SUFFIX
+        self.dbx.set_data(data.SIMPLE_1)
+        meta, content = self.dbx.remote["/foo.txt"]
+        download = self.dbx.files_download.side_effect
+        def interrupted(remote, *args, **kwargs):
+            meta, resp = download(remote, *args, **kwargs)
+            def broken(chunk_size=1):
+                yield resp.data[:5]
+                raise ConnectionError("Connection reset")
+            resp.iter_content = broken
+            return meta, resp
+
+        with self.subTest("interrupted"), redirect_stderr(io.StringIO()):
+            self.dbx.files_download.side_effect = interrupted
+
+            rc = dbxmirror.main(TEST_ARGS)
+
+            self.assertEqual(rc, 8)
+            self.assertFalse((TEST_TARGET / "foo.txt").exists())
+            with open(partpath(str(TEST_TARGET / "foo.txt"), meta.rev), "rb") as f:
+                self.assertEqual(content[:5], f.read())
+
+        with self.subTest("resumed"):
+            self.dbx.files_download.side_effect = download
+            self.dbx.files_download.reset_mock(); self.dbx.downloaded = []
+
+            rc = dbxmirror.main(TEST_ARGS)
+
+            self.assertEqual(rc, 0)
+            self.assertTargetMatchesRemote()
+            self.dbx.files_download.assert_any_call(f"rev:{meta.rev}", extra_headers={ "Range": "bytes=5-" })
+            self.assertEqual(content, (TEST_TARGET / "foo.txt").read_bytes())
+            self.assertEqual([], [ p for p in self.listTarget(include_hidden=True) if p.name.endswith(PART_SUFFIX) ])
+
+        with self.subTest("outdated"):
+            outdated = partpath(str(TEST_TARGET / "foo.txt"), "0123456789abcdef")
+            with open(outdated, "wb") as f: f.write(b"Hello")
+
+            rc = dbxmirror.main(TEST_ARGS)
+
+            self.assertEqual(rc, 0)
+            self.assertFalse(os.path.exists(outdated))
+
+        with self.subTest("outdated, no delete"):
+            with open(outdated, "wb") as f: f.write(b"Hello")
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--no-delete" ])
+
+            self.assertEqual(rc, 0)
+            self.assertFalse(os.path.exists(outdated))
+
+        with self.subTest("outdated, incremental"):
+            self.assertEqual(0, dbxmirror.main(TEST_ARGS + [ "--incremental" ]))
+            with open(outdated, "wb") as f: f.write(b"Hello")
+            self.dbx.change({ "files": { "foo.txt": { "data": b"Changed", "client_modified": datetime(2024, 11, 17) } } })
+
+            rc = dbxmirror.main(TEST_ARGS + [ "--incremental", "--no-delete" ])
+
+            self.assertEqual(rc, 0)
+            self.assertFalse(os.path.exists(outdated))
+            self.assertEqual(b"Changed", (TEST_TARGET / "foo.txt").read_bytes())
+            self.assertEqual([], [ p for p in self.listTarget(include_hidden=True) if p.name.endswith(PART_SUFFIX) ])
+
+    def test_batched_metadata(self):
+        """ metadata of a folder is loaded and written at once """
+        from .. import dbxmeta
+        self.dbx.set_data(data.MORE_FILES_1)
+        records, save_many = dbxmeta.DbxMetaDB.records, dbxmeta.DbxMetaDB.save_many
+
+        for run in ("create", "up to date"):
+            with self.subTest(run), patch.object(dbxmeta.DbxMetaDB, "records", autospec=True, side_effect=records) as mock_records, \
+                                    patch.object(dbxmeta.DbxMetaDB, "save_many", autospec=True, side_effect=save_many) as mock_save:
+                rc = dbxmirror.main(TEST_ARGS)
+
+                self.assertEqual(rc, 0)
+                self.assertEqual(1, mock_records.call_count) # one folder
+                self.assertEqual(1, mock_save.call_count)
+                self.assertEqual(len(self.dbx.files), len(mock_save.call_args.args[1]))
+                self.assertEqual(len(self.dbx.files), self.meta.db.execute("select count(*) from meta").fetchone()[0])
+
+    def test_records(self):
+        """ lightweight records for the meta table """
+        from ..dbxmeta import MetaRecord, LocalFileMeta
+        self.dbx.set_data(data.SIMPLE_1)
+        rc = dbxmirror.main(TEST_ARGS)
+        self.assertEqual(rc, 0)
+
+        records = self.meta.records()
+        self.assertEqual(len(self.dbx.existing), len(records))
+        self.assertTrue(all(isinstance(rec, MetaRecord) for rec in records))
+        self.assertFalse(hasattr(records[0], "__dict__"))
+
+        meta, _data = self.dbx.remote["/test/bar.txt"]
+        rec = self.meta.find_records([ "/test/bar.txt" ])["/test/bar.txt"]
+        self.assertTrue(rec.same(MetaRecord.from_dbx(meta, "/test")))
+        self.assertEqual("/test", rec.parent)
+        self.assertIsNotNone(rec.fingerprint)
+        local = self.meta.from_record(rec) # back to dropbox SDK types
+        self.assertIsInstance(local, LocalFileMeta)
+        self.assertEqual(meta.content_hash, local.content_hash)
+        self.assertTrue(rec.same(local.record()))
+
+    def test_schema(self):
+        """ indexed schema, migration of old databases and subtree operations """
+        import sqlite3
+        from ..dbxmeta import DbxMetaDB
+        self.dbx.set_data(data.SIMPLE_1)
+        rc = dbxmirror.main(TEST_ARGS)
+        self.assertEqual(rc, 0)
+
+        plan = self.meta.db.execute("explain query plan select * from meta where parent = ?", ("/test",)).fetchall()
+        self.assertRegex(str([ tuple(row) for row in plan ]), r"USING INDEX meta_parent")
+        self.assertEqual(len(DbxMetaDB.MIGRATIONS), self.meta.db.execute("pragma user_version").fetchone()[0])
+
+        self.assertEqual({ "/test", "/test/bar.txt", "/test/empty.txt", "/test/empty" },
+                         { rec.key for rec in self.meta.subtree("/test") })
+        self.assertEqual(4, self.meta.remove_subtree("/test"))
+        self.assertEqual(1, self.meta.db.execute("select count(*) from meta").fetchone()[0])
+
+        # a database of dropsync 0.2.x
+        old = sqlite3.connect(os.path.join(TEST_TARGET, "old.db3"))
+        old.execute("""create table meta (key text not null primary key, type text not null, name text not null, id text,
+                       size integer, path text, parent text, rev text,
+                       client_ts timestamp, server_ts timestamp, mod_ts timestamp, sync_ts timestamp)""")
+        old.execute("insert into meta (key, type, name, parent) values ('/foo.txt', 'LocalFileMeta', 'foo.txt', '')")
+        old.commit(); old.close()
+        db = DbxMetaDB(TEST_TARGET, "old.db3")
+        try:
+            self.assertEqual(len(DbxMetaDB.MIGRATIONS), db.db.execute("pragma user_version").fetchone()[0])
+            rec = db.find_records([ "/foo.txt" ])["/foo.txt"]
+            self.assertIsNone(rec.content_hash)
+            self.assertIsNone(rec.fingerprint)
+        finally:
+            db.close()
+
+    def test_metadb_profile(self):
+        """ SQLite performance profile of the metadata file """
+        from .. import dbxmeta
+        self.dbx.set_data(data.SIMPLE_1)
+        mock_stdout = io.StringIO()
+
+        with redirect_stdout(mock_stdout):
+            rc = dbxmirror.main(TEST_ARGS + [ "--metadb-profile=fast" ])
+
+        self.assertEqual(rc, 0)
+        self.assertRegex(mock_stdout.getvalue(), r"Metadata profile fast: journal_mode=wal, synchronous=1, .*temp_store=2")
+        self.assertEqual("wal", self.journal_mode())
+        self.assertTargetMatchesRemote() # read by a second connection
+
+        with self.subTest("safe"):
+            with redirect_stdout(io.StringIO()):
+                rc = dbxmirror.main(TEST_ARGS) # self.meta still has the file open
+
+            self.assertEqual(rc, 0)
+            self.assertEqual("wal", self.journal_mode()) # not switched back under other connections
+
+        with self.subTest("new file"):
+            dbxmeta.DbxMetaDB(TEST_TARGET, "new.db").close()
+            self.assertEqual("delete", self.journal_mode("new.db"))
+
+    def journal_mode(self, dbname=TEST_DBNAME):
+        import sqlite3
+        db = sqlite3.connect(TEST_TARGET / dbname)
+        try:
+            return db.execute("pragma journal_mode").fetchone()[0]
+        finally:
+            db.close()
+
+    def test_path_matcher(self):
+        """ combined exclude/include/keep patterns, pruning excluded folders """
+        from ..dbxutil import PathMatcher
+        matcher = PathMatcher([ "^/test/", "^/foo$", r"^/(a)\1" ], [ "^/test/keep" ], [ "^/kept" ], root="")
+        self.assertEqual(1, len(matcher.incl))
+        self.assertEqual(3, len(matcher.excl)) # not combined because of the backreference
+        self.assertEqual(1, len(PathMatcher([ "^/test/", "^/foo.*" ]).excl))
+
+        self.assertFalse(matcher.excluded("/Test"))
+        self.assertTrue(matcher.excluded("/Test/bar.txt"))
+        self.assertFalse(matcher.excluded("/test/keep.txt"))
+        self.assertTrue(matcher.excluded("/aa"))
+        self.assertTrue(matcher.kept("/KEPT/file"))
+        self.assertFalse(matcher.kept("/test/kept"))
+
+        self.assertTrue(matcher.excluded_tree("/foo/bar/baz.txt"))
+        self.assertIn("/foo", matcher._folders)
+        with patch.object(matcher, "excluded", wraps=matcher.excluded) as mock_excluded:
+            self.assertTrue(matcher.excluded_tree("/foo/bar/other.txt"))
+            self.assertEqual(0, mock_excluded.call_count) # /foo/bar is cached, so the entry itself isn't matched
+            self.assertFalse(matcher.excluded_tree("/bar.txt"))
+            self.assertEqual(1, mock_excluded.call_count) # no excluded ancestor, only the entry itself
+        self.assertFalse(matcher.excluded_tree("/bar/baz.txt"))
+        self.assertFalse(PathMatcher([ "^/sub$" ], root="/Sub").excluded_tree("/sub/file.txt"))
+
+    def test_dedup(self):
+        """ create files from identical local files instead of downloading them """
+        from .. import dbxtransfer
+        self.dbx.set_data(data.DUPLICATES_1)
+        mock_stdout = io.StringIO()
+
+        with redirect_stdout(mock_stdout):
+            rc = dbxmirror.main(TEST_ARGS + [ "--dedup=copy" ])
+
+        self.assertEqual(rc, 0)
+        self.assertEqual(1, len(self.dbx.downloaded)) # the first one, the others are copies
+        self.assertRegex(mock_stdout.getvalue(), r"Copying A/setup.exe from setup.exe")
+        for name in ("setup.exe", "A/setup.exe", "B/setup.exe"):
+            with open(os.path.join(TEST_TARGET, name), "rb") as f:
+                self.assertEqual(b"Installer" * 1000, f.read())
+        self.assertEqual(3, len(self.meta.find_content(self.dbx.files[0][0].content_hash))) # all verified
+
+        with self.subTest("hardlink"):
+            shutil.rmtree(TEST_TARGET / "A"); shutil.rmtree(TEST_TARGET / "B")
+            self.dbx.change({ "folders": { "C": { "files": { "setup.exe": { "data": b"Installer" * 1000,
+                                                                            "client_modified": datetime(2024, 11, 14, 12, 0, 0) } } } } })
+            self.dbx.downloaded = []
+            rc = dbxmirror.main(TEST_ARGS + [ "--dedup=hardlink" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(0, len(self.dbx.downloaded))
+            self.assertTrue(os.path.samefile(TEST_TARGET / "setup.exe", TEST_TARGET / "C" / "setup.exe")) # same timestamp
+            self.assertFalse(os.path.samefile(TEST_TARGET / "setup.exe", TEST_TARGET / "A" / "setup.exe"))
+
+            with patch.object(dbxmirror.dropbox_content_hasher, "hash_file") as mock_hasher:
+                rc = dbxmirror.main(TEST_ARGS + [ "--dedup=hardlink" ])
+            self.assertEqual(rc, 0)
+            self.assertEqual(0, mock_hasher.call_count) # all fingerprints still match
+
+        src, dst = os.path.join(TEST_TARGET, "setup.exe"), os.path.join(TEST_TARGET, "copy.exe")
+        for mode in dbxtransfer.DEDUP_MODES:
+            with self.subTest(mode=mode):
+                self.assertTrue(dbxtransfer.clone_file(src, dst, "rev", mode))
+                with open(dst, "rb") as f:
+                    self.assertEqual(b"Installer" * 1000, f.read())
+                self.assertEqual(mode == "hardlink", os.path.samefile(src, dst))
+                os.remove(dst)
+        self.assertFalse(dbxtransfer.clone_file(src, dst, "rev", check=lambda st: False)) # source changed
+        self.assertFalse(os.path.exists(dst))
+
+    def moved(self, args, initial=None):
+        self.dbx.set_data(data.SIMPLE_1)
+        rc = dbxmirror.main(TEST_ARGS + (args if initial is None else initial))
+        self.assertEqual(rc, 0)
+        inode = os.stat(TEST_TARGET / "Test" / "bar.txt").st_ino
+
+        self.dbx.change(data.SIMPLE_MOVED_1)
+        self.dbx.downloaded = []
+        mock_stdout = io.StringIO()
+        with redirect_stdout(mock_stdout):
+            rc = dbxmirror.main(TEST_ARGS + args)
+
+        self.assertEqual(rc, 0)
+        self.assertEqual(0, len(self.dbx.downloaded))
+        self.assertRegex(mock_stdout.getvalue(), r"Moving Test -> Renamed")
+        self.assertRegex(mock_stdout.getvalue(), r"Moving foo.txt -> Renamed/foo.txt")
+        self.assertEqual(inode, os.stat(TEST_TARGET / "Renamed" / "bar.txt").st_ino)
+        self.assertEqual(len(self.dbx.existing), len(self.listTarget()))
+        rec = self.meta.find_records([ "/renamed/empty" ])["/renamed/empty"]
+        self.assertEqual(("/renamed", "/Renamed/empty"), (rec.parent, rec.path))
+        self.assertEqual(0, self.meta.db.execute("select count(*) from meta where key like '/test/%'").fetchone()[0])
+        return mock_stdout.getvalue()
+
+    def test_moves(self):
+        """ rename moved files and folders instead of downloading them again """
+        self.moved([])
+
+    def test_moves_incremental(self):
+        """ rename moved files and folders found in a delta """
+        self.moved([ "--incremental" ])
+
+    def test_moves_plan(self):
+        """ plan moves instead of downloads and removals """
+        out = self.moved([ "--max-download=0" ], initial=[])
+
+        self.assertRegex(out, r"move +2 +0 bytes")
+        self.assertNotRegex(out, r"download|remove|mkdir")
+        self.assertEqual(len(self.dbx.existing), self.meta.db.execute("select count(*) from meta where type <> 'LocalDeletedMeta'").fetchone()[0])
+
+        with self.subTest("apply plan"):
+            from copy import deepcopy
+            tmp  = tempfile.mkdtemp(); self.addCleanup(shutil.rmtree, tmp)
+            plan = os.path.join(tmp, "plan.json")
+            inode = os.stat(TEST_TARGET / "Renamed" / "bar.txt").st_ino
+            self.dbx.change({ "folders": { "Back": deepcopy(data.SIMPLE_MOVED_1["folders"]["Renamed"]) }, "deleted": { "Renamed": {} } })
+
+            rc = dbxmirror.main(TEST_ARGS + [ f"--plan={plan}" ])
+
+            self.assertEqual(rc, 0)
+            with open(plan) as f: ops = json.load(f)["ops"]
+            self.assertEqual([ "move" ], [ op["op"] for op in ops ]) # the folder, with its contents
+
+            rc = dbxmirror.main(TEST_ARGS + [ f"--apply-plan={plan}" ])
+
+            self.assertEqual(rc, 0)
+            self.assertEqual(0, len(self.dbx.downloaded))
+            self.assertEqual(inode, os.stat(TEST_TARGET / "Back" / "bar.txt").st_ino)
+            self.assertEqual(len(self.dbx.existing), len(self.listTarget()))
+            self.assertEqual(0, self.meta.db.execute("select count(*) from meta where key like '/renamed/%'").fetchone()[0])
+            self.assertEqual(1, self.meta.db.execute("select count(*) from meta where key = '/back/foo.txt'").fetchone()[0])
+
+    def test_zip(self):
+        """ download the small files of a folder as one zip archive """
+        from .. import dbxtransfer
+        self.dbx.set_data(data.SMALL_FILES_1)
+        extract = dbxtransfer._extract
+        def corrupt(archive, info, meta, loc): # e.g. changed after the folder has been listed
+            return extract(archive, info, meta, loc) if meta.name != "f3.txt" else False
+
+        with patch.object(dbxtransfer, "_extract", side_effect=corrupt):
+            rc = dbxmirror.main(TEST_ARGS + [ "--zip-min=3" ])
+
+        self.assertEqual(rc, 0)
+        self.assertEqual([ "/small" ], self.dbx.zipped) # not the root folder
+        self.assertEqual([ "/f0.txt", "/small/f3.txt" ], sorted(remote for _none, remote in self.dbx.downloaded))
+        self.assertEqual(len(self.dbx.existing), len(self.listTarget()))
+        for meta, content in self.dbx.files:
+            loc = os.path.join(TEST_TARGET, meta.path_display.lstrip("/"))
+            with open(loc, "rb") as f:
+                self.assertEqual(content, f.read())
+            self.assertEqual(meta.client_modified.replace(tzinfo=timezone.utc).timestamp(), os.stat(loc).st_mtime)
+            self.assertIsNotNone(self.meta.find_records([ meta.path_lower ])[meta.path_lower].fingerprint)
+
+        with self.subTest("not enough files"):
+            os.remove(os.path.join(TEST_TARGET, "Small", "f1.txt"))
+            self.dbx.downloaded, self.dbx.zipped = [], []
+            rc = dbxmirror.main(TEST_ARGS + [ "--zip-min=3" ])
+            self.assertEqual(rc, 0)
+            self.assertEqual([], self.dbx.zipped)
+            self.assertEqual(1, len(self.dbx.downloaded))
+
+        with self.subTest("small share of the folder"):
+            for name in ("f1.txt", "f2.txt"): os.remove(os.path.join(TEST_TARGET, "Small", name))
+            self.dbx.downloaded, self.dbx.zipped = [], []
+            rc = dbxmirror.main(TEST_ARGS + [ "--zip-min=2" ])
+            self.assertEqual(rc, 0)
+            self.assertEqual([], self.dbx.zipped) # 2 of 5 files, the archive would contain 3 unchanged ones
+            self.assertEqual(2, len(self.dbx.downloaded))
+
+            for name in ("f1.txt", "f2.txt", "f3.txt"): os.remove(os.path.join(TEST_TARGET, "Small", name))
+            self.dbx.downloaded, self.dbx.zipped = [], []
+            rc = dbxmirror.main(TEST_ARGS + [ "--zip-min=2" ])
+            self.assertEqual(rc, 0)
+            self.assertEqual([ "/small" ], self.dbx.zipped)
+
+        with self.subTest("excluded file"):
+            shutil.rmtree(os.path.join(TEST_TARGET, "Small"))
+            self.dbx.downloaded, self.dbx.zipped = [], []
+            rc = dbxmirror.main(TEST_ARGS + [ "--zip-min=1", "--exclude=/Small/f1.txt" ])
+            self.assertEqual(rc, 0)
+            self.assertEqual([], self.dbx.zipped) # the archive would contain it
+            self.assertFalse(os.path.exists(os.path.join(TEST_TARGET, "Small", "f1.txt")))
+
+    def test_async_engine(self):
+        """ full sync with the asyncio engine """
+        from .. import aengine
+        self.dbx.set_data(data.SIMPLE_1)
+
+        with self.subTest("create"):
+            rc = aengine.main(TEST_ARGS + [ "--jobs=3" ])
+            self.assertEqual(rc, 0)
+            self.assertTargetMatchesRemote()
+            self.assertEqual(0, self.meta.db.execute("select count(*) from journal").fetchone()[0])
+
+        with self.subTest("up to date"):
+            self.dbx.downloaded = []
+            os.utime(TEST_TARGET / "foo.txt") # hashed again
+            with patch.object(dbxmirror.dropbox_content_hasher, "hash_file", wraps=dbxmirror.dropbox_content_hasher.hash_file) as mock_hash:
+                rc = aengine.main(TEST_ARGS)
+            self.assertEqual(rc, 0)
+            self.assertEqual(0, len(self.dbx.downloaded))
+            self.assertEqual(1, mock_hash.call_count)
+
+        with self.subTest("changes"):
+            self.dbx.change(data.SIMPLE_MOVED_1)
+            self.dbx.downloaded = []
+            rc = aengine.main(TEST_ARGS + [ "--jobs=2" ])
+            self.assertEqual(rc, 0)
+            self.assertEqual(0, len(self.dbx.downloaded))
+            self.assertEqual(len(self.dbx.existing), len(self.listTarget()))
+            self.assertEqual(len(self.dbx.existing), self.meta.db.execute("select count(*) from meta where type <> 'LocalDeletedMeta'").fetchone()[0])
+
+    def test_async_upload(self):
+        """ uploads with the asyncio engine: blocking calls don't run on the event loop """
+        import threading
+        from .. import aengine
+        self.dbx.set_data(data.UPLOAD_1)
+        threads = {}
+        def record(mock):
+            call = mock.side_effect
+            def wrapper(*args, **kwargs):
+                threads.setdefault(mock, set()).add(threading.current_thread().name.split("_")[0])
+                return call(*args, **kwargs)
+            mock.side_effect = wrapper
+        for mock in (self.dbx.files_list_folder, self.dbx.files_create_folder_v2, self.dbx.files_upload_session_finish_batch_v2):
+            record(mock)
+
+        rc = aengine.main(TEST_ARGS + [ "--direction=upload", "--jobs=2", "--list-jobs=2" ])
+
+        self.assertEqual(rc, 0)
+        self.assertEqual(sorted([ "/foo.txt", "/Test/added.txt", "/New/new.txt" ]), sorted(self.dbx.uploaded))
+        self.assertIn("/new/sub", self.dbx.remote)
+        self.assertEqual({ "dropsync-list" }, threads[self.dbx.files_list_folder])
+        self.assertNotIn("MainThread", threads[self.dbx.files_create_folder_v2])
+        self.assertEqual({ "dropsync" }, threads[self.dbx.files_upload_session_finish_batch_v2])
+        meta = self.meta.db.execute("select count(*) from meta where type <> 'LocalDeletedMeta'").fetchone()[0]
+        self.assertEqual(len(self.dbx.existing), meta)
@@ -1,4 +1,5 @@
-import os, io, re, platform
+import os, io, re, platform, shutil
+from datetime import datetime
 from .. import dbxmirror, dbxutil, dbxmeta
 from . import data, TestBase, TEST_ARGS, TEST_TARGET, TEST_DBNAME, unittest, patch, MagicMock
 from contextlib import redirect_stdout, redirect_stderr
@@ -87,19 +88,21 @@ class TestErrors(TestBase):
     def test_dry_run(self):
         """ sync data to an empty target (dry-run)
             see test_dbxmirror.TestDbxmirror.test_create_target()
-            also no real error, see the TODOs below...
         """
         self.dbx.set_data(data.SIMPLE_1)
+        mock_stdout = io.StringIO()
 
-        rc = dbxmirror.main(TEST_ARGS + [ "--dry-run" ])
+        with redirect_stdout(mock_stdout):
+            rc = dbxmirror.main(TEST_ARGS + [ "--dry-run" ])
 
         self.assertEqual(rc, 0)
         self.assertEqual(0, len(self.dbx.downloaded))
-        self.assertEqual(len(self.dbx.folders), self.dbx.makedirs_mock.call_count) # TODO: Folders ARE still created on dry-run
-        all = self.listTarget()
-        meta = self.meta.db.execute("select count(*) from meta").fetchone()[0]
-        self.assertEqual(len(self.dbx.folders), len(all))
-        self.assertEqual(len(self.dbx.folders) + len(self.dbx.files), meta) # TODO: Also, meta data ist also written to the database
+        self.assertEqual(0, self.dbx.makedirs_mock.call_count)
+        self.assertEqual([], self.listTarget())
+        self.assertEqual(0, self.meta.db.execute("select count(*) from meta").fetchone()[0])
+        size = sum(f[0].size for f in self.dbx.files)
+        self.assertRegex(mock_stdout.getvalue(), rf"mkdir +{len(self.dbx.folders)} +0 bytes")
+        self.assertRegex(mock_stdout.getvalue(), rf"download +{len(self.dbx.files)} +{size} bytes")
 
     @unittest.skipIf(not dbxutil.fs_case_sensitive(str(TEST_TARGET.parent)), "Target is case insensitive")
     def test_Case_Sensitive(self): # pragma: windows-nocover
@@ -124,7 +127,7 @@ class TestErrors(TestBase):
         """
         with self.subTest("DbxMetaDB.remove()"):
             self.dbx.set_data(data.SIMPLE_1)
-            rc = dbxmirror.main(TEST_ARGS + [ "--dry-run" ])
+            rc = dbxmirror.main(TEST_ARGS)
             self.assertEqual(rc, 0)
             meta = self.meta.db.execute("select count(*) from meta").fetchone()[0]
             self.assertGreater(meta, 0)
@@ -135,7 +138,7 @@ class TestErrors(TestBase):
 
         with self.subTest("DbxMetaDB(reset=True)"):
             self.dbx.set_data(data.SIMPLE_1)
-            rc = dbxmirror.main(TEST_ARGS + [ "--dry-run" ])
+            rc = dbxmirror.main(TEST_ARGS)
             self.assertEqual(rc, 0)
             meta = self.meta.db.execute("select count(*) from meta").fetchone()[0]
             self.assertGreater(meta, 0)
@@ -176,6 +179,25 @@ class TestErrors(TestBase):
             self.assertEqual( old if CS else Old, dbxutil.path_insensitive(Old))
             self.assertEqual((old if CS else Old) + os.sep, dbxutil.path_insensitive(Old + os.sep))
 
+            # ...and the same with a cached directory index
+            index = dbxutil.DirIndex(tgt)
+            self.assertIs(None, dbxutil.path_insensitive(New, index))
+            self.assertIs(None, dbxutil.path_insensitive(os.path.join(New, "new") + os.sep, index))
+            self.assertIs(None, dbxutil.path_insensitive(os.path.join(File, "dir"), index))
+            self.assertEqual(old + os.sep, dbxutil.path_insensitive(Old + os.sep, index))
+            self.assertEqual(tgt, dbxutil.path_insensitive(tgt, index))
+            with patch.object(dbxutil.os, "listdir", wraps=os.listdir) as mock_listdir:
+                self.assertEqual(File, dbxutil.path_insensitive(os.path.join(Old, "FILE"), index))
+                self.assertEqual(0, mock_listdir.call_count) # already listed
+                os.makedirs(os.path.join(new, "sub"))
+                index.add(os.path.join(new, "sub"))
+                self.assertEqual(os.path.join(new, "sub"), index.resolve(os.path.join(New, "SUB")))
+                self.assertEqual(1, mock_listdir.call_count) # only the new folder
+                shutil.rmtree(new)
+                index.remove(new)
+                self.assertIs(None, index.resolve(os.path.join(New, "sub")))
+                self.assertNotIn(new, index.dirs)
+
         with self.subTest("lets get 100%"):
             from ..dbxmeta import LocalDeletedMeta, LocalFileMeta
             class FoobarMeta(LocalDeletedMeta):
@@ -193,7 +215,7 @@ class TestErrors(TestBase):
 
             # fill meta DB again
             test_args = TEST_ARGS + [ "--exclude=FindMeNot"]; test_args.remove("-vvv") # coverage ;)
-            rc = dbxmirror.main(test_args + [ "--dry-run" ]); self.assertEqual(rc, 0)
+            rc = dbxmirror.main(test_args); self.assertEqual(rc, 0)
             meta = self.meta.db.execute("select count(*) from meta").fetchone()[0]
             self.assertGreater(meta, 0)
             self.assertEqual(meta, len(self.meta.find()))
@@ -206,7 +228,7 @@ class TestErrors(TestBase):
             self.meta.remove("name like '%'"); self.meta.db.commit() # slightly different, no params
             self.assertEqual(0, self.meta.db.execute("select count(*) from meta").fetchone()[0])
 
-            mock_stdout, mock_args = io.StringIO(), MagicMock(verbose=0, excl_patt=[re.compile(".*")])
+            mock_stdout, mock_args = io.StringIO(), MagicMock(verbose=0, excl_patt=[re.compile(".*")], matcher=dbxutil.PathMatcher([".*"]))
             with redirect_stdout(mock_stdout):
                 dbxmirror.log(mock_args, 1, "Hello Not!")
                 self.assertEqual("", mock_stdout.getvalue())
@@ -219,3 +241,296 @@ class TestErrors(TestBase):
                 mock_args.verbose = 3
                 dbxmirror.dbx_list(mock_args, self.dbx, "")
                 self.assertRegex(mock_stdout.getvalue(), r"^Excluded: .*")
+
+    def test_parallel_error(self):
+        """ a failing transfer in a worker thread aborts the sync """
+        self.dbx.set_data(data.MORE_FILES_1)
+        self.dbx.files_download.side_effect = OSError("Disk full")
+        mock_stderr = io.StringIO()
+
+        with redirect_stderr(mock_stderr):
+            rc = dbxmirror.main(TEST_ARGS + [ "--jobs=2" ])
+
+        self.assertEqual(rc, 8)
+        self.assertRegex(mock_stderr.getvalue(), r"ERROR: Exception.*Disk full")
+        self.assertEqual(0, self.meta.db.execute("select count(*) from meta").fetchone()[0])
+
+    def test_corrupt_download(self):
+        """ the content hash of the downloaded data doesn't match """
+        self.dbx.set_data(data.SIMPLE_1)
+        download = self.dbx.files_download.side_effect
+        def corrupt(remote, *args, **kwargs):
+            meta, resp = download(remote, *args, **kwargs)
+            resp.data = resp.data + b"garbage"
+            return meta, resp
+        self.dbx.files_download.side_effect = corrupt
+        mock_stderr = io.StringIO()
+
+        with redirect_stderr(mock_stderr):
+            rc = dbxmirror.main(TEST_ARGS)
+
+        self.assertEqual(rc, 4)
+        self.assertRegex(mock_stderr.getvalue(), r"ERROR: Transfer of foo.txt failed: .*Content hash mismatch")
+        self.assertFalse((TEST_TARGET / "foo.txt").exists())
+
+    def test_checkpoint_resume(self):
+        """ an aborted sync keeps the checkpointed metadata and resumes """
+        self.dbx.set_data(data.TWO_FOLDERS_1)
+        download = self.dbx.files_download.side_effect
+        def fail_b(remote, *args, **kwargs):
+            meta, resp = download(remote, *args, **kwargs)
+            if meta.path_lower.startswith("/b/"): raise ConnectionError("Network is unreachable")
+            return meta, resp
+        self.dbx.files_download.side_effect = fail_b
+
+        with redirect_stderr(io.StringIO()):
+            rc = dbxmirror.main(TEST_ARGS + [ "--checkpoint=1" ])
+
+        self.assertEqual(rc, 8)
+        self.assertEqual(1, self.meta.db.execute("select count(*) from journal").fetchone()[0])
+        self.assertEqual(1, self.meta.db.execute("select count(*) from meta where key = '/a/a.txt'").fetchone()[0])
+
+        self.dbx.files_download.side_effect = download
+        self.dbx.files_list_folder.reset_mock(); self.dbx.downloaded = []
+
+        rc = dbxmirror.main(TEST_ARGS)
+
+        self.assertEqual(rc, 0)
+        listed = [ c.args[0] for c in self.dbx.files_list_folder.call_args_list ]
+        self.assertNotIn("/a", listed)
+        self.assertIn("/b", listed)
+        self.assertEqual([ "/b/b.txt" ], [ remote for _local, remote in self.dbx.downloaded ])
+        self.assertEqual(0, self.meta.db.execute("select count(*) from journal").fetchone()[0])
+        self.assertEqual(len(self.dbx.existing), self.meta.db.execute("select count(*) from meta").fetchone()[0])
+
+    def test_resume_removal(self):
+        """ a folder with an entry to be removed isn't journaled as done before the removal """
+        self.dbx.set_data(data.TWO_FOLDERS_1)
+        rc = dbxmirror.main(TEST_ARGS)
+        self.assertEqual(rc, 0)
+
+        (TEST_TARGET / "A" / "stale.txt").write_bytes(b"Stale")
+        self.dbx.change({ "folders": { "B": { "files": { "b.txt": { "data": b"Changed B", "client_modified": datetime(2024, 11, 17) } } } } })
+        download = self.dbx.files_download.side_effect
+        def fail_b(remote, *args, **kwargs):
+            meta, resp = download(remote, *args, **kwargs)
+            if meta.path_lower.startswith("/b/"): raise ConnectionError("Network is unreachable")
+            return meta, resp
+        self.dbx.files_download.side_effect = fail_b
+
+        with redirect_stderr(io.StringIO()):
+            rc = dbxmirror.main(TEST_ARGS + [ "--checkpoint=1" ])
+
+        self.assertEqual(rc, 8)
+        self.assertTrue((TEST_TARGET / "A" / "stale.txt").exists())
+        self.assertEqual(0, self.meta.db.execute("select count(*) from journal where key = '/a'").fetchone()[0])
+
+        self.dbx.files_download.side_effect = download
+        rc = dbxmirror.main(TEST_ARGS)
+
+        self.assertEqual(rc, 0)
+        self.assertFalse((TEST_TARGET / "A" / "stale.txt").exists())
+        self.assertEqual(b"Changed B", (TEST_TARGET / "B" / "b.txt").read_bytes())
+
+    def test_async_engine_error(self):
+        """ a failing transfer aborts the asyncio engine """
+        from .. import aengine
+        self.dbx.set_data(data.SMALL_FILES_1)
+        self.dbx.files_download.side_effect = OSError("Disk full")
+        mock_stderr = io.StringIO()
+
+        with redirect_stderr(mock_stderr):
+            rc = aengine.main(TEST_ARGS + [ "--jobs=2" ])
+
+        self.assertEqual(rc, 8)
+        self.assertRegex(mock_stderr.getvalue(), r"ERROR: Exception.*Disk full")
+        self.assertEqual(0, self.meta.db.execute("select count(*) from meta").fetchone()[0])
+
+    def test_retry(self):
+        """ transient remote errors are retried, rate limits wait as requested """
+        import requests.exceptions, dropbox.exceptions
+        self.dbx.set_data(data.SIMPLE_1)
+        list_folder, download = self.dbx.files_list_folder.side_effect, self.dbx.files_download.side_effect
+        failures = [ dropbox.exceptions.RateLimitError("req", backoff=5), requests.exceptions.ConnectionError("Connection reset") ]
+        def flaky(fn):
+            def call(*args, **kwargs):
+                if failures: raise failures.pop(0)
+                return fn(*args, **kwargs)
+            return call
+        self.dbx.files_list_folder.side_effect = flaky(list_folder)
+        self.dbx.files_download.side_effect = flaky(download)
+
+        rc = dbxmirror.main(TEST_ARGS + [ "--retries=1" ])
+
+        self.assertEqual(rc, 0)
+        self.assertTargetMatchesRemote()
+        self.assertEqual(2, self.sleep.call_count)
+        self.assertGreaterEqual(self.sleep.call_args_list[0].args[0], 5)
+
+        with self.subTest("exhausted"):
+            self.dbx.files_download.side_effect = requests.exceptions.ConnectionError("Network is unreachable")
+            (TEST_TARGET / "foo.txt").unlink()
+            self.sleep.reset_mock(); self.dbx.files_download.reset_mock()
+            mock_stdout, mock_stderr = io.StringIO(), io.StringIO()
+
+            with redirect_stdout(mock_stdout), redirect_stderr(mock_stderr):
+                rc = dbxmirror.main(TEST_ARGS + [ "--retries=2" ])
+
+            self.assertEqual(rc, 4)
+            self.assertEqual(3, self.dbx.files_download.call_count)
+            self.assertEqual(2, self.sleep.call_count)
+            self.assertRegex(mock_stderr.getvalue(), r"ERROR: Transfer of foo.txt failed: .*Network is unreachable")
+            self.assertRegex(mock_stderr.getvalue(), r"ERROR: 1 transfers failed")
+            self.assertRegex(mock_stdout.getvalue(), r"Remote errors: 2 retries \(0 rate limited\)")
+            self.assertFalse((TEST_TARGET / "foo.txt").exists())
+            self.assertGreater(self.meta.db.execute("select count(*) from journal").fetchone()[0], 0) # the sync went on
+
+        with self.subTest("resumed"):
+            self.dbx.files_download.side_effect = download
+            self.dbx.downloaded = []
+
+            rc = dbxmirror.main(TEST_ARGS)
+
+            self.assertEqual(rc, 0)
+            self.assertEqual([ "/foo.txt" ], [ remote for _none, remote in self.dbx.downloaded ])
+            self.assertEqual(len(self.dbx.existing), len(self.listTarget()))
+            self.assertEqual(0, self.meta.db.execute("select count(*) from journal").fetchone()[0])
+
+    def test_permanent_error(self):
+        """ a file failing with a permanent error is skipped, the others are synced """
+        import dropbox.exceptions, dropbox.files
+        self.dbx.set_data(data.SIMPLE_1)
+        download, foo = self.dbx.files_download.side_effect, self.dbx.remote["/foo.txt"][0]
+        def restricted(remote, *args, **kwargs):
+            if remote in (foo.path_lower, "rev:" + foo.rev):
+                raise dropbox.exceptions.ApiError("req", dropbox.files.DownloadError.path(dropbox.files.LookupError.restricted_content), None, None)
+            return download(remote, *args, **kwargs)
+        self.dbx.files_download.side_effect = restricted
+        mock_stderr = io.StringIO()
+
+        with redirect_stderr(mock_stderr):
+            rc = dbxmirror.main(TEST_ARGS)
+
+        self.assertEqual(rc, 4)
+        self.assertEqual(1, self.dbx.files_download.call_count - len(self.dbx.downloaded)) # not retried
+        self.assertRegex(mock_stderr.getvalue(), r"ERROR: Transfer of foo.txt failed: .*restricted_content")
+        self.assertFalse((TEST_TARGET / "foo.txt").exists())
+        self.assertTrue((TEST_TARGET / "Test" / "bar.txt").exists())
+
+        with self.subTest("upload batch"):
+            import requests.exceptions
+            self.dbx.files_download.side_effect = download
+            (TEST_TARGET / "new.txt").write_bytes(b"new")
+            self.dbx.files_upload_session_finish_batch_v2.side_effect = requests.exceptions.ConnectionError("Connection reset")
+            mock_stderr = io.StringIO()
+
+            with redirect_stderr(mock_stderr):
+                rc = dbxmirror.main(TEST_ARGS + [ "--direction=both" ])
+
+            self.assertEqual(rc, 4)
+            self.assertEqual(1, self.dbx.files_upload_session_finish_batch_v2.call_count) # the sessions might have been committed
+            self.assertRegex(mock_stderr.getvalue(), r"ERROR: Transfer of .*new.txt failed: .*Connection reset")
+            self.assertTrue((TEST_TARGET / "foo.txt").exists())
+
+    def test_upload_refused(self):
+        """ an upload refused by dropbox fails alone, the others of its batch are committed """
+        import dropbox.files
+        self.dbx.set_data(data.SIMPLE_1)
+        rc = dbxmirror.main(TEST_ARGS)
+        self.assertEqual(rc, 0)
+
+        (TEST_TARGET / "a.txt").write_bytes(b"A")
+        (TEST_TARGET / "b.txt").write_bytes(b"B")
+        finish = self.dbx.files_upload_session_finish_batch_v2.side_effect
+        def refuse_b(entries):
+            result = finish([ arg for arg in entries if arg.commit.path != "/b.txt" ])
+            failure = dropbox.files.UploadSessionFinishBatchResultEntry.failure(
+                dropbox.files.UploadSessionFinishError.path(dropbox.files.WriteError.insufficient_space))
+            results = iter(result.entries)
+            return dropbox.files.UploadSessionFinishBatchResult(
+                entries=[ failure if arg.commit.path == "/b.txt" else next(results) for arg in entries ])
+        self.dbx.files_upload_session_finish_batch_v2.side_effect = refuse_b
+        mock_stderr = io.StringIO()
+
+        with redirect_stderr(mock_stderr):
+            rc = dbxmirror.main(TEST_ARGS + [ "--direction=both" ])
+
+        self.assertEqual(rc, 4)
+        self.assertRegex(mock_stderr.getvalue(), r"ERROR: Transfer of b.txt failed: .*insufficient_space")
+        self.assertEqual([ "/a.txt" ], self.dbx.uploaded)
+        self.assertEqual(1, self.meta.db.execute("select count(*) from meta where key = '/a.txt'").fetchone()[0])
+        self.assertEqual(0, self.meta.db.execute("select count(*) from meta where key = '/b.txt'").fetchone()[0])
+
+        self.dbx.files_upload_session_finish_batch_v2.side_effect = finish
+        self.dbx.uploaded = []
+        rc = dbxmirror.main(TEST_ARGS + [ "--direction=both" ])
+
+        self.assertEqual(rc, 0)
+        self.assertEqual([ "/b.txt" ], self.dbx.uploaded) # no conflicted copy of a.txt
+        self.assertEqual(len(self.dbx.existing), len(self.listTarget()))
+
+    def test_local_journal_scan_failed(self):
+        """ a full scan with failed uploads doesn't complete the local change journal, the next run scans again """
+        import json, requests.exceptions
+        self.dbx.set_data(data.SIMPLE_1)
+        rc = dbxmirror.main(TEST_ARGS)
+        self.assertEqual(rc, 0)
+
+        self.meta.set_state("local_journal", json.dumps({ "pid": os.getpid(), "since": dbxmirror.utcnow().isoformat(), "overflow": None }))
+        self.meta.commit()
+        (TEST_TARGET / "new.txt").write_bytes(b"New")
+        finish = self.dbx.files_upload_session_finish_batch_v2.side_effect
+        self.dbx.files_upload_session_finish_batch_v2.side_effect = requests.exceptions.ConnectionError("Connection reset")
+
+        with redirect_stderr(io.StringIO()):
+            rc = dbxmirror.main(TEST_ARGS + [ "--direction=upload", "--incremental" ])
+
+        self.assertEqual(rc, 4)
+        self.assertIsNone(self.meta.get_state("local_journal:scanned"))
+
+        self.dbx.files_upload_session_finish_batch_v2.side_effect = finish
+        self.dbx.files_list_folder.reset_mock()
+
+        rc = dbxmirror.main(TEST_ARGS + [ "--direction=upload", "--incremental" ])
+
+        self.assertEqual(rc, 0)
+        self.assertLess(0, self.dbx.files_list_folder.call_count) # scanned again
+        self.assertEqual([ "/new.txt" ], self.dbx.uploaded)
+        self.assertIsNotNone(self.meta.get_state("local_journal:scanned"))
+
+    def test_retry_limits(self):
+        """ rate limits without a backoff count as attempts, non-idempotent calls aren't repeated blindly """
+        import requests.exceptions, dropbox.exceptions, dropbox.files
+        from .. import dbxretry
+        retry = dbxretry.Retry(retries=2)
+        fn = MagicMock(side_effect=dropbox.exceptions.RateLimitError("req", backoff=None), __name__="fn")
+
+        with self.assertRaises(dropbox.exceptions.RateLimitError):
+            retry.call(fn)
+
+        self.assertEqual(3, fn.call_count)
+        self.assertEqual(2, self.sleep.call_count)
+        self.assertTrue(all(c.args[0] <= retry.cap for c in self.sleep.call_args_list))
+
+        with self.subTest("create folder"):
+            folder = dropbox.files.FolderMetadata(name="new", id="id:new", path_lower="/new", path_display="/new")
+            conflict = dropbox.files.CreateFolderError.path(dropbox.files.WriteError.conflict(dropbox.files.WriteConflictError.folder))
+            dbx = MagicMock()
+            dbx.files_create_folder_v2.side_effect = [ requests.exceptions.ConnectionError("Connection reset"),
+                                                       dropbox.exceptions.ApiError("req", conflict, None, None) ]
+            dbx.files_get_metadata.return_value = folder
+
+            self.assertEqual(folder, dbxretry.Retrying(dbx, retry).files_create_folder_v2("/new").metadata)
+
+            self.assertEqual(2, dbx.files_create_folder_v2.call_count)
+            dbx.files_create_folder_v2.side_effect = [ dropbox.exceptions.ApiError("req", conflict, None, None) ]
+            with self.assertRaises(dropbox.exceptions.ApiError): # not created by a previous attempt
+                dbxretry.Retrying(dbx, retry).files_create_folder_v2("/new")
+
+        with self.subTest("finish batch"):
+            dbx.files_upload_session_finish_batch_v2.side_effect = requests.exceptions.ConnectionError("Connection reset")
+
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                dbxretry.Retrying(dbx, retry).files_upload_session_finish_batch_v2([])
+
+            self.assertEqual(1, dbx.files_upload_session_finish_batch_v2.call_count)